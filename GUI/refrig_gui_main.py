@@ -6,6 +6,10 @@ from time import sleep
 import paho.mqtt.client as mqtt
 import logging
 from pathlib import Path
+import struct
+import json
+import zlib
+import uuid
 
 
 class refrigMainWindow(refrig_ui_mainwindow.Ui_MainWindow):
@@ -13,6 +17,7 @@ class refrigMainWindow(refrig_ui_mainwindow.Ui_MainWindow):
     update_time_milisecs = 2000
     main_window = None
     sens_data = {}
+    sens_quality = {} # quality of values (good/stale/comm_error/out_of_range/substituted)
 
     def __init__(self, mw) -> None:
         try:
@@ -28,7 +33,7 @@ class refrigMainWindow(refrig_ui_mainwindow.Ui_MainWindow):
             self.setupUi(mw) # init interface
             for obj in self.main_window.findChildren(refrig_widgets.ValveWidget):
                 obj.mw = self
-            self.mqtt_iface = mqtt_iface(self.ext_iface_cfg, self.read_callback, self.process_error)
+            self.mqtt_iface = mqtt_iface(self.ext_iface_cfg, self.read_callback, self.process_error, self.quality_callback)
             self.update_state('OK')
             # make update timer (SHOULD BE SET AT THE VERY END OF INIT):
             self.update_timer = QtCore.QTimer(self.main_window)
@@ -99,6 +104,10 @@ class refrigMainWindow(refrig_ui_mainwindow.Ui_MainWindow):
         self.sens_data.update({dev_name:value})
 
 
+    def quality_callback(self, dev_name, quality):
+        self.sens_quality.update({dev_name:quality})
+
+
     def get_metrics(self): 
         try:
             #look for every sensor device name in response dict and update widget values
@@ -107,16 +116,19 @@ class refrigMainWindow(refrig_ui_mainwindow.Ui_MainWindow):
                 if val==None: # log no responce
                     self.logger.info(f'No responce from {obj.objectName()}')
                 obj.update_value(val)
+                obj.set_quality(self.sens_quality.get(obj.objectName(), 'good'))
             #same for valves (feedback)
             for obj in self.main_window.findChildren(refrig_widgets.ValveWidget):
                 val = self.sens_data.get(f'{obj.objectName()}_fb', None)
                 if val==None: # log no responce
                     self.logger.info(f'No responce from {obj.objectName()}_fb')
                 obj.update_value(val)
+                obj.set_quality(self.sens_quality.get(f'{obj.objectName()}_fb', 'good'))
             #and for turbo pumps
             for obj in self.main_window.findChildren(refrig_widgets.TurboPumpWidget):
                 val = self.sens_data.get(f'{obj.objectName()}_State', None)
                 obj.update_value(val)
+                obj.set_quality(self.sens_quality.get(f'{obj.objectName()}_State', 'good'))
             self.update_timer.start(self.update_time_milisecs)  # reset timer
         except Exception as err:
             self.process_error(type(err)(f'get_metrics: {err}'))
@@ -169,10 +181,24 @@ class refrigMainWindow(refrig_ui_mainwindow.Ui_MainWindow):
         
 
 class mqtt_iface():
-    def __init__(self, iface_cfg, read_callback, err_handler) -> None:
+
+    # decoder of refrig/snapshot messages (see core's refrig_external_ifaces.mqtt_iface)
+    snapshot_version = 1
+    snapshot_header = struct.Struct('<BBIdH') # schema version, kind (0 - snapshot, 1 - delta), schema id, unix time, entries
+    snapshot_entry = struct.Struct('<HdB') # device index, value (NaN - no value), quality index
+    # decoder of history replies (see core's refrig_historian.HistoryQueryService)
+    history_version = 1
+    history_header = struct.Struct('<BBHHdI') # version, flags (1 - last, 2 - error), sequence number, device index, resolution, rows
+    history_raw_row = struct.Struct('<ddB') # timestamp, value (NaN - no value), quality code
+    history_bucket_row = struct.Struct('<dddddI') # bucket start, min, max, mean, last, count
+
+    def __init__(self, iface_cfg, read_callback, err_handler, quality_callback = None) -> None:
         self.process_error = err_handler
         self.con_info = iface_cfg
         self.read_callback = read_callback
+        self.quality_callback = quality_callback
+        self.snapshot_schema = None # (schema id, device names, quality names) from refrig/snapshot/schema
+        self.history_requests = {} # {request id: (device names, callback, {dev_name: (resolution, rows)})}
         self.mqtt_client = mqtt.Client()
         self.connect_iface()
 
@@ -200,10 +226,80 @@ class mqtt_iface():
 
     def process_read(self, client, userdata, msg):
         try:
-            dev_name = msg.topic.split("/")[-1]
+            topic = msg.topic.split("/")
+            dev_name = topic[-1]
+            if topic[1] == 'snapshot': # refrig/snapshot (binary) and refrig/snapshot/schema
+                self.process_snapshot(topic, msg.payload)
+                return
+            if topic[1] == 'history': # replies to our requests, other requests/replies are skipped
+                if len(topic) == 4 and topic[2] == 'reply' and topic[3] in self.history_requests:
+                    self.process_history_reply(topic[3], msg.payload)
+                return
             value = f'{msg.payload.decode()}'
-            if dev_name not in ['State', 'Status', 'Command']:
-                value = float(value)
+            if len(topic) == 3 and topic[1] == 'quality': # refrig/quality/<dev_name>: "quality timestamp source"
+                if self.quality_callback is not None:
+                    self.quality_callback(dev_name, value.split(' ')[0])
+                return
+            if dev_name not in ['State', 'Status', 'Command', 'Metrics']:
+                value = float(value) if value else None # empty payload - no value
             self.read_callback(dev_name, value)
         except Exception as err:
-            self.process_error(type(err)(f'process_read: {err}'))
\ No newline at end of file
+            self.process_error(type(err)(f'process_read: {err}'))
+
+
+    def process_snapshot(self, topic, payload):
+        '''
+        Decodes snapshot/delta messages to values and qualities, messages of unknown schema are skipped
+        '''
+        try:
+            if topic[-1] == 'schema':
+                schema = json.loads(payload.decode())
+                if schema['version'] != self.snapshot_version:
+                    raise ValueError(f'unsupported snapshot version {schema["version"]}')
+                self.snapshot_schema = (zlib.crc32(payload), schema['devices'], schema['qualities'])
+                return
+            version, kind, schema_id, timestamp, num_entries = self.snapshot_header.unpack_from(payload)
+            if self.snapshot_schema is None or version != self.snapshot_version or schema_id != self.snapshot_schema[0]:
+                return # schema is not received yet (it is retained, so it comes soon)
+            _, dev_names, qualities = self.snapshot_schema
+            for idx, value, quality_idx in self.snapshot_entry.iter_unpack(payload[self.snapshot_header.size:]):
+                self.read_callback(dev_names[idx], None if value != value else value) # NaN - no value
+                if self.quality_callback is not None:
+                    self.quality_callback(dev_names[idx], qualities[quality_idx])
+        except Exception as err:
+            self.process_error(type(err)(f'process_snapshot: {err}'))
+
+
+    def request_history(self, devices:list, start:float, end:float, max_points:int, callback):
+        '''
+        Requests recorded history of devices (unix time range, decimated by the core to max_points per device).
+        callback({dev_name: (resolution, rows)}) is called from the MQTT thread when the whole reply is received (replies come
+        with refrig/# subscription):
+        resolution 0 - rows are (timestamp, value, quality code), otherwise (bucket start, min, max, mean, last, count)
+        '''
+        request_id = uuid.uuid4().hex
+        self.history_requests[request_id] = (list(devices), callback, {})
+        self.mqtt_client.publish('refrig/history/request', json.dumps({'id':request_id, 'devices':list(devices), 'start':start,
+                                                                        'end':end, 'max_points':max_points}))
+        return request_id
+
+
+    def process_history_reply(self, request_id, payload):
+        try:
+            data = zlib.decompress(payload)
+            version, flags, seq, dev_idx, resolution, num_rows = self.history_header.unpack_from(data)
+            if version != self.history_version:
+                raise ValueError(f'unsupported history reply version {version}')
+            devices, callback, results = self.history_requests[request_id]
+            body = data[self.history_header.size:]
+            if flags & 2: # error
+                del self.history_requests[request_id]
+                raise ValueError(f'history request failed: {body.decode()}')
+            row_struct = self.history_bucket_row if resolution else self.history_raw_row
+            rows = results.setdefault(devices[dev_idx], (resolution, []))[1]
+            rows.extend(row_struct.iter_unpack(body[:num_rows * row_struct.size]))
+            if flags & 1: # last chunk
+                del self.history_requests[request_id]
+                callback(results)
+        except Exception as err:
+            self.process_error(type(err)(f'process_history_reply: {err}'))
@@ -17,6 +17,22 @@ turbine_validator = QtGui.QIntValidator()
 turbine_validator.setRange(0, 1000)
 
 
+def set_label_quality(label, quality):
+    '''
+    greys out a widget label if its value is not good (stale, comm_error, etc.), quality is shown in tooltip
+    '''
+    if quality == 'good':
+        label.setGraphicsEffect(None)
+        label.setToolTip('')
+        return
+    if not isinstance(label.graphicsEffect(), QtWidgets.QGraphicsColorizeEffect):
+        effect = QtWidgets.QGraphicsColorizeEffect(label)
+        effect.setColor(QtGui.QColor('gray'))
+        effect.setStrength(1)
+        label.setGraphicsEffect(effect)
+    label.setToolTip(quality)
+
+
 class ValveWidget(QtWidgets.QWidget):
     '''
     abstract class for valve widgets
@@ -63,6 +79,10 @@ class ValveWidget(QtWidgets.QWidget):
             self.p_win.raise_()
 
 
+    def set_quality(self, quality):
+        set_label_quality(self.label, quality)
+
+
     def update_value(self, val):
         '''
         Updates value and color of widget
@@ -400,6 +420,10 @@ class SensWidget(QtWidgets.QWidget):
             self.set_green()
 
 
+    def set_quality(self, quality):
+        set_label_quality(self.label, quality)
+
+
     def format_value(self, val):
         if val == 0:
             return '0'
@@ -0,0 +1,263 @@
+# asyncio engine for modbus RTU over TCP gateways (PKT8 thermometry)
+# several requests can be in flight (per connection and over several connections to the gateway),
+# lost connections are restored automatically with backoff
+import asyncio
+import socket
+import struct
+from collections import deque
+from multiprocessing import Queue
+from time import monotonic, perf_counter
+
+from refrig_comm_ifaces import BaseInterface, ModbusRtuOverTcpComInterface
+from refrig_data_converters import RefrigDataConverter
+from refrig_modbus_codec import codec_from_config, crc16_modbus
+
+
+class AsyncRtuOverTcpClient():
+    '''
+    minimal asyncio modbus RTU-over-TCP client;
+    RTU frames have no transaction id, so responses are matched to requests in order (FIFO),
+    any timeout or broken frame resets the connection to resync the stream
+    '''
+    def __init__(self, host:str, port:int, timeout:float = 1, max_in_flight:int = 1, backoff:float = 1, max_backoff:float = 30) -> None:
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cur_backoff = backoff
+        self.retry_at = 0
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.pending = deque() # (unit, function code, future) in order of sending
+        self.in_flight = None # semaphore, created inside the event loop
+        self.write_lock = None
+        self.connect_lock = None
+        self.reconnects = 0
+
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+
+    async def ensure_connected(self):
+        """
+        The function `ensure_connected` (re)connects to the gateway if there is no connection; after a
+        failed attempt next attempts are delayed with exponential backoff.
+        """
+        if self.connect_lock is None:
+            self.connect_lock = asyncio.Lock()
+            self.write_lock = asyncio.Lock()
+            self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        async with self.connect_lock:
+            if self.connected:
+                return
+            if monotonic() < self.retry_at:
+                raise ConnectionError(f'no connection to {self.host}:{self.port}, reconnecting in {self.retry_at - monotonic():.1f} s')
+            try:
+                self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+                sock = self.writer.get_extra_info('socket')
+                if sock is not None:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) # detect dead gateway while idle
+                self.reader_task = asyncio.get_running_loop().create_task(self.read_responses())
+                self.cur_backoff = self.backoff
+                self.reconnects += 1
+            except (OSError, asyncio.TimeoutError) as err:
+                self.retry_at = monotonic() + self.cur_backoff
+                self.cur_backoff = min(self.cur_backoff * 2, self.max_backoff)
+                raise ConnectionError(f'could not connect to {self.host}:{self.port}: {err!r}')
+
+
+    async def close(self, reason:Exception | None = None):
+        """
+        The function `close` closes the connection and fails all pending requests.
+        """
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = None
+        if self.reader_task is not None and self.reader_task is not asyncio.current_task():
+            self.reader_task.cancel()
+        self.reader_task = None
+        while self.pending:
+            _, _, future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(reason or ConnectionError('connection closed'))
+
+
+    async def read_responses(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(2)
+                unit, func_code = header[0], header[1]
+                if func_code & 0x80: # exception response: code + crc
+                    body = await self.reader.readexactly(3)
+                elif func_code in (3, 4): # byte count + data + crc
+                    byte_count = await self.reader.readexactly(1)
+                    body = byte_count + await self.reader.readexactly(byte_count[0] + 2)
+                elif func_code in (6, 16): # address + value/count + crc
+                    body = await self.reader.readexactly(6)
+                else:
+                    raise ValueError(f'unsupported function code {func_code}')
+                frame = header + body
+                if crc16_modbus(frame[:-2]) != struct.unpack('<H', frame[-2:])[0]:
+                    raise ValueError(f'CRC error in frame {frame.hex()}')
+                if not self.pending:
+                    raise ValueError(f'unexpected frame {frame.hex()}')
+                req_unit, req_func_code, future = self.pending.popleft()
+                if unit != req_unit or (func_code & 0x7F) != req_func_code:
+                    raise ValueError(f'response for unit {unit} fc {func_code} does not match request for unit {req_unit} fc {req_func_code}')
+                if not future.done():
+                    future.set_result(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err: # stream is broken or out of sync
+            await self.close(ConnectionError(f'connection to {self.host}:{self.port} reset: {err!r}'))
+
+
+    async def execute(self, unit:int, pdu:bytes):
+        """
+        The function `execute` sends a request and waits for its response.
+
+        :param unit: The `unit` parameter is the modbus id of the device
+        :param pdu: The `pdu` parameter is the request (function code + data)
+        :return: the response frame (bytes).
+        """
+        await self.ensure_connected()
+        async with self.in_flight:
+            future = asyncio.get_running_loop().create_future()
+            frame = bytes([unit]) + pdu
+            async with self.write_lock:
+                if not self.connected:
+                    raise ConnectionError(f'connection to {self.host}:{self.port} lost')
+                self.pending.append((unit, pdu[0], future))
+                self.writer.write(frame + struct.pack('<H', crc16_modbus(frame)))
+                await self.writer.drain()
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                # a late answer would be matched to the next request, resync by reconnecting
+                await self.close(TimeoutError(f'no answer from unit {unit}'))
+                raise TimeoutError(f'no answer from unit {unit} in {self.timeout} s')
+
+
+    async def read_holding_registers(self, address:int, count:int, unit:int):
+        response = await self.execute(unit, struct.pack('>BHH', 3, address, count))
+        if response[1] & 0x80:
+            raise ValueError(f'unit {unit} returned modbus exception code {response[2]}')
+        return list(struct.unpack(f'>{response[2] // 2}H', response[3:-2]))
+
+
+class AsyncModbusRtuOverTcpComInterface(BaseInterface): # PKT8, asyncio engine
+
+    read_codec = ModbusRtuOverTcpComInterface.read_codec
+
+    def __init__(self, core_path, output_dict, err_queue:Queue, modbus_con_info:dict, read_devices_config:dict,
+                 read_period = .5, name: str | None = None, metrics_dict = None, calibrations = None) -> None:
+        try:
+            super().__init__(output_dict, err_queue, read_period, name, daemon = None, metrics_dict=metrics_dict)
+            self.read_dev_conf = read_devices_config
+            self.con_info = modbus_con_info
+            self.data_converter = RefrigDataConverter(core_path, calibrations)
+            self.read_batch = self.data_converter.compile_batch(self.read_dev_conf) # a whole scan is converted at once
+            self.read_codecs = {dev_name:codec_from_config(dev_conf, self.read_codec) for dev_name, dev_conf in self.read_dev_conf.items()}
+            for dev_conf in self.read_dev_conf.values():
+                self.poll_scheduler.add_poll_class(self.get_poll_period(dev_conf))
+            self.timeout = float(modbus_con_info.get('timeout', 1))
+            self.num_connections = int(modbus_con_info.get('num_connections', 1))
+            self.max_in_flight = int(modbus_con_info.get('max_in_flight', 1))
+            self.clients = []
+        except Exception as err:
+            raise type(err)(f'{self.name} AsyncModbusRtuOverTcpComInterface init: {err}')
+
+
+    def connect_iface(self):
+        """
+        The function checks that the gateway is reachable; connections are made (and restored) by the
+        interface process itself.
+        """
+        try:
+            ip = self.con_info['ip']
+            port = int(self.con_info['port'])
+            with socket.create_connection((ip, port), timeout=self.timeout * 3):
+                pass
+        except Exception as err:
+            raise type(err)(f'{self.name} connect_modbus: Could not connect to {self.con_info.get("ip")}:{self.con_info.get("port")}: {err}')
+
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+
+    async def run_async(self):
+        self.clients = [AsyncRtuOverTcpClient(self.con_info['ip'], int(self.con_info['port']), timeout=self.timeout,
+                                              max_in_flight=self.max_in_flight) for _ in range(self.num_connections)]
+        while True:
+            try:
+                await asyncio.sleep(self.poll_scheduler.time_to_next())
+                self.process_commands(0) # no controllable devices: commands are rejected as by the sync engine
+                await self.read_devices(self.poll_scheduler.pop_due())
+            except Exception as err:
+                self.process_error(type(err)(f'{self.name} {err}'), 0)
+
+
+    def get_client(self, unit:int):
+        return self.clients[unit % len(self.clients)] # every unit always uses the same connection
+
+
+    async def read_device(self, dev_name:str, dev_conf:dict):
+        if dev_conf['num_registers'] <= 0:
+            raise ValueError(f'Invalid register config for {dev_name}')
+        start = perf_counter()
+        try:
+            registers = await self.get_client(dev_conf['modbus_id']).read_holding_registers(dev_conf['start_register'],
+                                                                                           dev_conf['num_registers'], unit=dev_conf['modbus_id'])
+        except Exception as err:
+            self.bus_metrics.record(perf_counter() - start, dev_conf['modbus_id'], [dev_name],
+                                    'error' if isinstance(err, ValueError) else 'timeout')
+            raise
+        self.bus_metrics.record(perf_counter() - start, dev_conf['modbus_id'], [dev_name])
+        if len(registers)<2:
+            raise ValueError(f'incorrect data: {registers} for device {dev_name}')
+        return self.read_codecs[dev_name].decode(registers[:2])[0] # raw value
+
+
+    async def read_devices(self, poll_periods:list | None = None):
+        """
+        The function `read_devices` reads all due devices concurrently (concurrency is limited by number
+        of connections and requests in flight per connection) and stores the values in a dictionary.
+        """
+        try:
+            scan_start = perf_counter()
+            dev_names = [dev_name for dev_name, dev_conf in self.read_dev_conf.items()
+                         if poll_periods is None or self.get_poll_period(dev_conf) in poll_periods]
+            results = await asyncio.gather(*[self.read_device(dev_name, self.read_dev_conf[dev_name]) for dev_name in dev_names],
+                                           return_exceptions=True)
+            dev_values = {}
+            raw_values = {}
+            errors = set() # same errors (e.g. lost connection) are reported once per cycle
+            for dev_name, result in zip(dev_names, results):
+                dev_values.update({dev_name:None})
+                if isinstance(result, Exception):
+                    errors.add(f'{result.__class__.__name__}: {result}' if isinstance(result, (ConnectionError, TimeoutError))
+                               else f'{dev_name}: {result}')
+                    continue
+                raw_values[dev_name] = result
+            for dev_name, out_val in self.read_batch.convert_dict(raw_values).items(): # human-readable output
+                if isinstance(out_val, Exception):
+                    errors.add(f'{dev_name}: {out_val}')
+                    continue
+                dev_values[dev_name] = out_val
+            qualities = {dev_name:self.get_value_quality(self.read_dev_conf[dev_name], value) for dev_name, value in dev_values.items()}
+            for dev_name in self.read_batch.check_ranges(raw_values): # e.g. resistance outside of the calibrated range
+                if dev_values[dev_name] is not None:
+                    qualities[dev_name] = 'out_of_range'
+            self.publish_values(dev_values, qualities)
+            self.bus_metrics.record_scan(perf_counter() - scan_start, min(poll_periods) if poll_periods else None)
+            for err in errors:
+                self.process_error(f'read_devices: {err}')
+            self.publish_metrics({'connections':[{'connected':client.connected, 'reconnects':client.reconnects} for client in self.clients]})
+        except Exception as err:
+            raise type(err)(f'read_devices: {err}')
@@ -2,16 +2,16 @@ from collections.abc import Callable, Iterable, Mapping
 from threading import Thread
 from typing import Any
 from time import sleep
-from copy import deepcopy
 
 class refrigAutoControls(Thread):
-    def __init__(self, values_dict, error_queue, cmd_func, update_period = .5, name: str | None = None) -> None:
+    def __init__(self, values_dict, error_queue, cmd_func, update_period = .5, name: str | None = None, value_events = None) -> None:
         try:
             super().__init__(name=name, daemon=True)
             self.values_dict = values_dict
             self.err_queue = error_queue
             self.send_command = cmd_func
-            self.update_period = update_period
+            self.update_period = update_period # max time between updates if there are no value changes
+            self.value_events = value_events # change events subscription (optional, update_period timer otherwise)
         except Exception as err:
             raise type(err)(f'refrigAutoControls init: {err}')
 
@@ -19,8 +19,11 @@ class refrigAutoControls(Thread):
     def run(self):
         try:
             while True:
-                sleep(self.update_period)
-                cur_values = deepcopy(self.values_dict) # get a local copy of shared values dict to avoid blocking
+                if self.value_events is None:
+                    sleep(self.update_period)
+                else:
+                    self.value_events.get(timeout=self.update_period) # wakes up as soon as some value changes
+                cur_values = self.values_dict.snapshot() # get a local copy of shared values to avoid blocking
         except Exception as err:
             self.err_queue.put(f'refrigAutoControls: {err}')
 
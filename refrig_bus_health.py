@@ -0,0 +1,102 @@
+# bus health tracking:
+# a circuit breaker per bus unit stops polling of dead units and retries them with exponential backoff
+from time import monotonic
+
+
+class CircuitBreaker():
+
+    states = ('closed', 'open', 'half_open') # closed - unit is polled normally, open - unit is skipped, half_open - retry attempt
+
+    def __init__(self, max_failures:int = 3, backoff:float = 1, max_backoff:float = 60) -> None:
+        if max_failures < 1:
+            raise ValueError(f'CircuitBreaker: max_failures should be >= 1, got {max_failures}')
+        self.max_failures = max_failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = 'closed'
+        self.failures = 0 # consecutive failures
+        self.trips = 0 # number of times breaker was opened
+        self.cur_backoff = backoff
+        self.retry_at = 0
+
+
+    def allow(self, now:float | None = None):
+        """
+        The function `allow` checks if the unit should be polled now; an open breaker goes to half-open
+        state (one retry attempt) when its backoff time has passed.
+
+        :param now: The `now` parameter is the current monotonic time, taken from clock if not specified
+        :return: True if the unit should be polled.
+        """
+        if self.state != 'open':
+            return True
+        if now is None:
+            now = monotonic()
+        if now < self.retry_at:
+            return False
+        self.state = 'half_open'
+        return True
+
+
+    def record_success(self):
+        """
+        The function `record_success` closes the breaker after a successful transaction.
+        :return: True if the unit has recovered (breaker was not closed).
+        """
+        recovered = self.state != 'closed'
+        self.state = 'closed'
+        self.failures = 0
+        self.cur_backoff = self.backoff
+        return recovered
+
+
+    def record_failure(self, now:float | None = None):
+        """
+        The function `record_failure` counts a failed transaction and opens the breaker after
+        `max_failures` consecutive failures; every failed retry doubles the backoff time.
+
+        :param now: The `now` parameter is the current monotonic time, taken from clock if not specified
+        :return: True if the breaker has just been opened (closed -> open).
+        """
+        if now is None:
+            now = monotonic()
+        self.failures += 1
+        match self.state:
+            case 'half_open': # retry failed
+                self.cur_backoff = min(self.cur_backoff * 2, self.max_backoff)
+                self.state = 'open'
+                self.retry_at = now + self.cur_backoff
+                return False
+            case 'closed' if self.failures >= self.max_failures:
+                self.state = 'open'
+                self.trips += 1
+                self.retry_at = now + self.cur_backoff
+                return True
+        return False
+
+
+    def get_metrics(self, now:float | None = None):
+        if now is None:
+            now = monotonic()
+        return {'state':self.state, 'failures':self.failures, 'trips':self.trips,
+                'retry_in':round(max(0, self.retry_at - now), 3) if self.state == 'open' else 0}
+
+
+class BusHealthMonitor():
+    def __init__(self, max_failures:int = 3, backoff:float = 1, max_backoff:float = 60) -> None:
+        self.max_failures = max_failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breakers = {} # unit: CircuitBreaker
+
+
+    def get_breaker(self, unit):
+        breaker = self.breakers.get(unit, None)
+        if breaker is None:
+            breaker = self.breakers[unit] = CircuitBreaker(self.max_failures, self.backoff, self.max_backoff)
+        return breaker
+
+
+    def get_metrics(self):
+        now = monotonic()
+        return {unit:breaker.get_metrics(now) for unit, breaker in self.breakers.items()}
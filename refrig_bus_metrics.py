@@ -0,0 +1,118 @@
+# bus transaction timing:
+# fixed log-spaced histograms (no samples stored) per interface, per unit and per device
+from bisect import bisect_left
+from math import ceil
+
+
+class LatencyHistogram():
+
+    bucket_bounds = [1e-4 * 1.25 ** i for i in range(52)] # upper bounds of buckets: 100 us ... ~11 s
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(self.bucket_bounds) + 1) # last bucket - overflow
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+    def add(self, value:float):
+        self.counts[bisect_left(self.bucket_bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+
+    def percentile(self, percent:float):
+        """
+        The function `percentile` returns the upper bound of the bucket containing the percentile (an
+        estimate within bucket resolution of 25%, never above the max value).
+
+        :param percent: The `percent` parameter is the percentile in range (0, 100]
+        :return: the percentile value in seconds (0 if histogram is empty).
+        """
+        if self.count == 0:
+            return 0
+        target = ceil(percent / 100 * self.count)
+        cumulative = 0
+        for idx, cur_count in enumerate(self.counts):
+            cumulative += cur_count
+            if cumulative >= target:
+                if idx < len(self.bucket_bounds):
+                    return min(self.bucket_bounds[idx], self.max)
+                break
+        return self.max
+
+
+class TransactionStats():
+    def __init__(self) -> None:
+        self.histogram = LatencyHistogram()
+        self.timeouts = 0
+        self.errors = 0
+        self.retries = 0
+
+
+    def add(self, duration:float, result:str = 'ok', retry:bool = False):
+        self.histogram.add(duration)
+        if result == 'timeout':
+            self.timeouts += 1
+        elif result == 'error':
+            self.errors += 1
+        if retry:
+            self.retries += 1
+
+
+    def get_metrics(self):
+        hist = self.histogram
+        return {'count':hist.count, 'mean_ms':round(hist.total / hist.count * 1000, 3) if hist.count else 0,
+                'p50_ms':round(hist.percentile(50) * 1000, 3), 'p95_ms':round(hist.percentile(95) * 1000, 3),
+                'p99_ms':round(hist.percentile(99) * 1000, 3), 'max_ms':round(hist.max * 1000, 3),
+                'timeouts':self.timeouts, 'errors':self.errors, 'retries':self.retries}
+
+
+class BusMetrics():
+    def __init__(self) -> None:
+        self.all_stats = TransactionStats()
+        self.unit_stats = {} # unit: TransactionStats
+        self.device_stats = {} # dev_name: TransactionStats
+        self.scan_stats = TransactionStats()
+        self.scan_overruns = 0
+
+
+    def record(self, duration:float, unit = None, dev_names = (), result:str = 'ok', retry:bool = False):
+        """
+        The function `record` adds a bus transaction to interface, unit and device statistics.
+
+        :param duration: The `duration` parameter is the transaction time in seconds
+        :param unit: The `unit` parameter is the bus address of the device (None if not applicable)
+        :param dev_names: The `dev_names` parameter is a list of devices served by the transaction
+        :param result: The `result` parameter is the transaction result: 'ok', 'timeout' or 'error'
+        :param retry: The `retry` parameter tells if the transaction was a retry
+        """
+        self.all_stats.add(duration, result, retry)
+        if unit is not None:
+            stats = self.unit_stats.get(unit, None)
+            if stats is None:
+                stats = self.unit_stats[unit] = TransactionStats()
+            stats.add(duration, result, retry)
+        for dev_name in dev_names:
+            stats = self.device_stats.get(dev_name, None)
+            if stats is None:
+                stats = self.device_stats[dev_name] = TransactionStats()
+            stats.add(duration, result, retry)
+
+
+    def record_scan(self, duration:float, period:float | None = None):
+        # a scan is overrun when it takes longer than its poll period
+        self.scan_stats.add(duration)
+        if period is not None and duration > period:
+            self.scan_overruns += 1
+
+
+    def get_metrics(self):
+        scans = self.scan_stats.get_metrics()
+        scans.update({'overruns':self.scan_overruns})
+        return {'transactions':self.all_stats.get_metrics(),
+                'units':{unit:stats.get_metrics() for unit, stats in self.unit_stats.items()},
+                'devices':{dev_name:stats.get_metrics() for dev_name, stats in self.device_stats.items()},
+                'scans':scans}
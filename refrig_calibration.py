@@ -0,0 +1,163 @@
+# registry of thermometer calibrations, loaded once by the core and handed to all interfaces (read-only):
+# polynomial coefficients (data/silicon_thermometry/*.txt) and calibrated resistance ranges (measured points of
+# data/raw/*.TAB) are compiled to a binary cache (data/calibrations.npz) keyed by hashes of the source files,
+# warm starts read the cache instead of parsing the text files;
+# every calibration has an id (hash of its source files), ids of active calibrations are logged with the history
+import hashlib
+import re
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+
+
+cache_version = 1
+num_coefs = 7 # T = K1 + K2 * (1000/R) + ... + K7 * (1000/R)**6
+tab_number = re.compile(r'№\s*(\d+)') # data/raw/Тermometr № N (D-4-N).TAB - measurements of thermometer TN
+
+
+class Calibration(NamedTuple):
+    name: str
+    coefs: tuple # polynomial coefficients in 1000/R, lowest power first
+    r_range: tuple | None # calibrated range (min R, max R), None if there are no measurements
+    calibration_id: str
+
+
+class CalibrationRegistry():
+    '''
+    immutable set of calibrations (numpy arrays are read-only, the registry is cheap to pickle for interface processes)
+    '''
+
+    def __init__(self, names:list, coefs, r_ranges, ids:list, source_key:str = '') -> None:
+        self.names = tuple(names)
+        self.coefs = np.array(coefs, dtype=np.float64).reshape(len(self.names), num_coefs)
+        self.r_ranges = np.array(r_ranges, dtype=np.float64).reshape(len(self.names), 2) # NaN - no measurements
+        self.ids = tuple(ids)
+        self.source_key = source_key
+        self.coefs.flags.writeable = False
+        self.r_ranges.flags.writeable = False
+        self.indexes = {name:idx for idx, name in enumerate(self.names)}
+
+
+    def __setstate__(self, state): # arrays stay read-only in interface processes
+        self.__dict__.update(state)
+        self.coefs.flags.writeable = False
+        self.r_ranges.flags.writeable = False
+
+
+    def __contains__(self, name:str):
+        return name in self.indexes
+
+
+    def get(self, name:str):
+        """
+        The function `get` returns a calibration by its name.
+
+        :return: a `Calibration` or None if there is no such calibration.
+        """
+        idx = self.indexes.get(name, None)
+        if idx is None:
+            return None
+        r_range = None if np.isnan(self.r_ranges[idx]).any() else tuple(self.r_ranges[idx].tolist())
+        return Calibration(name, tuple(self.coefs[idx].tolist()), r_range, self.ids[idx])
+
+
+    def save(self, cache_path:Path):
+        # written to a temporary file first and renamed, so a cache is always complete
+        tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+        with open(tmp_path, 'wb') as cache_file:
+            np.savez(cache_file, version=cache_version, source_key=self.source_key, names=np.array(self.names, dtype=str),
+                     coefs=self.coefs, r_ranges=self.r_ranges, ids=np.array(self.ids, dtype=str))
+        tmp_path.replace(cache_path)
+
+
+    @classmethod
+    def load(cls, cache_path:Path):
+        with np.load(cache_path, allow_pickle=False) as cache:
+            if int(cache['version']) != cache_version:
+                raise ValueError(f'calibration cache version {int(cache["version"])}, expected {cache_version}')
+            return cls(cache['names'].tolist(), cache['coefs'], cache['r_ranges'], cache['ids'].tolist(), str(cache['source_key']))
+
+
+def read_coefs_file(file_path:Path):
+    # sensor name (first line) and coefficients (K1 = ... lines) of a data/silicon_thermometry file
+    lines = file_path.read_text().splitlines()
+    coefs = [float(cur_line.split('=')[-1]) for cur_line in lines[1:] if cur_line.strip()]
+    if len(coefs) != num_coefs:
+        raise ValueError(f'{file_path.name}: {len(coefs)} coefficients, expected {num_coefs}')
+    return lines[0].split()[0], coefs
+
+
+def read_tab(tab_path:Path):
+    """
+    The function `read_tab` parses a data/raw .TAB file (measurements and vendor fit of one thermometer),
+    lines are read as a stream.
+
+    :return: a dictionary with lists: `R` (measured resistances, Ohm), `T` (measured temperatures, K),
+    `calculated` (T of the vendor fit, K), `error` (vendor fit residuals, mK), `coefs` (vendor coefficients).
+    """
+    tab_data = {'R':[], 'T':[], 'calculated':[], 'error':[], 'coefs':[]}
+    row_keys = (('Measured', 'R,Ohm', 'R'), ('Measured', 'T,K', 'T'), ('Calculated', 'T,K', 'calculated'), ('Error', 'DT,mK', 'error'))
+    with open(tab_path, 'r', errors='replace') as tab_file:
+        for cur_line in tab_file:
+            if cur_line.startswith('K') and '=' in cur_line:
+                tab_data['coefs'].append(float(cur_line.split('=')[-1]))
+                continue
+            for head, unit, key in row_keys:
+                if cur_line.startswith(head) and unit in cur_line:
+                    tab_data[key] += [float(item) for item in cur_line.split(unit, 1)[-1].split()]
+                    break
+    return tab_data
+
+
+def get_sources(core_path:Path):
+    # coefficient files and measurement files {calibration name: path}
+    coefs_dir, raw_dir = core_path.joinpath('data', 'silicon_thermometry'), core_path.joinpath('data', 'raw')
+    coefs_files = sorted(coefs_dir.glob('*.txt')) if coefs_dir.is_dir() else []
+    tab_files = {}
+    for tab_path in sorted(raw_dir.glob('*.TAB')) if raw_dir.is_dir() else []:
+        number = tab_number.search(tab_path.name)
+        if number is not None:
+            tab_files[f'T{number.group(1)}'] = tab_path
+    return coefs_files, tab_files
+
+
+def load_calibrations(core_path, cache_path=None):
+    """
+    The function `load_calibrations` returns the calibration registry, from the cache if hashes of the
+    source files match it, otherwise the source files are parsed and the cache is rewritten.
+
+    :param core_path: The `core_path` parameter is the core directory (with data/silicon_thermometry and data/raw)
+    :param cache_path: The `cache_path` parameter is the cache file, defaults to data/calibrations.npz
+    :return: a `CalibrationRegistry` object.
+    """
+    try:
+        core_path = Path(core_path)
+        cache_path = Path(cache_path) if cache_path is not None else core_path.joinpath('data', 'calibrations.npz')
+        coefs_files, tab_files = get_sources(core_path)
+        file_hashes = {file_path:hashlib.sha1(file_path.read_bytes()).hexdigest() for file_path in coefs_files + list(tab_files.values())}
+        source_key = hashlib.sha1(';'.join(f'{file_path.name}:{file_hash}' for file_path, file_hash in file_hashes.items()).encode()).hexdigest()
+        if cache_path.exists():
+            try:
+                registry = CalibrationRegistry.load(cache_path)
+                if registry.source_key == source_key:
+                    return registry
+            except Exception: # broken or old cache, rebuilt
+                pass
+        names, coefs, r_ranges, ids = [], [], [], []
+        for file_path in coefs_files:
+            name, sensor_coefs = read_coefs_file(file_path)
+            tab_path = tab_files.get(name, None)
+            resistances = read_tab(tab_path)['R'] if tab_path is not None else []
+            names.append(name)
+            coefs.append(sensor_coefs)
+            r_ranges.append((min(resistances), max(resistances)) if resistances else (np.nan, np.nan))
+            ids.append(hashlib.sha1((file_hashes[file_path] + (file_hashes[tab_path] if tab_path is not None else '')).encode()).hexdigest()[:12])
+        registry = CalibrationRegistry(names, coefs, r_ranges, ids, source_key)
+        try:
+            registry.save(cache_path)
+        except OSError: # read-only installation, works without cache
+            pass
+        return registry
+    except Exception as err:
+        raise type(err)(f'load_calibrations: {err}')
@@ -0,0 +1,130 @@
+# fitting of thermometer calibrations from raw measurements (data/raw/*.TAB):
+# python refrig_calibration_fit.py [raw directory] [--order 6] [--write [coefficients directory]]
+# T is fitted by least squares as a polynomial in x = 1000/R, thermometers with the same number of measured points
+# are fitted together (stacked Vandermonde matrices, one batched QR); the fit is made in the Chebyshev basis on the
+# measured interval of x (well conditioned) and converted to the power basis of the coefficient files.
+# Residuals at the measured points are reported for the new fit, the vendor fit and the current coefficient file,
+# coefficient files are written only with --write (the compiled calibration cache is rebuilt after that).
+import argparse
+import sys
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+from refrig_calibration import load_calibrations, num_coefs, read_coefs_file, read_tab, tab_number
+
+
+def read_measurements(raw_path:Path):
+    """
+    The function `read_measurements` reads measured points of all thermometers of a directory.
+
+    :return: a dictionary {calibration name: `read_tab` dictionary}.
+    """
+    measurements = {}
+    for tab_path in sorted(Path(raw_path).glob('*.TAB')):
+        number = tab_number.search(tab_path.name)
+        if number is None:
+            continue
+        tab_data = read_tab(tab_path)
+        if len(tab_data['R']) != len(tab_data['T']):
+            raise ValueError(f'{tab_path.name}: {len(tab_data["R"])} resistances, {len(tab_data["T"])} temperatures')
+        measurements[f'T{number.group(1)}'] = tab_data
+    return measurements
+
+
+def eval_poly(coefs, x):
+    # T in the power basis by Horner's rule (as the converters evaluate it), coefs - lowest power first
+    T = np.full(np.shape(x), coefs[-1], dtype=np.float64)
+    for coef in coefs[-2::-1]:
+        T = T * x + coef
+    return T
+
+
+def fit_calibrations(measurements:dict, order:int = num_coefs - 1):
+    """
+    The function `fit_calibrations` fits polynomials in 1000/R to measured points, thermometers with the same
+    number of points are fitted in one batch.
+
+    :param measurements: The `measurements` parameter is a dictionary {name: `read_tab` dictionary}
+    :param order: The `order` parameter is the order of the polynomials
+    :return: a dictionary {name: coefficients in the power basis of 1000/R (lowest power first)}.
+    """
+    try:
+        groups = {}
+        for name, tab_data in measurements.items():
+            if len(tab_data['R']) <= order:
+                raise ValueError(f'{name}: {len(tab_data["R"])} points are not enough for order {order}')
+            groups.setdefault(len(tab_data['R']), []).append(name)
+        fits = {}
+        for names in groups.values():
+            x = 1000.0 / np.array([measurements[name]['R'] for name in names], dtype=np.float64) # (thermometers, points)
+            T = np.array([measurements[name]['T'] for name in names], dtype=np.float64)
+            x_lo, x_hi = x.min(axis=1), x.max(axis=1)
+            u = (2 * x - (x_lo + x_hi)[:, None]) / (x_hi - x_lo)[:, None] # measured interval to [-1, 1]
+            vander = np.polynomial.chebyshev.chebvander(u, order)
+            q, r = np.linalg.qr(vander)
+            cheb_coefs = np.linalg.solve(r, np.einsum('npk,np->nk', q, T)[..., None])[..., 0]
+            for name, coefs, lo, hi in zip(names, cheb_coefs, x_lo, x_hi):
+                fits[name] = np.polynomial.Chebyshev(coefs, domain=[lo, hi]).convert(kind=np.polynomial.Polynomial).coef
+        return fits
+    except Exception as err:
+        raise type(err)(f'fit_calibrations: {err}')
+
+
+def write_coefs_file(coefs_path:Path, name:str, coefs):
+    # coefficient file of data/silicon_thermometry (higher powers are 0 if the order is lower)
+    if len(coefs) > num_coefs:
+        raise ValueError(f'{name}: coefficient files have {num_coefs} coefficients, fit has {len(coefs)}')
+    coefs = list(coefs) + [0.0] * (num_coefs - len(coefs))
+    tmp_path = coefs_path.with_name(coefs_path.name + '.tmp')
+    tmp_path.write_text('\n'.join([name] + [f'K{idx + 1} = {coef:.18f}' for idx, coef in enumerate(coefs)]))
+    tmp_path.replace(coefs_path)
+
+
+def report(measurements:dict, fits:dict, coefs_dir:Path):
+    # max and RMS residuals (mK) at the measured points: new fit, vendor fit, current coefficient file
+    print(f'{"thermometer":<12}{"points":>7}{"fit max":>10}{"fit rms":>10}{"vendor max":>12}{"file max":>10}   (mK)')
+    for name, coefs in sorted(fits.items(), key=lambda item: int(item[0][1:])):
+        tab_data = measurements[name]
+        x, T = 1000.0 / np.array(tab_data['R']), np.array(tab_data['T'])
+        residuals = (eval_poly(coefs, x) - T) * 1000
+        vendor = np.abs(tab_data['error']).max() if tab_data['error'] else np.nan
+        file_max = np.nan
+        if coefs_dir.joinpath(f'{name}.txt').exists():
+            file_max = np.abs(eval_poly(read_coefs_file(coefs_dir.joinpath(f'{name}.txt'))[1], x) - T).max() * 1000
+        print(f'{name:<12}{len(T):>7}{np.abs(residuals).max():>10.3f}{np.sqrt(np.mean(residuals**2)):>10.3f}'
+              f'{vendor:>12.3f}{file_max:>10.3f}')
+
+
+if __name__ == '__main__':
+    core_path = Path(__file__).parent
+    parser = argparse.ArgumentParser(description='Fit thermometer calibrations to raw measurements (.TAB files).')
+    parser.add_argument('raw', nargs='?', type=Path, default=core_path.joinpath('data', 'raw'), help='directory of .TAB files')
+    parser.add_argument('--order', type=int, default=num_coefs - 1, help=f'polynomial order (max {num_coefs - 1} for coefficient files)')
+    parser.add_argument('--write', nargs='?', type=Path, const=core_path.joinpath('data', 'silicon_thermometry'),
+                        help='write coefficient files to this directory (default: data/silicon_thermometry)')
+    parser.add_argument('--quiet', action='store_true', help="don't print residuals")
+    args = parser.parse_args()
+
+    try:
+        start = perf_counter()
+        measurements = read_measurements(args.raw)
+        if not measurements:
+            sys.exit(f'no .TAB files in {args.raw}')
+        fits = fit_calibrations(measurements, args.order)
+        fit_time = perf_counter() - start
+        if not args.quiet:
+            report(measurements, fits, args.write or core_path.joinpath('data', 'silicon_thermometry'))
+        print(f'{len(fits)} thermometers fitted in {fit_time:.3f} s', file=sys.stderr)
+        if args.write is not None:
+            if args.order >= num_coefs:
+                sys.exit(f'coefficient files have {num_coefs} coefficients, order {args.order} can only be reported')
+            args.write.mkdir(parents=True, exist_ok=True)
+            for name, coefs in fits.items():
+                write_coefs_file(args.write.joinpath(f'{name}.txt'), name, coefs)
+            if args.write.resolve() == core_path.joinpath('data', 'silicon_thermometry').resolve():
+                load_calibrations(core_path) # compiled cache of the new coefficients
+            print(f'{len(fits)} coefficient files written to {args.write}', file=sys.stderr)
+    except Exception as err:
+        sys.exit(f'{err.__class__.__name__}: {err}')
@@ -1,30 +1,189 @@
 from collections.abc import Callable, Iterable, Mapping
-from copy import deepcopy
 from typing import Any
 
 from pymodbus.client.sync import ModbusSerialClient
 from pymodbus.client.sync import ModbusTcpClient
 from pymodbus.transaction import ModbusRtuFramer
 from pymodbus import register_read_message
+from pymodbus.pdu import ExceptionResponse
 import paho.mqtt.client as mqtt
 
 from multiprocessing import Process, Queue
 from threading import Thread
 from queue import Empty, Full
-from time import sleep
-import struct
+from time import sleep, monotonic, perf_counter, time
 
-from refrig_data_converters import RefrigDataConverter
+from refrig_data_converters import RefrigDataConverter, pass_value
+from refrig_scan_planner import ModbusScanPlanner, PollScheduler
+from refrig_modbus_codec import get_codec, codec_from_config
+from refrig_bus_health import BusHealthMonitor
+from refrig_bus_metrics import BusMetrics
 from refrig_turbine_iface import TurbineControl
 
 
 class BaseInterface(Process):
-    def __init__(self, output_dict, err_queue:Queue, read_period:float = .5, name: str | None = None, daemon: bool | None = None) -> None:
+
+    coalesce_commands = False # keep only the latest queued command per device (for setpoint-like commands)
+
+    def __init__(self, output_dict, err_queue:Queue, read_period:float = .5, name: str | None = None, daemon: bool | None = None, 
+                 metrics_dict = None) -> None:
         super().__init__(name=name, daemon=None)
         self.err_queue = err_queue
         self.output_dict = output_dict
+        self.metrics_dict = metrics_dict # process shared dict for interface metrics (optional)
         self.read_period = read_period
-        self.cmd_queue = Queue(maxsize=10)
+        self.cmd_queue = Queue(maxsize=100)
+        self.poll_scheduler = PollScheduler()
+        self.bus_metrics = BusMetrics() # transaction and scan timing
+        self.metrics_period = 1 # metrics are put to the shared dict not more often than this (seconds)
+        self.metrics_published = None
+
+
+    def get_poll_period(self, dev_conf):
+        """
+        The function `get_poll_period` returns the poll period of a device (`poll_period` from its config
+        or interface's `read_period` by default).
+
+        :param dev_conf: The `dev_conf` parameter is the device config (dict or None)
+        :return: the poll period in seconds.
+        """
+        if not isinstance(dev_conf, dict):
+            return self.read_period
+        return float(dev_conf.get('poll_period', self.read_period))
+
+
+    def get_value_quality(self, dev_conf, value):
+        """
+        The function `get_value_quality` returns the quality of a just read value: comm_error if there
+        is no value, out_of_range if it is outside of `valid_range` of the device config, good otherwise.
+        """
+        if value is None:
+            return 'comm_error'
+        valid_range = dev_conf.get('valid_range', None) if isinstance(dev_conf, dict) else None
+        if valid_range is not None and not valid_range[0] <= value <= valid_range[1]:
+            return 'out_of_range'
+        return 'good'
+
+
+    def publish_values(self, dev_values:dict, quality:str | dict | None = None, timestamp:float | None = None):
+        """
+        The function `publish_values` puts read values with their quality, acquisition time and source
+        interface to the shared values table.
+
+        :param dev_values: The `dev_values` parameter is a dictionary {dev_name: value}
+        :param quality: The `quality` parameter is a quality of all values or a dictionary {dev_name: quality}
+        :param timestamp: The `timestamp` parameter is the acquisition time (unix time), current time by default
+        """
+        self.output_dict.update(dev_values, timestamp=timestamp, quality=quality, source=self.name)
+
+
+    def wait_next_poll(self):
+        """
+        The function `wait_next_poll` waits until the next poll class is due and returns due poll periods.
+        Commands arriving while waiting are executed immediately.
+        """
+        while True:
+            self.read_priority_devices()
+            timeout = self.poll_scheduler.time_to_next()
+            if timeout <= 0:
+                return self.poll_scheduler.pop_due()
+            priority_timeout = self.time_to_priority_read()
+            if priority_timeout is not None:
+                timeout = min(timeout, priority_timeout)
+            self.process_commands(timeout) # returns after timeout or as soon as arrived commands are sent
+
+
+    def read_priority_devices(self):
+        # reads which should not wait for the poll scheduler (e.g. feedback after a command), none by default
+        return
+
+
+    def time_to_priority_read(self):
+        # time in seconds to the next priority read, None if there is nothing to read
+        return None
+
+
+    def process_commands(self, timeout:float = 0):
+        """
+        The function `process_commands` drains the command queue and sends the commands to devices.
+        It is also called between bus transactions, so commands don't wait for the whole scan.
+        With `coalesce_commands` only the latest command per device is sent.
+
+        :param timeout: The `timeout` parameter is the time in seconds to wait for the first command,
+        defaults to 0 (don't wait)
+        :type timeout: float
+        :return: when the command queue is empty.
+        """
+        commands = [] # [(dev_name, command)] in order of arrival
+        while True: # get all commands from queue first
+            try:
+                if timeout > 0:
+                    cfg = self.cmd_queue.get(timeout=timeout) # wakes up as soon as a command is put into queue
+                else:
+                    cfg = self.cmd_queue.get_nowait()
+                timeout = 0
+                dev_name = next(iter(cfg))
+                commands.append((dev_name, cfg[dev_name]))
+            except Empty:
+                break
+            except Exception as err:
+                self.process_error(type(err)(f'{self.name} process_commands: {err}'), 0)
+                continue
+        if len(commands) == 0:
+            return
+        if self.coalesce_commands:
+            latest = {}
+            for dev_name, command in commands:
+                latest.pop(dev_name, None) # keep order of the latest commands
+                latest[dev_name] = command
+            commands = list(latest.items())
+        self.execute_commands(commands)
+
+
+    def execute_commands(self, commands:list):
+        """
+        The function `execute_commands` executes commands one by one, errors are reported per command.
+
+        :param commands: The `commands` parameter is a list of (dev_name, command) tuples
+        :type commands: list
+        """
+        for dev_name, command in commands:
+            try:
+                self.execute_command({dev_name:command})
+            except Exception as err:
+                self.process_error(type(err)(f'{self.name} process_commands: {err}'), 0)
+
+
+    def execute_command(self, cfg:dict):
+        """
+        The function `execute_command` executes a single command from the command queue (interfaces
+        with controllable devices override it).
+
+        :param cfg: The `cfg` parameter is a dictionary {dev_name: command}
+        :type cfg: dict
+        :raises AttributeError: the interface has no controllable devices
+        """
+        for dev_name in cfg:
+            raise AttributeError(f'no config found for device {dev_name}')
+
+
+    def publish_metrics(self, metrics:dict | None = None):
+        """
+        The function `publish_metrics` puts interface metrics together with bus timing statistics to
+        the shared metrics dict (if there is one), not more often than every `metrics_period` seconds.
+
+        :param metrics: The `metrics` parameter is a dictionary of the interface specific metrics
+        :type metrics: dict | None
+        """
+        if self.metrics_dict is None:
+            return
+        now = monotonic()
+        if self.metrics_published is not None and now - self.metrics_published < self.metrics_period:
+            return
+        self.metrics_published = now
+        metrics = dict(metrics or {})
+        metrics.update({'bus':self.bus_metrics.get_metrics(), 'scheduler_overruns':self.poll_scheduler.overruns})
+        self.metrics_dict[self.name] = metrics
 
 
     def process_error(self, err, err_priority=0):
@@ -48,18 +207,45 @@ class BaseInterface(Process):
 
 class ModbusComInterface(BaseInterface): # korobochki
 
+    coalesce_commands = True # valve setpoints, only the latest one matters
+    max_write_registers = 123 # modbus limit for write_registers
     mb_client = None
     read_dev_conf = None
     control_dev_conf = None
+    read_codec = get_codec('float32', word_order='little', byte_order='little') # sensor registers: all 4 bytes reversed
+    write_codec = get_codec('float32', word_order='big', byte_order='little') # control registers: bytes swapped inside registers
 
     def __init__(self, core_path, output_dict, err_queue:Queue, modbus_con_info:dict, read_devices_config:dict, 
-                 control_devices_config: dict, read_period = .5, name: str | None = None, ) -> None:
+                 control_devices_config: dict, read_period = .5, name: str | None = None, metrics_dict = None, calibrations = None) -> None:
         try:
-            super().__init__(output_dict=output_dict, err_queue=err_queue, read_period=read_period, name=name)
+            super().__init__(output_dict=output_dict, err_queue=err_queue, read_period=read_period, name=name, metrics_dict=metrics_dict)
             self.read_dev_conf = read_devices_config
             self.control_dev_conf = control_devices_config
             self.con_info = modbus_con_info
-            self.data_converter = RefrigDataConverter(core_path)
+            self.data_converter = RefrigDataConverter(core_path, calibrations)
+            self.read_converters = self.data_converter.compile_read(self.read_dev_conf)
+            self.write_converters = self.data_converter.compile_write(self.control_dev_conf)
+            self.scan_planner = ModbusScanPlanner(max_gap=int(modbus_con_info.get('scan_max_gap', 4)),
+                                                  max_block_size=int(modbus_con_info.get('scan_max_block_size', 60)))
+            self.scan_blocks = self.scan_planner.plan(self.read_dev_conf, default_period=self.read_period)
+            for block in self.scan_blocks:
+                self.poll_scheduler.add_poll_class(block.poll_period)
+            self.read_codecs = {dev_name:codec_from_config(dev_conf, self.read_codec) for dev_name, dev_conf in self.read_dev_conf.items()}
+            self.write_codecs = {dev_name:codec_from_config(dev_conf, self.write_codec) for dev_name, dev_conf in self.control_dev_conf.items()}
+            self.bus_health = BusHealthMonitor(max_failures=int(modbus_con_info.get('breaker_max_failures', 3)), 
+                                               backoff=float(modbus_con_info.get('breaker_backoff', 1)),
+                                               max_backoff=float(modbus_con_info.get('breaker_max_backoff', 60)))
+            self.dev_quality = {dev_name:'good' for dev_name in self.read_dev_conf}
+            #feedback read after write:
+            self.feedback_samples = int(modbus_con_info.get('feedback_samples', 5))
+            self.feedback_interval = float(modbus_con_info.get('feedback_interval', .2))
+            self.feedback_settle = float(modbus_con_info.get('feedback_settle', .5))
+            self.feedback_rel = {} # control device: its feedback sensor
+            for ctrl_dev_name, ctrl_dev_conf in self.control_dev_conf.items():
+                fb_dev_name = (ctrl_dev_conf or {}).get('feedback', f'{ctrl_dev_name}_fb')
+                if fb_dev_name in self.read_dev_conf:
+                    self.feedback_rel.update({ctrl_dev_name:fb_dev_name})
+            self.feedback_reads = {} # feedback sensor: [samples left, next read time, last value]
         except Exception as err:
             raise type(err)(f'{self.name} ModbusComInterface init: {err}')
 
@@ -85,120 +271,218 @@ class ModbusComInterface(BaseInterface): # korobochki
 
     def run(self):
         """
-        The function runs a continuous loop that sleeps for a specified period, processes commands,
-        reads devices, and handles any exceptions that occur.
+        The function runs a continuous loop that waits for the next due poll class, processes commands,
+        reads devices of due poll classes, and handles any exceptions that occur.
         """
         while True:
             try:
-                sleep(self.read_period)
+                poll_periods = self.wait_next_poll()
                 self.process_commands()
-                self.read_devices()
+                self.read_devices(poll_periods)
             except Exception as err:
                 self.process_error(type(err)(f'{self.name} {err}', 0))
 
 
-    def process_commands(self):
-        """
-        The function `process_commands` sends commands from a queue to a device until the queue is
-        empty.
-        :return: when the command queue is empty.
-        """
-        while True: # send all commands from queue
-            try:
-                cfg = self.cmd_queue.get_nowait()
-                dev_name = next(iter(cfg))
-                value = cfg[dev_name]
-                self.send_command(dev_name, value)
-            except Empty:
-                return
-            except Exception as err:
-                self.process_error(type(err)(f'{self.name} process_commands: {err}'), 0)
-                continue
+    def execute_command(self, cfg:dict):
+        dev_name = next(iter(cfg))
+        value = cfg[dev_name]
+        self.send_command(dev_name, value)
 
 
-    def read_devices(self):
+    def read_devices(self, poll_periods:list | None = None):
         """
         The function `read_devices` reads data from multiple devices using Modbus communication and
-        stores the values in a dictionary.
+        stores the values in a dictionary. Devices are read in blocks built by the scan planner, every
+        block is then split back into per-device values.
+
+        :param poll_periods: The `poll_periods` parameter is a list of poll classes to read (all
+        devices are read if not specified)
+        :type poll_periods: list | None
         """
         try:
-            dev_values = {}
-            for dev_name, dev_conf in self.read_dev_conf.items():
-                try:
-                    if dev_conf['num_registers'] <= 0:
-                        raise ValueError(f'ModbusComInterface.read_modbus_data: Invalid register config for {dev_name}')
-                    data = self.mb_client.read_holding_registers(dev_conf['start_register'], dev_conf['num_registers'],
-                                                                                    unit=dev_conf['modbus_id'])
-                    if not isinstance(data, register_read_message.ReadHoldingRegistersResponse) or len(data.registers)<2: # no answer or incorrect answer format
-                        dev_values[dev_name] = None
-                        raise ValueError(f'ModbusComInterface.read_modbus_data: incorrect data: {data} for device {dev_name}')
-                    #converting responce to str and sending to data converter to get human-readable output:
-                    reg1 = '{0:016b}'.format(data.registers[0])
-                    reg2 = '{0:016b}'.format(data.registers[1])
-                    out_val = self.modbus_to_dec(f'{reg1}{reg2}')
-                    out_val = self.data_converter.read_data_convert(dev_conf.get('converter_type', 'Default'), dev_name, out_val)
-                    dev_values.update({dev_name:out_val})
-                except Exception as err:
-                    dev_values.update({dev_name:None})
-                    self.process_error(f'read_devices: {err}')
+            scan_start = perf_counter()
+            for block in list(self.scan_blocks):
+                if poll_periods is not None and block.poll_period not in poll_periods:
                     continue
-            self.output_dict.update(dev_values)
+                self.process_commands() # commands don't wait for the end of scan
+                dev_values = {}
+                self.read_block(block, dev_values)
+                self.publish_values(dev_values, self.dev_quality, time()) # values are published as soon as their block is read
+                self.read_priority_devices() # feedback of just sent commands doesn't wait for the end of scan
+            self.bus_metrics.record_scan(perf_counter() - scan_start, min(poll_periods) if poll_periods else None)
+            self.publish_metrics({'breakers':self.bus_health.get_metrics(),
+                                  'quality':{dev_name:quality for dev_name, quality in self.dev_quality.items() if quality != 'good'}})
         except Exception as err:
             raise type(err)(f'read_devices: {err}')
-        
 
-    #modbus encoding and decoding:
-    def to_bytes(self,value): # dec to binary
-        return struct.pack('!f', value)
-    
 
-    def to_hex(self,value): # dec to hex
-        return self.to_bytes(value).hex()
+    def read_block(self, block, dev_values:dict):
+        """
+        The function `read_block` reads one block, splits and converts it to device values (failed
+        devices get None), unit failures are counted by the unit's circuit breaker.
+
+        :param block: The `block` parameter is the `ScanBlock` to read
+        :param dev_values: The `dev_values` parameter is a dictionary to put device values into
+        :type dev_values: dict
+        """
+        breaker = self.bus_health.get_breaker(block.modbus_id)
+        if not breaker.allow(): # unit is considered dead, don't waste bus time on it
+            self.set_block_failed(block, dev_values)
+            return
+        retry = breaker.state == 'half_open'
+        try:
+            start = perf_counter()
+            try:
+                data = self.mb_client.read_holding_registers(block.start_register, block.num_registers,
+                                                                                unit=block.modbus_id)
+            except Exception as err:
+                data = err
+            result = 'ok' if isinstance(data, register_read_message.ReadHoldingRegistersResponse) else \
+                     'error' if isinstance(data, ExceptionResponse) else 'timeout'
+            self.bus_metrics.record(perf_counter() - start, block.modbus_id, [dev_name for dev_name, _ in block.devices], result, retry)
+            if not isinstance(data, (register_read_message.ReadHoldingRegistersResponse, ExceptionResponse)):
+                raise ConnectionError(f'no answer from unit {block.modbus_id}: {data}')
+            breaker.record_success() # unit answered (even with modbus exception), it is alive
+            if isinstance(data, ExceptionResponse) and len(block.devices) > 1:
+                # device rejected the block (e.g. unmapped registers in a gap), read its devices one by one from now on
+                if block in self.scan_blocks:
+                    self.split_scan_block(block)
+                raise ValueError(f'block read rejected by unit {block.modbus_id}: {data}, block splitted')
+            if not isinstance(data, register_read_message.ReadHoldingRegistersResponse) or len(data.registers)<block.num_registers: # incorrect answer format
+                raise ValueError(f'incorrect data: {data} for block {block}')
+            raw_values = self.decode_block(block, data.registers)
+        except ConnectionError as err:
+            self.set_block_failed(block, dev_values)
+            if breaker.record_failure():
+                self.process_error(f'read_devices: {err}, unit is considered dead, retrying with backoff')
+            elif breaker.state == 'closed': # errors of dead units are reported once
+                self.process_error(f'read_devices: {err}')
+            return
+        except Exception as err:
+            self.set_block_failed(block, dev_values)
+            self.process_error(f'read_devices: {err}')
+            return
+        for dev_name, dev_conf in block.devices:
+            try:
+                #sending decoded value to data converter to get human-readable output:
+                out_val = self.read_converters[dev_name](raw_values[dev_name])
+                dev_values.update({dev_name:out_val})
+                self.dev_quality[dev_name] = self.get_value_quality(dev_conf, out_val)
+            except Exception as err:
+                dev_values.update({dev_name:None})
+                self.dev_quality[dev_name] = 'comm_error'
+                self.process_error(f'read_devices: {err}')
+                continue
 
 
-    def modbus_to_dec(self, raw_value:str):
+    def set_block_failed(self, block, dev_values:dict):
         """
-        The function `modbus_to_dec` converts a raw value from a IEEE754 protocol(with byte reverse) to a decimal number.
-        
-        :param raw_value: The `raw_value` parameter is a string representing a 32-bit Modbus value
-        :type raw_value: str
-        :return: the decimal value of the given raw_value.
+        The function `set_block_failed` publishes None with comm_error quality for all devices of a block.
         """
-        
-        #reverse bytes
-        b0 = raw_value[0:8]
-        b1 = raw_value[8:16]
-        b2 = raw_value[16:24]
-        b3 = raw_value[24:]
-        raw_value = f'{b3}{b2}{b1}{b0}'
-        
-        sign = int(raw_value[0])  # sign, 1 bit (31)
-        exp = int(raw_value[1:9], 2)  # exponent, 8 bits (30-23)
-        mant = int(raw_value[9:], 2)  # fraction of mantissa, 23 bits (22-0)
+        for dev_name, _ in block.devices:
+            dev_values.update({dev_name:None})
+            self.dev_quality[dev_name] = 'comm_error'
 
-        dec_number = ((-1) ** sign) * (2 ** (exp - 127)) * (1 + (mant / 2 ** 23))
-        return dec_number
-    
 
-    def val_to_modbus(self, val):
+    def decode_block(self, block, registers):
         """
-        The function `val_to_modbus` takes a Python float value and transforms it into a 4-byte
-        refrigerator modbus format.
+        The function `decode_block` decodes registers of a block read to raw device values. Dense blocks
+        of 2-register devices sharing one format are decoded at once.
+
+        :param block: The `block` parameter is the `ScanBlock` that was read
+        :param registers: The `registers` parameter is a list of registers returned for the block
+        :return: a dictionary with device names as keys and decoded values as values.
+        """
+        codecs = {self.read_codecs[dev_name] for dev_name, _ in block.devices}
+        is_dense = block.num_registers == 2 * len(block.devices) and all(dev_conf['num_registers'] == 2 for _, dev_conf in block.devices)
+        if len(codecs) == 1 and is_dense:
+            values = codecs.pop().decode(registers[:block.num_registers])
+            return {dev_name:value for (dev_name, _), value in zip(block.devices, values)}
+        raw_values = {}
+        for dev_name, dev_registers in block.split_registers(registers).items():
+            if len(dev_registers)<2:
+                raise ValueError(f'incorrect data: {dev_registers} for device {dev_name}')
+            raw_values.update({dev_name:self.read_codecs[dev_name].decode(dev_registers[:2])[0]})
+        return raw_values
+
+
+    def split_scan_block(self, block):
+        """
+        The function `split_scan_block` replaces a block in the scan plan with single-device blocks.
+
+        :param block: The `block` parameter is a `ScanBlock` which could not be read at once
+        """
+        idx = self.scan_blocks.index(block)
+        self.scan_blocks[idx:idx+1] = self.scan_planner.split_block(block)
         
-        :param val: The `val` parameter is a Python float value that needs to be transformed into a
-        4-byte refrigerator modbus format
-        :return: two values: `out_reg1` and `out_reg2`.
+
+    def execute_commands(self, commands:list):
+        """
+        The function `execute_commands` encodes commands and merges writes to contiguous control
+        registers of the same unit into single `write_registers` calls.
+
+        :param commands: The `commands` parameter is a list of (dev_name, value) tuples
+        :type commands: list
+        """
+        writes = [] # [modbus_id, start_register, registers, dev_names]
+        for dev_name, value in commands:
+            try:
+                if dev_name == 'Service':
+                    self.send_command(dev_name, value)
+                    continue
+                modbus_id, start_register, registers = self.encode_command(dev_name, value)
+                writes.append([modbus_id, start_register, registers, [dev_name]])
+            except Exception as err:
+                self.process_error(type(err)(f'{self.name} process_commands: {err}'), 0)
+        writes.sort(key=lambda write: (write[0], write[1]))
+        merged_writes = []
+        for write in writes:
+            if merged_writes:
+                last = merged_writes[-1]
+                if (last[0] == write[0] and last[1] + len(last[2]) == write[1]
+                        and len(last[2]) + len(write[2]) <= self.max_write_registers):
+                    last[2] = last[2] + write[2]
+                    last[3] = last[3] + write[3]
+                    continue
+            merged_writes.append(write)
+        for modbus_id, start_register, registers, dev_names in merged_writes:
+            try:
+                self.write_registers(modbus_id, start_register, registers)
+                self.schedule_feedback_reads(dev_names)
+            except Exception as err:
+                self.process_error(type(err)(f'{self.name} process_commands: {dev_names}: {err}'), 0)
+
+
+    def encode_command(self, dev_name, value):
+        """
+        The function `encode_command` converts a command value and encodes it to registers.
+
+        :param dev_name: The `dev_name` parameter is the name of the control device
+        :param value: The `value` parameter is the command value (number or string with a number)
+        :return: modbus id, start register and list of registers to write.
         """
         try:
-            hex_num = self.to_hex(val)
-            hex_str = str(hex_num)
-            #reverse bytes and put them in 2 registers
-            bytes = [hex_str[0:2], hex_str[2:4], hex_str[4:6], hex_str[6:8]]
-            out_reg2 = int(f'{bytes[3]}{bytes[2]}', 16)
-            out_reg1 = int(f'{bytes[1]}{bytes[0]}', 16)
-            return out_reg1, out_reg2
+            dev_conf = self.control_dev_conf.get(dev_name, None)
+            if dev_conf is None:
+                raise AttributeError(f'no config found for device {dev_name}')
+            value = self.write_converters[dev_name](float(value))
+            registers = self.write_codecs[dev_name].encode([value]) # encode decimal to modbus format (2 registers)
+            return dev_conf['modbus_id'], dev_conf['start_register'], registers
         except Exception as err:
-            raise type(err)(f'val_to_modbus encoding error: {err}')
+            raise type(err)(f'encode_command: {err}')
+
+
+    def write_registers(self, modbus_id, start_register, registers):
+        start = perf_counter()
+        try:
+            response = self.mb_client.write_registers(start_register, registers, unit=modbus_id)
+        except Exception:
+            self.bus_metrics.record(perf_counter() - start, modbus_id, result='timeout')
+            raise
+        self.bus_metrics.record(perf_counter() - start, modbus_id, result='timeout' if response is None else
+                                'error' if response.isError() else 'ok')
+        if response is None or response.isError():
+            raise ConnectionError(f'write to unit {modbus_id} at {start_register} failed: {response}')
 
 
     def send_command(self, dev_name, value):
@@ -217,29 +501,79 @@ class ModbusComInterface(BaseInterface): # korobochki
             if dev_name == 'Service':
                 pass # self.do_calib()
                 return
-            dev_conf = self.control_dev_conf.get(dev_name, None)
-            if dev_conf is None:
-                raise AttributeError(f'no config found for device {dev_name}')
-            value = self.data_converter.write_data_convert(dev_name, value)
-            val_reg1, val_reg2 = self.val_to_modbus(value) # encode decimal to modbus format (2 registers)
-            self.mb_client.write_registers([dev_conf['start_register'], dev_conf['start_register']+1], [val_reg1, val_reg2], unit=dev_conf['modbus_id'])
-
-            # self.mb_client.write_registers(dev_conf['start_register'], val_reg1, unit=dev_conf['modbus_id']) # send first register
-            # self.mb_client.write_registers(dev_conf['start_register']+1, val_reg2, unit=dev_conf['modbus_id']) # send second register
+            self.write_registers(*self.encode_command(dev_name, value))
+            self.schedule_feedback_reads([dev_name])
         except Exception as err:
             raise type(err)(f'send_data: {err}')
+
+
+    def schedule_feedback_reads(self, dev_names:list):
+        """
+        The function `schedule_feedback_reads` schedules immediate reads of feedback sensors of just
+        written control devices; they are sampled every `feedback_interval` seconds until the value
+        settles (changes less than `feedback_settle`) or `feedback_samples` reads are done.
+
+        :param dev_names: The `dev_names` parameter is a list of written control devices
+        :type dev_names: list
+        """
+        now = monotonic()
+        for dev_name in dev_names:
+            fb_dev_name = self.feedback_rel.get(dev_name, None)
+            if fb_dev_name is not None and self.feedback_samples > 0:
+                self.feedback_reads[fb_dev_name] = [self.feedback_samples, now, None]
+
+
+    def time_to_priority_read(self):
+        if not self.feedback_reads:
+            return None
+        return max(0, min(state[1] for state in self.feedback_reads.values()) - monotonic())
+
+
+    def read_priority_devices(self):
+        """
+        The function `read_priority_devices` reads due feedback sensors (due sensors of one unit are read
+        in one block) and pushes their values to the shared dict at once.
+        """
+        try:
+            if not self.feedback_reads:
+                return
+            now = monotonic()
+            due_conf = {fb_dev_name:self.read_dev_conf[fb_dev_name] for fb_dev_name, state in self.feedback_reads.items() if state[1] <= now}
+            if not due_conf:
+                return
+            dev_values = {}
+            for block in self.scan_planner.plan(due_conf):
+                self.read_block(block, dev_values)
+            self.publish_values(dev_values, self.dev_quality)
+            now = monotonic()
+            for fb_dev_name in due_conf:
+                samples_left, _, last_value = self.feedback_reads[fb_dev_name]
+                value = dev_values.get(fb_dev_name, None)
+                settled = value is not None and last_value is not None and abs(value - last_value) <= self.feedback_settle
+                if samples_left <= 1 or settled:
+                    del self.feedback_reads[fb_dev_name]
+                else:
+                    self.feedback_reads[fb_dev_name] = [samples_left - 1, now + self.feedback_interval, value]
+        except Exception as err:
+            self.feedback_reads.clear()
+            self.process_error(f'read_priority_devices: {err}')
     
 
 class ModbusRtuOverTcpComInterface(BaseInterface): # PKT8
 
-    
+    read_codec = get_codec('uint32', word_order='little', byte_order='big', divider=100) # resistance in 0.01 Ohm, low word first
+
     def __init__(self, core_path, output_dict, err_queue:Queue, modbus_con_info:dict, read_devices_config:dict, 
-                 read_period = .5, name: str | None = None, ) -> None:
+                 read_period = .5, name: str | None = None, metrics_dict = None, calibrations = None) -> None:
         try:
-            super().__init__(output_dict, err_queue, read_period, name, daemon = None)
+            super().__init__(output_dict, err_queue, read_period, name, daemon = None, metrics_dict=metrics_dict)
             self.read_dev_conf = read_devices_config
             self.con_info = modbus_con_info
-            self.data_converter = RefrigDataConverter(core_path)
+            self.data_converter = RefrigDataConverter(core_path, calibrations)
+            self.read_batch = self.data_converter.compile_batch(self.read_dev_conf) # a whole scan is converted at once
+            self.read_codecs = {dev_name:codec_from_config(dev_conf, self.read_codec) for dev_name, dev_conf in self.read_dev_conf.items()}
+            for dev_conf in self.read_dev_conf.values():
+                self.poll_scheduler.add_poll_class(self.get_poll_period(dev_conf))
         except Exception as err:
             raise type(err)(f'{self.name} ModbusComInterface init: {err}')
             
@@ -259,49 +593,72 @@ class ModbusRtuOverTcpComInterface(BaseInterface): # PKT8
     def run(self):
         while True:
             try:
-                sleep(self.read_period)
-                self.read_devices()
+                self.read_devices(self.wait_next_poll())
             except Exception as err:
                 self.process_error(type(err)(f'{self.name} {err}', 0))
 
 
-    def read_devices(self):
+    def read_devices(self, poll_periods:list | None = None):
         try:
+            scan_start = perf_counter()
             dev_values = {}
+            raw_values = {}
             for dev_name, dev_conf in self.read_dev_conf.items():
+                if poll_periods is not None and self.get_poll_period(dev_conf) not in poll_periods:
+                    continue
                 try:
                     if dev_conf['num_registers'] <= 0:
                         raise ValueError(f'ModbusComInterface.read_modbus_data: Invalid register config for {dev_name}')
-                    data = self.mb_client.read_holding_registers(dev_conf['start_register'], dev_conf['num_registers'],
-                                                                                    unit=dev_conf['modbus_id'])
+                    start = perf_counter()
+                    try:
+                        data = self.mb_client.read_holding_registers(dev_conf['start_register'], dev_conf['num_registers'],
+                                                                                        unit=dev_conf['modbus_id'])
+                    except Exception:
+                        self.bus_metrics.record(perf_counter() - start, dev_conf['modbus_id'], [dev_name], 'timeout')
+                        raise
+                    self.bus_metrics.record(perf_counter() - start, dev_conf['modbus_id'], [dev_name],
+                                            'ok' if isinstance(data, register_read_message.ReadHoldingRegistersResponse) else
+                                            'error' if isinstance(data, ExceptionResponse) else 'timeout')
                     if not isinstance(data, register_read_message.ReadHoldingRegistersResponse) or len(data.registers)<2: # no answer or incorrect answer format
                         dev_values[dev_name] = None
                         raise ValueError(f'ModbusComInterface.read_modbus_data: incorrect data: {data} for device {dev_name}')
-                    #decoding responce and sending to data converter to get human-readable output:
-                    msb = data.registers[1]
-                    lsb = data.registers[0]
-                    out_val = ((msb << 16) | (lsb) ) / 100
-                    out_val = self.data_converter.read_data_convert(dev_conf.get('converter_type', 'Default'), dev_name, out_val)
-                    dev_values.update({dev_name:out_val})
+                    #decoding responce, values of the scan are sent to data converter together:
+                    raw_values[dev_name] = self.read_codecs[dev_name].decode(data.registers[:2])[0]
+                    dev_values.update({dev_name:None})
                 except Exception as err:
                     dev_values.update({dev_name:None})
                     self.process_error(f'read_devices: {err}')
                     continue
-            self.output_dict.update(dev_values)
+            for dev_name, out_val in self.read_batch.convert_dict(raw_values).items(): # human-readable output
+                if isinstance(out_val, Exception):
+                    self.process_error(f'read_devices: {out_val}')
+                    continue
+                dev_values[dev_name] = out_val
+            qualities = {dev_name:self.get_value_quality(self.read_dev_conf[dev_name], value) for dev_name, value in dev_values.items()}
+            for dev_name in self.read_batch.check_ranges(raw_values): # e.g. resistance outside of the calibrated range
+                if dev_values[dev_name] is not None:
+                    qualities[dev_name] = 'out_of_range'
+            self.publish_values(dev_values, qualities)
+            self.bus_metrics.record_scan(perf_counter() - scan_start, min(poll_periods) if poll_periods else None)
+            self.publish_metrics()
         except Exception as err:
             raise type(err)(f'read_devices: {err}')
         
 
 class TurbineComInterface(BaseInterface):
     def __init__(self, core_path, output_dict, err_queue:Queue, con_info:dict, read_devices_config:dict, 
-                 control_devices_config:dict, read_period = .5, name: str | None = None, ) -> None:
+                 control_devices_config:dict, read_period = .5, name: str | None = None, metrics_dict = None, calibrations = None) -> None:
         try:
-            super().__init__(output_dict=output_dict, err_queue=err_queue, read_period=read_period, name=name)
+            super().__init__(output_dict=output_dict, err_queue=err_queue, read_period=read_period, name=name, metrics_dict=metrics_dict)
             self.control_dev_conf = control_devices_config
             self.read_dev_conf = read_devices_config
             self.con_info = con_info
             
-            self.data_converter = RefrigDataConverter(core_path)
+            self.data_converter = RefrigDataConverter(core_path, calibrations)
+            self.read_converters = self.data_converter.compile_read(self.read_dev_conf)
+            self.write_converters = self.data_converter.compile_write(self.control_dev_conf)
+            for dev_conf in self.read_dev_conf.values():
+                self.poll_scheduler.add_poll_class(self.get_poll_period(dev_conf))
         except Exception as err:
             raise type(err)(f'{self.name} ModbusComInterface init: {err}')
         
@@ -317,61 +674,63 @@ class TurbineComInterface(BaseInterface):
     def run(self):
         while True:
             try:
-                sleep(self.read_period)
+                poll_periods = self.wait_next_poll()
                 self.process_commands()
-                self.read_devices() # read all turbine attributes
+                self.read_devices(poll_periods) # read turbine attributes of due poll classes
             except Exception as err:
                 self.process_error(type(err)(f'{self.name} {err}', 0))
 
 
-    def read_devices(self):
+    def read_devices(self, poll_periods:list | None = None):
         try:
-            self.tc_client.send_command('read_temp') # sending command to read values from turbine
+            scan_start = perf_counter()
+            self.send_telegram('read_temp') # sending command to read values from turbine
             dev_values = {}
             for dev_name, dev_conf in self.read_dev_conf.items():
+                if poll_periods is not None and self.get_poll_period(dev_conf) not in poll_periods:
+                    continue
                 try:
-                    if not isinstance(dev_conf, dict):
-                        converter_type = 'Default'
-                    else:
-                        converter_type = dev_conf.get('converter_type', 'Default')
                     out_val = self.tc_client.get_attr_value(attr_name=dev_name.split('_')[-1])
-                    out_val = self.data_converter.read_data_convert(converter_type, dev_name, out_val)
+                    out_val = self.read_converters[dev_name](out_val)
                     dev_values.update({dev_name:out_val})
                 except Exception as err:
                     dev_values.update({dev_name:None})
                     self.process_error(f'read_devices: {err}')
                     continue
-            self.output_dict.update(dev_values)
+            self.publish_values(dev_values, {dev_name:self.get_value_quality(self.read_dev_conf[dev_name], value) for dev_name, value in dev_values.items()})
+            self.bus_metrics.record_scan(perf_counter() - scan_start, min(poll_periods) if poll_periods else None)
+            self.publish_metrics()
         except Exception as err:
             raise type(err)(f'read_devices: {err}')
         
 
-    def process_commands(self):
-        while True: # send all commands from queue
-            try:
-                cfg = self.cmd_queue.get_nowait()
-                dev_name = next(iter(cfg))
-                cmd = cfg[dev_name].split(' ')
-                cmd_name = cmd[0]
-                if len(cmd)>1:
-                    cmd_value = cmd[1]
-                    cmd_value = self.data_converter.write_data_convert(dev_name=dev_name, value=cmd_value)
-                else:
-                    cmd_value = None
-                self.tc_client.send_command(cmd_name, cmd_value)
-            except Empty:
-                return
-            except Exception as err:
-                self.process_error(type(err)(f'{self.name} process_commands: {err}'), 0)
-                continue
+    def execute_command(self, cfg:dict):
+        dev_name = next(iter(cfg))
+        cmd = cfg[dev_name].split(' ')
+        cmd_name = cmd[0]
+        if len(cmd)>1:
+            cmd_value = cmd[1]
+            cmd_value = self.write_converters.get(dev_name, pass_value)(cmd_value)
+        else:
+            cmd_value = None
+        self.send_telegram(cmd_name, cmd_value)
+
+
+    def send_telegram(self, cmd_name, cmd_value = None):
+        # timed turbine transaction
+        start = perf_counter()
+        try:
+            self.tc_client.send_command(cmd_name, cmd_value)
+        except Exception:
+            self.bus_metrics.record(perf_counter() - start, result='error')
+            raise
+        self.bus_metrics.record(perf_counter() - start)
 
 
 class MqttComInterface(Thread): # devices, connected to WB extention modules (vacpumps, valves)
 
-    local_values_dict = {}
-
     def __init__(self, core_path, output_dict, err_queue:Queue, con_info:dict, read_devices_config:dict, 
-                 control_devices_config:dict, read_period = 1, name: str | None = None, ) -> None:
+                 control_devices_config:dict, read_period = 1, name: str | None = None, calibrations = None) -> None:
         try:
             super().__init__(name=name, daemon=True)
             self.cmd_queue = Queue(maxsize=10)
@@ -381,9 +740,9 @@ class MqttComInterface(Thread): # devices, connected to WB extention modules (va
             self.control_dev_conf = control_devices_config
             self.read_dev_conf = read_devices_config
             self.con_info = con_info
-            
-            # type(self).local_values_dict = {}
-            self.data_converter = RefrigDataConverter(core_path)
+            self.data_converter = RefrigDataConverter(core_path, calibrations)
+            self.read_converters = self.data_converter.compile_read(self.read_dev_conf)
+            self.write_converters = self.data_converter.compile_write(self.control_dev_conf)
             self.mqtt_client = mqtt.Client()
             self.topic_head = '/devices/control/'
         except Exception as err:
@@ -411,25 +770,28 @@ class MqttComInterface(Thread): # devices, connected to WB extention modules (va
         try:
             value = float(f'{msg.payload.decode()}')
             dev_name = msg.topic.split("/")[-1]
-            dev_conf = self.read_dev_conf.get('dev_name', {})
-            converter_type = dev_conf.get('converter_type', 'Default')
-            value = self.data_converter.read_data_convert(converter_type, dev_name, value)
-            lvd = type(self).local_values_dict
-            lvd.update({dev_name:value})
+            value = self.read_converters.get(dev_name, pass_value)(value)
+            self.output_dict.update({dev_name:value}, source=self.name) # values are shared as soon as they arrive
         except Exception as err:
             print(err)
             self.process_error(type(err)(f'error reading value: {err}'), 0)
 
 
-    def process_commands(self):
+    def process_commands(self, timeout:float = 0):
         """
         The function `process_commands` sends commands from a queue to a device until the queue is
         empty.
+        :param timeout: The `timeout` parameter is the time in seconds to wait for the first command,
+        defaults to 0 (don't wait)
         :return: when the command queue is empty.
         """
         while True: # send all commands from queue
             try:
-                cfg = self.cmd_queue.get_nowait()
+                if timeout > 0:
+                    cfg = self.cmd_queue.get(timeout=timeout) # wakes up as soon as a command is put into queue
+                else:
+                    cfg = self.cmd_queue.get_nowait()
+                timeout = 0
                 dev_name = next(iter(cfg))
                 value = cfg[dev_name]
                 self.send_command(dev_name, value)
@@ -442,10 +804,9 @@ class MqttComInterface(Thread): # devices, connected to WB extention modules (va
 
     def send_command(self, dev_name, value):
         try:
-            dev_conf = self.control_dev_conf.get(dev_name, {})
-            converter_type = dev_conf.get('converter_type', 'Default')
+            dev_conf = self.control_dev_conf.get(dev_name) or {}
             topic_name = dev_conf.get('mqtt_topic', f'{dev_name}')
-            value = self.data_converter.write_data_convert(converter_type, dev_name, value)
+            value = self.write_converters.get(dev_name, pass_value)(value)
             self.mqtt_client.publish(topic=f'{self.topic_head}{topic_name}', payload=f'{value}')
         except Exception as err:
             raise type(err)(f'send_command: {err}')
@@ -454,9 +815,7 @@ class MqttComInterface(Thread): # devices, connected to WB extention modules (va
     def run(self):
         while True:
             try:
-                sleep(self.read_period)
-                self.process_commands()
-                self.output_dict.update(self.local_values_dict)
+                self.process_commands(self.read_period) # values are shared by update_value, only commands wait here
             except Exception as err:
                 print(err)
                 self.process_error(type(err)(f'{self.name}: {err}'), 0)
@@ -471,38 +830,79 @@ class MqttComInterface(Thread): # devices, connected to WB extention modules (va
 
 
 class MultiDeviceCalculator(BaseInterface):
-    def __init__(self, output_dict, multi_devices_conf: dict, err_queue: Queue, read_period: float = 1, name: str | None = None, daemon: bool | None = None) -> None:
+    def __init__(self, output_dict, multi_devices_conf: dict, err_queue: Queue, read_period: float = 1, name: str | None = None, daemon: bool | None = None,
+                 value_events = None) -> None:
         super().__init__(output_dict, err_queue, read_period, name, daemon)
         self.multi_devices_conf = multi_devices_conf
+        self.value_events = value_events # change events subscription (optional, all devices are recalculated every read_period otherwise)
+        self.last_full_pass = 0 # monotonic time of the last recalculation of all multi devices
+        self.comp_dev_rel = {} # {component dev_name: [multi dev names]}
+        for cur_multi_dev_name, comp_devs_list in self.multi_devices_conf.items():
+            for cur_comp_dev_name in comp_devs_list:
+                self.comp_dev_rel.setdefault(cur_comp_dev_name, []).append(cur_multi_dev_name)
 
 
     def run(self):
         """
-        The function runs an infinite loop that periodically updates the output dictionary based on the
-        values in the input dictionary and the configuration of multiple devices.
+        The function runs an infinite loop that updates the output dictionary based on the values in the
+        input dictionary and the configuration of multiple devices: as soon as some component changes
+        (only affected multi devices) and at least once every read_period (all multi devices).
         """
         while True:
             try:
-                sleep(self.read_period)
-                #create local copies of dicts to avoid blocking other processes:
-                local_output_dict = {}
-                in_values = deepcopy(self.output_dict)
-
-                for cur_multi_dev_name, comp_devs_list in self.multi_devices_conf.items():
-                    multi_dev_conf = {}
-                    for cur_comp_dev_name in comp_devs_list: # get values of multi_dev's components
-                        multi_dev_conf.update({cur_comp_dev_name:in_values.get(cur_comp_dev_name, None)})
-                    try:
-                        cur_out_value = self.calculate_device_value(cur_multi_dev_name, multi_dev_conf)
-                    except (AttributeError, KeyError, TypeError) as err: # if no key found or some value is None - return None and send warning
-                        cur_out_value = None
-                        self.process_error(type(err)(f'{self.name} {err}'), 0)
-                    local_output_dict.update({cur_multi_dev_name:cur_out_value}) # fill local dict
-                self.output_dict.update(local_output_dict) # update global dict with local dict's values                   
+                self.recalculate(self.wait_changes())
             except Exception as err:
                 self.process_error(type(err)(f'{self.name} {err}'), 0)
 
 
+    def recalculate(self, multi_dev_names):
+        """
+        The function `recalculate` calculates multi devices from the current values of their components
+        and writes them to the output dictionary.
+
+        :param multi_dev_names: The `multi_dev_names` parameter is a list of multi devices to recalculate
+        """
+        #create local copy of shared values to avoid blocking other processes:
+        in_records = self.output_dict.snapshot_records() # lock-free copy {dev_name: (value, timestamp, quality, source)}
+
+        for cur_multi_dev_name in multi_dev_names:
+            comp_devs_list = self.multi_devices_conf[cur_multi_dev_name]
+            multi_dev_conf = {}
+            comp_records = [in_records[cur_comp_dev_name] for cur_comp_dev_name in comp_devs_list if cur_comp_dev_name in in_records]
+            for cur_comp_dev_name in comp_devs_list: # get values of multi_dev's components
+                multi_dev_conf.update({cur_comp_dev_name:in_records.get(cur_comp_dev_name, (None,))[0]})
+            try:
+                cur_out_value = self.calculate_device_value(cur_multi_dev_name, multi_dev_conf)
+            except (AttributeError, KeyError, TypeError) as err: # if no key found or some value is None - return None and send warning
+                cur_out_value = None
+                self.process_error(type(err)(f'{self.name} {err}'), 0)
+            # result is as old and as bad as its oldest and worst component:
+            timestamp = min((record[1] for record in comp_records), default=None)
+            quality = max((record[2] for record in comp_records), key=self.output_dict.severity.index, default='good')
+            self.output_dict.update({cur_multi_dev_name:cur_out_value}, timestamp=timestamp, quality=quality, source=self.name)
+
+
+    def wait_changes(self):
+        """
+        The function `wait_changes` waits for changes of components and returns names of multi devices
+        to recalculate: all of them if read_period has passed since the last full pass (components with
+        constant values are rewritten with new timestamps but send no events) or events were lost.
+        """
+        if self.value_events is None:
+            sleep(self.read_period)
+            return list(self.multi_devices_conf)
+        events = self.value_events.get(timeout=max(self.last_full_pass + self.read_period - monotonic(), 0))
+        if not events or monotonic() - self.last_full_pass >= self.read_period:
+            self.last_full_pass = monotonic()
+            return list(self.multi_devices_conf)
+        multi_dev_names = []
+        for dev_name in events:
+            for cur_multi_dev_name in self.comp_dev_rel.get(dev_name, []):
+                if cur_multi_dev_name not in multi_dev_names:
+                    multi_dev_names.append(cur_multi_dev_name)
+        return multi_dev_names
+
+
     def calculate_device_value(self, multi_dev_name, multi_dev_conf):
         """
         The function `calculate_device_value` calculates the value of a device based on its name and
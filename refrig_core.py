@@ -2,14 +2,19 @@
 from refrig_comm_ifaces import MultiDeviceCalculator, MqttComInterface
 from refrig_debugging import ModbusComInterface, ModbusRtuOverTcpComInterface, TurbineComInterface
 
+from refrig_async_ifaces import AsyncModbusRtuOverTcpComInterface
 from refrig_external_ifaces import mqtt_iface
 from refrig_auto_controls import refrigAutoControls
+from refrig_value_table import SharedValueTable
+from refrig_historian import HistoryStore, RefrigHistorian, HistoryQueryService, rollup_dtype
+from refrig_calibration import load_calibrations
 
-from time import sleep
+from time import sleep, monotonic, time
 from multiprocessing import Queue, Manager, Lock
 from queue import Empty, Full
 from pathlib import Path
 import logging
+import json
 
 from time import sleep
 
@@ -19,6 +24,12 @@ class RefrigControlsCore():
     state = 'INIT' # INIT/OK/WARNING/ERROR/CRITICAL
     status = 'Manual' # Manual/Heating to/cooling to/ etc
     ext_iface = None
+    historian = None
+    history_service = None
+    value_sources = ['box_iface', 'therm_iface', 'turb1_iface', 'turb2_iface', 'vac_iface', 'multi_dev_calculator'] # interfaces writing live values
+    stale_periods = 5 # values are stale after this number of missed poll periods (if stale_after is not set)
+    value_subscribers = ['ext_iface', 'multi_dev_calculator', 'auto_controls'] # consumers of value change events
+    quality_check_period = 1 # seconds, how often qualities are checked for stale values
 
     def __init__(self) -> None:
         try: # pre-logger error handling
@@ -31,13 +42,20 @@ class RefrigControlsCore():
             self.err_queue = Queue(maxsize=20) # process shared queue for storing errors
             self.pool_lock = Lock()
             pool_manager = type(self).pool_manager = Manager()
-            self.values_dict = pool_manager.dict() 
-
-            self.ext_iface_cfg, self.iface_cfg, self.device_cfg = self.read_main_config(self.cur_path.joinpath('config.yaml'))
-            self.silicon_therm_cfg = self.read_silicon_therm_config(self.cur_path.joinpath('data','silicon_thermometry'))
+            self.metrics_dict = pool_manager.dict() # interfaces metrics (bus health etc.)
+
+            self.ext_iface_cfg, self.iface_cfg, self.device_cfg, self.history_cfg = self.read_main_config(self.cur_path.joinpath('config.yaml'))
+            self.values_dict = SharedValueTable(self.get_value_dev_names(self.device_cfg), sources=self.value_sources,
+                                                stale_after=self.get_stale_after(self.device_cfg)) # process shared live values
+            # change events queues, made before any interface is started:
+            self.value_events = {name:self.values_dict.subscribe(name) for name in self.value_subscribers}
+            if self.history_cfg.get('enabled', False): # historian records every sample, not only changes
+                self.value_events['historian'] = self.values_dict.subscribe('historian', maxsize=10000, changes_only=False)
+            self.calibrations = load_calibrations(self.cur_path) # thermometer calibrations, shared by all interfaces
+            self.device_calibrations = self.get_device_calibrations(self.device_cfg)
             self.init_ifaces()
 
-            del self.ext_iface_cfg, self.iface_cfg, self.device_cfg, self.silicon_therm_cfg # not needed anymore
+            del self.ext_iface_cfg, self.iface_cfg, self.device_cfg, self.history_cfg # not needed anymore
             self.update_state('OK')
             self.update_status(self.status)
         except Exception as err:
@@ -87,7 +105,8 @@ class RefrigControlsCore():
         
         :param cfg_path: The `cfg_path` parameter is a string that represents the path to the
         configuration file that needs to be read
-        :return: three variables: ext_iface_cfg, iface_cfg, and device_cfg.
+        :return: four variables: ext_iface_cfg, iface_cfg, device_cfg and history_cfg (empty if there is no
+        `history` section).
         """
         import yaml
         try:
@@ -100,43 +119,91 @@ class RefrigControlsCore():
                 iface_cfg = cfg['connections']
                 ext_iface_cfg = iface_cfg.pop('external_iface')
                 device_cfg = cfg['devices']
+                history_cfg = cfg.get('history', None) or {}
 
                 # for cur_con_type, cur_devs in device_cfg.values():
                 #     for cur_dev_name, cur_dev_conf in dict(cur_devs).values():
                 #         if 'converter_type' not in list(cur_dev_conf.keys()):
                 #             cur_dev_conf.update({'converter_type':'Default'})
 
-            return ext_iface_cfg, iface_cfg, device_cfg
+            return ext_iface_cfg, iface_cfg, device_cfg, history_cfg
         except Exception as err:
             raise type(err)(f'read_main_config: {err}')
         
 
-    def read_silicon_therm_config(self, cfg_dir):
+    def get_value_dev_names(self, device_cfg:dict):
         """
-        The function reads configuration files in a specified directory and returns the data in a
-        dictionary format.
-        
-        :param cfg_dir: The `cfg_dir` parameter is a directory path where the configuration files are
-        located
-        :return: a dictionary `si_therm_data` which contains the sensor names as keys and their
-        corresponding coefficients as values.
+        The function `get_value_dev_names` lists devices which have live values: sensor devices of all
+        interfaces and multi devices (slots of the shared value table).
+
+        :param device_cfg: The `device_cfg` parameter is the `devices` section of the main config
+        :type device_cfg: dict
+        :return: a list of device names.
         """
-        try:
-            si_therm_data = {}
-            for cur_file_name in list(cfg_dir.iterdir()):
-                cur_file = open(cfg_dir.joinpath(cur_file_name), 'r')
-                cur_sensor_name = cur_file.readline().split()[0]
-                cur_sens_coefs = []
-                while True:
-                    cur_line = cur_file.readline()
-                    if len(cur_line) == 0:
-                        break
-                    cur_sens_coefs.append(float(cur_line.split('=')[-1]))
-                cur_file.close()
-                si_therm_data.update({cur_sensor_name: cur_sens_coefs})
-            return si_therm_data
-        except Exception as err:
-            raise type(err)(f'read_silicon_therm_config: {err}')
+        dev_names = []
+        for section_name, section_cfg in device_cfg.items():
+            if section_name.endswith('_sensor_devices') or section_name == 'multi_devices':
+                dev_names += [dev_name for dev_name in (section_cfg or {}) if dev_name not in dev_names]
+        return dev_names
+
+
+    def get_stale_after(self, device_cfg:dict):
+        """
+        The function `get_stale_after` returns value lifetimes of devices: `stale_after` of the device
+        config or `stale_periods` poll periods if `poll_period` is set (default lifetime otherwise).
+
+        :param device_cfg: The `device_cfg` parameter is the `devices` section of the main config
+        :type device_cfg: dict
+        :return: a dictionary {dev_name: seconds}.
+        """
+        stale_after = {}
+        for section_cfg in device_cfg.values():
+            for dev_name, dev_conf in (section_cfg or {}).items():
+                if not isinstance(dev_conf, dict):
+                    continue
+                if 'stale_after' in dev_conf:
+                    stale_after[dev_name] = float(dev_conf['stale_after'])
+                elif 'poll_period' in dev_conf:
+                    stale_after[dev_name] = self.stale_periods * float(dev_conf['poll_period'])
+        return stale_after
+
+
+    def get_deadbands(self, device_cfg:dict):
+        """
+        The function `get_deadbands` returns publishing deadbands of devices which have `deadband` or
+        `deadband_rel` in their config.
+
+        :param device_cfg: The `device_cfg` parameter is the `devices` section of the main config
+        :type device_cfg: dict
+        :return: a dictionary {dev_name: (absolute deadband, relative deadband)}.
+        """
+        deadbands = {}
+        for section_cfg in device_cfg.values():
+            for dev_name, dev_conf in (section_cfg or {}).items():
+                if isinstance(dev_conf, dict) and ('deadband' in dev_conf or 'deadband_rel' in dev_conf):
+                    deadbands[dev_name] = (float(dev_conf.get('deadband', 0)), float(dev_conf.get('deadband_rel', 0)))
+        return deadbands
+
+
+    def get_device_calibrations(self, device_cfg:dict):
+        """
+        The function `get_device_calibrations` returns ids of calibrations used by thermometers (devices
+        without calibration are converted by a formula and are not included).
+
+        :param device_cfg: The `device_cfg` parameter is the `devices` section of config
+        :return: a dictionary {dev_name: calibration id}.
+        """
+        device_calibrations = {}
+        for section_cfg in device_cfg.values():
+            if not isinstance(section_cfg, dict):
+                continue
+            for dev_name, dev_conf in section_cfg.items():
+                if not isinstance(dev_conf, dict) or dev_conf.get('converter_type', None) != 'SiTemp':
+                    continue
+                calibration = self.calibrations.get(dev_conf.get('calibration', dev_name))
+                if calibration is not None:
+                    device_calibrations[dev_name] = calibration.calibration_id
+        return device_calibrations
     
 
     def init_ifaces(self):
@@ -148,7 +215,9 @@ class RefrigControlsCore():
             self.dev_iface_rel = {} # stores which interface devices belong to
 
             #ext iface
-            self.ext_iface = mqtt_iface(self.ext_iface_cfg, self.send_command, self.err_queue)
+            self.ext_iface = mqtt_iface(self.ext_iface_cfg, self.send_command, self.err_queue, self.get_deadbands(self.device_cfg),
+                                        dev_names=self.values_dict.dev_names, qualities=self.values_dict.qualities,
+                                        history_callback=self.process_history_request)
 
             #box
             box_connect_info = self.iface_cfg.pop('box_serial')
@@ -159,7 +228,7 @@ class RefrigControlsCore():
 
             box_iface = ModbusComInterface(core_path=self.cur_path, output_dict=self.values_dict, err_queue=self.err_queue, 
                                            modbus_con_info=box_connect_info, read_devices_config=box_sensor_dev_cfg, control_devices_config=box_control_dev_cfg, 
-                                           read_period=.5, name='box_iface' )
+                                           read_period=.5, name='box_iface', metrics_dict=self.metrics_dict, calibrations=self.calibrations)
             self.box_iface_queue = box_iface.cmd_queue # queue to push commands
             box_iface.connect_iface()
             box_iface.start()
@@ -168,9 +237,13 @@ class RefrigControlsCore():
             therm_connect_info = self.iface_cfg.pop('therm_serial')
             therm_sensor_dev_cfg = self.device_cfg.pop('therm_sensor_devices')
             self.update_dev_ifaces_rel('therm_iface', list(therm_sensor_dev_cfg.keys()))
-            therm_iface = ModbusRtuOverTcpComInterface(core_path=self.cur_path, output_dict=self.values_dict, err_queue=self.err_queue, 
+            if therm_connect_info.get('engine', 'sync') == 'async': # asyncio engine with several requests in flight
+                therm_iface_cls = AsyncModbusRtuOverTcpComInterface
+            else:
+                therm_iface_cls = ModbusRtuOverTcpComInterface
+            therm_iface = therm_iface_cls(core_path=self.cur_path, output_dict=self.values_dict, err_queue=self.err_queue, 
                                            modbus_con_info=therm_connect_info, read_devices_config=therm_sensor_dev_cfg,
-                                           read_period=.5, name='therm_iface' )
+                                           read_period=.5, name='therm_iface', metrics_dict=self.metrics_dict, calibrations=self.calibrations)
             self.therm_iface_queue = therm_iface.cmd_queue # queue to push commands
             therm_iface.connect_iface()
             therm_iface.start()
@@ -184,7 +257,8 @@ class RefrigControlsCore():
             self.update_dev_ifaces_rel('turb1_iface', list(turb1_sensor_dev_cfg.keys())+list(turb1_control_dev_cfg.keys()) )
             turb1_iface = TurbineComInterface(core_path=self.cur_path, output_dict=self.values_dict, err_queue=self.err_queue, 
                                            con_info=turb1_connect_info, read_devices_config=turb1_sensor_dev_cfg, 
-                                           control_devices_config=turb1_control_dev_cfg, read_period=.5, name='turb1_iface' )
+                                           control_devices_config=turb1_control_dev_cfg, read_period=.5, name='turb1_iface',
+                                           metrics_dict=self.metrics_dict, calibrations=self.calibrations)
             self.turb1_iface_queue = turb1_iface.cmd_queue # queue to push commands
             turb1_iface.connect_iface()
             turb1_iface.start()
@@ -197,7 +271,8 @@ class RefrigControlsCore():
             self.update_dev_ifaces_rel('turb2_iface', list(turb2_sensor_dev_cfg.keys())+list(turb2_control_dev_cfg.keys()))
             turb2_iface = TurbineComInterface(core_path=self.cur_path, output_dict=self.values_dict, err_queue=self.err_queue, 
                                            con_info=turb2_connect_info, read_devices_config=turb2_sensor_dev_cfg, 
-                                           control_devices_config=turb2_control_dev_cfg, read_period=.5, name='turb2_iface' )
+                                           control_devices_config=turb2_control_dev_cfg, read_period=.5, name='turb2_iface',
+                                           metrics_dict=self.metrics_dict, calibrations=self.calibrations)
             self.turb2_iface_queue = turb2_iface.cmd_queue # queue to push commands
             turb2_iface.connect_iface()
             turb2_iface.start()
@@ -210,7 +285,8 @@ class RefrigControlsCore():
             self.update_dev_ifaces_rel('vac_iface', list(vac_sensor_dev_cfg.keys())+list(vac_control_dev_cfg.keys()))
             vac_iface = MqttComInterface(core_path=self.cur_path, output_dict=self.values_dict, err_queue=self.err_queue, 
                                            con_info=vac_connect_info, read_devices_config=vac_sensor_dev_cfg, 
-                                           control_devices_config=vac_control_dev_cfg, read_period=1, name='vac_iface' )
+                                           control_devices_config=vac_control_dev_cfg, read_period=1, name='vac_iface',
+                                           calibrations=self.calibrations)
             self.vac_iface_queue = vac_iface.cmd_queue # queue to push commands
             vac_iface.connect_iface()
             vac_iface.start()
@@ -218,15 +294,39 @@ class RefrigControlsCore():
             #multi_device_calculator:
             multi_dev_cfg = self.device_cfg.pop('multi_devices')
             self.multi_dev_calculator = MultiDeviceCalculator(output_dict=self.values_dict, multi_devices_conf=multi_dev_cfg, 
-                                                              err_queue=self.err_queue, read_period=1, name='multi_dev_calculator')
+                                                              err_queue=self.err_queue, read_period=1, name='multi_dev_calculator',
+                                                              value_events=self.value_events['multi_dev_calculator'])
             self.multi_dev_calculator.start()
 
 
             #auto_control_thread
             self.auto_ctrl_thread = refrigAutoControls(values_dict=self.values_dict, error_queue=self.err_queue, 
-                                                       cmd_func=self.send_command, update_period=1, name='auto_controls')
+                                                       cmd_func=self.send_command, update_period=1, name='auto_controls',
+                                                       value_events=self.value_events['auto_controls'])
             self.auto_ctrl_thread.start()
 
+            #historian:
+            if 'historian' in self.value_events:
+                history_path = self.cur_path.joinpath(self.history_cfg.get('path', 'history'))
+                segment_max_size = int(self.history_cfg.get('segment_max_size', 64) * 2**20)
+                history_store = HistoryStore(history_path, self.values_dict.qualities, segment_max_size=segment_max_size,
+                                             max_total_size=int(self.history_cfg.get('max_total_size', 2048) * 2**20),
+                                             cold_after=self.history_cfg.get('cold_after', None),
+                                             cold_block_size=self.history_cfg.get('cold_block_size', 4096))
+                history_store.log_calibrations(time(), self.device_calibrations) # samples from now on are converted with them
+                tier_stores = {} # downsampled tiers
+                for resolution, max_size in (self.history_cfg.get('rollups', None) or {}).items():
+                    tier_stores[float(resolution)] = HistoryStore(history_path.joinpath(f'rollup_{resolution}s'), self.values_dict.qualities,
+                                                                  segment_max_size=segment_max_size, max_total_size=int(max_size * 2**20),
+                                                                  dtype=rollup_dtype)
+                self.historian = RefrigHistorian(history_store, self.value_events['historian'], self.err_queue,
+                                                 flush_period=self.history_cfg.get('flush_period', 10), name='historian',
+                                                 tier_stores=tier_stores)
+                self.historian.start()
+                self.history_service = HistoryQueryService(self.historian, self.ext_iface.publish, self.err_queue,
+                                                           chunk_rows=self.history_cfg.get('reply_chunk_rows', 2000), name='history_service')
+                self.history_service.start()
+
         except Exception as err:
             raise type(err)(f'init_ifaces: {err}')
 
@@ -248,12 +348,13 @@ class RefrigControlsCore():
 
     def run(self):
         """
-        The function runs a continuous loop that sends data to external interface
+        The function runs a continuous loop that sends changed values to external interface
         and processes any errors that occur.
         """
+        self.next_quality_check = monotonic()
         while True:
             try:
-                self.ext_iface.send(self.values_dict)
+                self.publish_changes()
                 while True:
                     cur_error = self.err_queue.get_nowait()
                     if isinstance(cur_error, dict):
@@ -262,7 +363,6 @@ class RefrigControlsCore():
                     else:
                         self.process_error(cur_error, 0)
             except Empty:
-                sleep(1)
                 continue
             except KeyboardInterrupt:
                 self.stop_app()
@@ -270,6 +370,23 @@ class RefrigControlsCore():
                 self.process_error(err, 1)
 
 
+    def publish_changes(self):
+        """
+        The function `publish_changes` waits for value change events (not longer than the next quality
+        check) and sends the changed values to external interface. All values are passed to it every
+        `quality_check_period`, so values which became stale are reported without any events and
+        unchanged values get their heartbeat (external interface filters what is really published).
+        """
+        events = self.value_events['ext_iface'].get(timeout=max(self.next_quality_check - monotonic(), 0))
+        if events is None: # events were lost, send everything
+            self.ext_iface.send_values(self.values_dict.snapshot_records())
+        elif events:
+            self.ext_iface.send_values(self.values_dict.get_records(events))
+        if monotonic() >= self.next_quality_check:
+            self.ext_iface.send_values(self.values_dict.snapshot_records())
+            self.next_quality_check = monotonic() + self.quality_check_period
+
+
     def send_command(self, dev_name:str, cmd):
         """
         The `send_command` function is used to send commands to different devices and handle any errors
@@ -288,6 +405,9 @@ class RefrigControlsCore():
             if dev_name == 'State': # GUI/UI sent command to set app state
                 self.update_state(cmd)
                 return
+            if dev_name == 'Metrics': # GUI/UI requested interfaces metrics (bus timing, health)
+                self.ext_iface.send({'Metrics':json.dumps(self.get_metrics())})
+                return
             iface_name = self.dev_iface_rel.get(dev_name, None)
             if iface_name is None:
                 raise AttributeError(f'unknown device {dev_name}')
@@ -300,6 +420,34 @@ class RefrigControlsCore():
             self.process_error(type(err)(f'RefrigControlsCore.send_command: {err}'))
         
 
+    def process_history_request(self, request:dict):
+        """
+        The function `process_history_request` passes a history request from external interface to the
+        history query service.
+
+        :param request: The `request` parameter is a dictionary {'id', 'devices', 'start', 'end', 'max_points'}
+        :type request: dict
+        """
+        try:
+            if self.history_service is None:
+                raise AttributeError(f'history is not recorded (see history section of config)')
+            self.history_service.submit(request)
+        except Exception as err:
+            self.process_error(type(err)(f'RefrigControlsCore.process_history_request: {err}'))
+
+
+    def get_metrics(self):
+        """
+        The function `get_metrics` returns a snapshot of interfaces metrics: bus transaction latency
+        percentiles, timeouts, retries, scan durations and overruns, bus health, historian counters.
+        :return: a dictionary {iface_name: metrics}.
+        """
+        metrics = dict(self.metrics_dict)
+        if self.historian is not None:
+            metrics['historian'] = self.historian.get_metrics()
+        return metrics
+
+
     #state and status
     def update_status(self, new_status, log_status=True):
         """
@@ -374,6 +522,9 @@ class RefrigControlsCore():
 
     def stop_app(self):
         try:
+            if self.historian is not None:
+                self.historian.stop(timeout=30) # pending samples and open buckets are written by the historian thread
+            self.values_dict.close()
             exit()
         except Exception as err:
             self.process_error(err, 1)
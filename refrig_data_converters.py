@@ -1,146 +1,437 @@
 from abc import ABC, abstractmethod
-import struct
 from pathlib import Path
-from math import sqrt
+from math import sqrt, isfinite, factorial
+
+import numpy as np
+
+from refrig_calibration import CalibrationRegistry, load_calibrations
+
+
+# conversion is compiled once per device at interface init: every converter makes a function with the parameters
+# of the device (from its config) bound in, read/write loops call the function of a device for every value;
+# whole scans can be converted at once by a BatchConverter (one numpy pass per converter type, same results as
+# the functions of the devices bit for bit: same operations in the same order, polynomials by Horner's rule)
+
+
+def pass_value(value): # no conversion
+    return value
 
 
 #to-be-called converter
 class RefrigDataConverter():
-    def __init__(self, core_path: Path | str) -> None:
+    def __init__(self, core_path: Path | str, calibrations: CalibrationRegistry | None = None) -> None:
+        # calibrations are loaded by the core once and shared, loaded here (from cache) if they are not given
         self.default_converter = DefaultConverter()
         self.valve_converter = ValveConverter()
         self.pressure_converter = PressureConverter()
-        self.si_temp_converter = SiliconTemperatureConverter(core_path)
-
-    
-    def read_data_convert(self, converter_type, dev_name, value):
-        match converter_type:
-            case 'Valve':
-                return self.valve_converter.read_data_convert(dev_name, value)
-            case 'Pressure':
-                return self.pressure_converter.read_data_convert(dev_name, value)
-            case 'SiTemp':
-                return self.si_temp_converter.read_data_convert(dev_name, value)
-            case _:
-                return self.default_converter.read_data_convert(dev_name, value)
-            
-
-    def write_data_convert(self, converter_type, dev_name, value):
-        match converter_type:
-            case 'Valve':
-                return self.valve_converter.write_data_convert(dev_name, value)
-            case _:
-                return self.default_converter.write_data_convert(dev_name, value)
+        self.si_temp_converter = SiliconTemperatureConverter(calibrations if calibrations is not None else load_calibrations(core_path))
+        self.converters = {'Valve':self.valve_converter, 'Pressure':self.pressure_converter, 'SiTemp':self.si_temp_converter}
+
+
+    def get_converter(self, dev_conf:dict):
+        return self.converters.get(dev_conf.get('converter_type', 'Default'), self.default_converter)
+
+
+    def compile_read(self, devices_config:dict):
+        """
+        The function `compile_read` makes conversion functions for values coming FROM devices.
+
+        :param devices_config: The `devices_config` parameter is a dictionary {dev_name: dev_conf} (dev_conf
+        can be None), `converter_type` and converter parameters are taken from it
+        :return: a dictionary {dev_name: function(raw value) -> value}.
+        """
+        try:
+            read_funcs = {}
+            for dev_name, dev_conf in devices_config.items():
+                dev_conf = dev_conf if isinstance(dev_conf, dict) else {}
+                read_funcs[dev_name] = self.get_converter(dev_conf).make_read_func(dev_name, dev_conf)
+            return read_funcs
+        except Exception as err:
+            raise type(err)(f'RefrigDataConverter.compile_read: {err}')
+
+
+    def compile_write(self, devices_config:dict):
+        """
+        The function `compile_write` makes conversion functions for commands going TO devices.
+
+        :param devices_config: The `devices_config` parameter is a dictionary {dev_name: dev_conf} (dev_conf
+        can be None)
+        :return: a dictionary {dev_name: function(value) -> command value}.
+        """
+        try:
+            write_funcs = {}
+            for dev_name, dev_conf in devices_config.items():
+                dev_conf = dev_conf if isinstance(dev_conf, dict) else {}
+                write_funcs[dev_name] = self.get_converter(dev_conf).make_write_func(dev_name, dev_conf)
+            return write_funcs
+        except Exception as err:
+            raise type(err)(f'RefrigDataConverter.compile_write: {err}')
+
+
+    def compile_batch(self, devices_config:dict):
+        """
+        The function `compile_batch` makes a batch converter of values coming FROM devices.
+
+        :param devices_config: The `devices_config` parameter is a dictionary {dev_name: dev_conf} (dev_conf
+        can be None)
+        :return: a `BatchConverter` object.
+        """
+        try:
+            converters = [self.default_converter] + list(self.converters.values())
+            dev_converters, param_rows, params, raw_ranges = [], [], [[] for _ in converters], []
+            for dev_name, dev_conf in devices_config.items():
+                dev_conf = dev_conf if isinstance(dev_conf, dict) else {}
+                converter_idx = converters.index(self.get_converter(dev_conf))
+                dev_converters.append(converter_idx)
+                param_rows.append(len(params[converter_idx]))
+                params[converter_idx].append(converters[converter_idx].batch_params(dev_name, dev_conf))
+                raw_ranges.append(converters[converter_idx].raw_range(dev_name, dev_conf) or (-np.inf, np.inf))
+            return BatchConverter(list(devices_config), self.compile_read(devices_config), converters, dev_converters,
+                                  param_rows, params, raw_ranges)
+        except Exception as err:
+            raise type(err)(f'RefrigDataConverter.compile_batch: {err}')
+
+
+class BatchConverter():
+    '''
+    vectorized conversion of values of a fixed set of devices: device parameters are stacked to one table per
+    converter type, a batch of raw values is converted with a vector of device indexes
+    '''
+
+    max_plans = 64
+
+    def __init__(self, dev_names:list, read_funcs:dict, converters:list, dev_converters:list, param_rows:list, params:list,
+                 raw_ranges:list) -> None:
+        self.dev_indexes = {dev_name:idx for idx, dev_name in enumerate(dev_names)}
+        self.read_funcs = read_funcs
+        self.converters = converters
+        self.dev_converters = np.array(dev_converters, dtype=np.intp) # converter of every device
+        self.param_rows = np.array(param_rows, dtype=np.intp) # row of every device in the table of its converter
+        self.params = [np.array(rows, dtype=np.float64).reshape(len(rows), -1) if rows else None for rows in params]
+        self.raw_lo, self.raw_hi = np.array(raw_ranges, dtype=np.float64).reshape(-1, 2).T # raw values out of it are out_of_range
+        self.plans = {} # conversion plans of device index vectors
+
+
+    def get_plan(self, dev_idx):
+        # positions of values and parameter rows per converter, the same scans come again and again
+        key = dev_idx.tobytes()
+        plan = self.plans.get(key, None)
+        if plan is None:
+            if len(self.plans) >= self.max_plans:
+                self.plans.clear()
+            dev_converters = self.dev_converters[dev_idx]
+            plan = []
+            for converter_idx in np.unique(dev_converters).tolist():
+                if converter_idx == 0: # default, no conversion
+                    continue
+                positions = np.flatnonzero(dev_converters == converter_idx)
+                plan.append((self.converters[converter_idx], positions, self.params[converter_idx][self.param_rows[dev_idx[positions]]]))
+            self.plans[key] = plan
+        return plan
+
+
+    def get_indexes(self, dev_names:list):
+        return np.array([self.dev_indexes[dev_name] for dev_name in dev_names], dtype=np.intp)
+
+
+    def convert(self, raw_values, dev_idx):
+        """
+        The function `convert` converts a batch of raw values in one numpy pass per converter type.
+
+        :param raw_values: The `raw_values` parameter is a sequence of raw values (numbers)
+        :param dev_idx: The `dev_idx` parameter is a numpy array of device indexes of the values (`get_indexes`)
+        :return: a numpy float64 array of converted values, NaN or inf where the function of the device raises an error.
+        """
+        raw_values = np.asarray(raw_values, dtype=np.float64)
+        values = raw_values.copy()
+        with np.errstate(all='ignore'):
+            for converter, positions, params in self.get_plan(np.asarray(dev_idx, dtype=np.intp)):
+                values[positions] = converter.convert_batch(raw_values[positions], params)
+        return values
+
+
+    def check_ranges(self, raw_values:dict):
+        """
+        The function `check_ranges` finds raw values outside of the ranges their conversion is valid for
+        (e.g. calibrated range of a thermometer).
+
+        :param raw_values: The `raw_values` parameter is a dictionary {dev_name: raw value}
+        :return: a list of device names.
+        """
+        dev_names = list(raw_values)
+        dev_idx = self.get_indexes(dev_names)
+        values = np.asarray(list(raw_values.values()), dtype=np.float64)
+        out_of_range = ~((values >= self.raw_lo[dev_idx]) & (values <= self.raw_hi[dev_idx]))
+        return [dev_names[idx] for idx in np.flatnonzero(out_of_range)]
+
+
+    def convert_dict(self, raw_values:dict):
+        """
+        The function `convert_dict` converts raw values of a scan, values which are not finite after the batch
+        conversion are converted again by the function of their device (to get its result or its error).
+
+        :param raw_values: The `raw_values` parameter is a dictionary {dev_name: raw value}
+        :return: a dictionary {dev_name: value or exception}.
+        """
+        dev_names = list(raw_values)
+        values = self.convert(list(raw_values.values()), self.get_indexes(dev_names))
+        results = dict(zip(dev_names, values.tolist()))
+        for idx in np.flatnonzero(~np.isfinite(values)):
+            dev_name = dev_names[idx]
+            try:
+                results[dev_name] = self.read_funcs[dev_name](raw_values[dev_name])
+            except Exception as err:
+                results[dev_name] = err
+        return results
 
 
 #Default converter
 class DefaultConverter():
 
-    def read_data_convert(self, dev_name, value): # convert data coming FROM device (with special cases)
-        return value
+    def make_read_func(self, dev_name:str, dev_conf:dict): # convert data coming FROM device
+        return pass_value
+
+
+    def make_write_func(self, dev_name:str, dev_conf:dict): # convert commands coming TO device
+        return pass_value
+
+
+    def batch_params(self, dev_name:str, dev_conf:dict): # parameters of a device for batch conversion
+        return ()
 
 
-    def write_data_convert(self, dev_name, value): # convert commands coming TO device
-        return value
-    
+    def raw_range(self, dev_name:str, dev_conf:dict): # (min, max) of raw values the conversion is valid for, None - any
+        return None
+
+
+    def convert_batch(self, values, params): # values - numpy array, params - parameters of their devices (one row per value)
+        return values
+
 
 #VALVES
 class ValveConverter(DefaultConverter):
+    '''
+    valve position, %; `invert: true` in the device config - position is 100 - value (valve is mounted reversed)
+    '''
 
     acc_range = [-2, 102] # range of acceptance [lower_bound, upper_bound]
 
-    def read_data_convert(self, dev_name, value):
-        try:
-            match dev_name:
-                case 'V13':
-                    value = 100 - value
-                    value = self.border_value_correct(value)
-                case _:
-                    value = self.border_value_correct(value)
-            return value
-        except Exception as err:
-            raise type(err)(f'ValveConverter for {dev_name}: {err}')
-
-
-    def border_value_correct(self, value):
+    def make_read_func(self, dev_name:str, dev_conf:dict):
         '''
-        valves can return values slightly outside of (0,100) range 
+        valves can return values slightly outside of (0,100) range
         due to calibration errors
         correct those values to avoid user confusion;
         values that are far outside of this range are not touched, so
         they can be treated as incorrect
         '''
-        if value<0 and value > self.acc_range[0]:
-            value = 0
-        elif value>100 and value < self.acc_range[1]:
-            value = 100
-        return value
-    
+        lower_bound, upper_bound = self.acc_range
+        invert = bool(dev_conf.get('invert', False))
+        def read_convert(value):
+            try:
+                if invert:
+                    value = 100 - value
+                if value<0 and value > lower_bound:
+                    value = 0
+                elif value>100 and value < upper_bound:
+                    value = 100
+                return value
+            except Exception as err:
+                raise type(err)(f'ValveConverter for {dev_name}: {err}')
+        return read_convert
+
+
+    def make_write_func(self, dev_name:str, dev_conf:dict):
+        if dev_conf.get('invert', False):
+            return lambda value: 100 - value
+        return pass_value
 
-    def write_data_convert(self, dev_name, value):
-        if dev_name == 'V13':
-            value = 100 - value
-        return value
+
+    def batch_params(self, dev_name:str, dev_conf:dict):
+        return (float(bool(dev_conf.get('invert', False))),)
+
+
+    def convert_batch(self, values, params):
+        values = np.where(params[:, 0] != 0, 100 - values, values)
+        values = np.where((values < 0) & (values > self.acc_range[0]), 0, values)
+        return np.where((values > 100) & (values < self.acc_range[1]), 100, values)
 
 
 #PRESSURES
 class PressureConverter(DefaultConverter):
+    '''
+    pressure = value * scale + offset, rounded to `decimals` (device config parameters, null - not rounded);
+    defaults are for keller sensors: absolute bar to relative bar, 2 decimals
+    '''
 
-    def read_data_convert(self, dev_name, value):
-        try:
-            match dev_name:
-                case 'Pvac1' | 'Pvac2':
-                    value*=1000
-                case 'P2':
-                    value+=12
-                case _:
-                    value = self.pressure_to_dec(value)
-                    value = round(value,2)
-            return value
-        except Exception as err:
-            raise type(err)(f'PressureConverter for {dev_name}: {err}')
-    
+    scale = 1
+    offset = -1
+    decimals = 2
+
+    def get_params(self, dev_conf:dict):
+        # scale, offset and rounding factor (0 - not rounded)
+        decimals = dev_conf.get('decimals', self.decimals)
+        return float(dev_conf.get('scale', self.scale)), float(dev_conf.get('offset', self.offset)), \
+               0.0 if decimals is None else 10.0 ** decimals
+
+
+    def make_read_func(self, dev_name:str, dev_conf:dict):
+        scale, offset, factor = self.get_params(dev_conf)
+        def read_convert(value):
+            try:
+                value = value * scale + offset
+                return round(value * factor) / factor if factor and isfinite(value) else value # half to even, as np.rint
+            except Exception as err:
+                raise type(err)(f'PressureConverter for {dev_name}: {err}')
+        return read_convert
+
+
+    def batch_params(self, dev_name:str, dev_conf:dict):
+        return self.get_params(dev_conf)
+
+
+    def convert_batch(self, values, params):
+        scale, offset, factor = params[:, 0], params[:, 1], params[:, 2]
+        values = values * scale + offset
+        rounded = np.rint(values * factor) / np.where(factor != 0, factor, 1) + 0.0 # + 0.0: -0.0 is 0.0 as in the scalar path
+        return np.where(factor != 0, rounded, values)
 
-    def pressure_to_dec(self, raw_data):
-        '''
-        transform keller pressure sensors to float decimal
-        '''
-        data = struct.unpack('!f',struct.pack('!I', int(raw_data[0:32], 2)))[0]
-        data -=1
-        # data *= 1000 # bar to mbar
-        return data
 
-    
 #SiliconThermometry
 class SiliconTemperatureConverter(DefaultConverter):
-    def __init__(self, core_path:str | Path) -> None:
-        try:
-            self.si_therm_data = {}
-            si_data_path = Path(core_path).joinpath('data', 'silicon_thermometry')
-            for cur_file_name in list(si_data_path.iterdir()):
-                cur_file = open(si_data_path.joinpath(cur_file_name), 'r')
-                cur_sensor_name = cur_file.readline().split()[0]
-                cur_sens_coefs = []
-                while True:
-                    cur_line = cur_file.readline()
-                    if len(cur_line) == 0:
-                        break
-                    cur_sens_coefs.append(float(cur_line.split('=')[-1]))
-                cur_file.close()
-                self.si_therm_data.update({cur_sensor_name: cur_sens_coefs})
-        except Exception as err:
-            raise type(err)(f'SiliconTemperatureConverter init: {err}')
-        
+    '''
+    resistance to temperature (K): polynomial in 1000/R with coefficients of the thermometer calibration
+    (data/silicon_thermometry, `calibration` in the device config - name of the calibration, defaults to the
+    device name), devices without calibration are converted with the platinum thermometer formula;
+    inside the calibrated range (measured points of data/raw/*.TAB) the polynomial is replaced by a table
+    linearly interpolated in 1000/R, its error is below `table_error` (K, device config), raw values outside
+    of the calibrated range are converted by the polynomial and reported as out_of_range;
+    coefficients and ranges come from the calibration registry (refrig_calibration)
+    '''
 
-    def read_data_convert(self, dev_name, value):
-        try:
-            if dev_name not in self.si_therm_data.keys():
-                T = round(-(sqrt((-0.00232 * value) + 17.59246) - 3.908) / 0.00116, 3)
-                T += 273.15
+    table_error = 1e-4 # K
+
+    def __init__(self, calibrations:CalibrationRegistry) -> None:
+        self.calibrations = calibrations
+        self.tables = {} # {(calibration, table_error): table}
+        self.flat_tables = [np.empty(0)] * 3 # x, T and slope of all tables (batch conversion)
+
+
+    def get_table(self, calibration, table_error:float):
+        """
+        The function `get_table` builds the interpolation table of a calibration (once per calibration and
+        error). The grid step comes from the error bound of linear interpolation h**2 / 8 * max|T''|, max|T''|
+        is bounded on short intervals by the (exact, T is a polynomial) Taylor expansion at their centers.
+
+        :param calibration: The `calibration` parameter is a `Calibration` of the registry
+        :return: a tuple (x_lo, x_hi, 1 / step, x, T, slope, offset in flat tables) or None if the calibrated
+        range is not known.
+        """
+        key = (calibration.name, table_error)
+        if key not in self.tables:
+            r_range = calibration.r_range
+            if r_range is None or not table_error:
+                self.tables[key] = None
+                return None
+            K = np.array(calibration.coefs, dtype=np.float64)
+            x_lo, x_hi = 1000.0 / r_range[1], 1000.0 / r_range[0]
+            edges = np.linspace(x_lo, x_hi, 257)
+            centers, radius = (edges[:-1] + edges[1:]) / 2, (edges[1] - edges[0]) / 2
+            d2_bound = np.zeros(len(centers))
+            deriv = np.polynomial.polynomial.polyder(K, 2)
+            for j in range(len(deriv)):
+                d2_bound += np.abs(np.polynomial.polynomial.polyval(centers, deriv)) * radius ** j / factorial(j)
+                deriv = np.polynomial.polynomial.polyder(deriv)
+            max_step = sqrt(8 * table_error / max(d2_bound.max(), 1e-12))
+            num_points = int(np.ceil((x_hi - x_lo) / max_step)) + 1
+            step = (x_hi - x_lo) / (num_points - 1)
+            x = x_lo + np.arange(num_points) * step
+            T = np.full(num_points, K[6])
+            for k in range(5, -1, -1):
+                T = T * x + K[k]
+            slope = np.diff(T) / np.diff(x)
+            slope = np.append(slope, slope[-1])
+            offset = len(self.flat_tables[0])
+            self.flat_tables = [np.concatenate([flat, column]) for flat, column in zip(self.flat_tables, (x, T, slope))]
+            self.tables[key] = (x_lo, x_hi, 1 / step, x, T, slope, offset)
+        return self.tables[key]
+
+
+    def get_calibration(self, dev_name:str, dev_conf:dict):
+        # coefficients and interpolation table of a device (None if it has no calibration)
+        calibration = self.calibrations.get(dev_conf.get('calibration', dev_name))
+        if calibration is None:
+            return None, None
+        return calibration.coefs, self.get_table(calibration, dev_conf.get('table_error', self.table_error))
+
+
+    def raw_range(self, dev_name:str, dev_conf:dict):
+        calibration = self.calibrations.get(dev_conf.get('calibration', dev_name))
+        return None if calibration is None else calibration.r_range
+
+
+    def make_read_func(self, dev_name:str, dev_conf:dict):
+        K, table = self.get_calibration(dev_name, dev_conf)
+        if K is None:
+            def read_convert(value):
+                try:
+                    T = round(-(sqrt((-0.00232 * value) + 17.59246) - 3.908) / 0.00116 * 1000) / 1000 # mK, half to even
+                    T += 273.15
+                    return T
+                except Exception as err:
+                    raise type(err)(f'SiliconTemperatureConverter for {dev_name}: {err}')
+            return read_convert
+        K0, K1, K2, K3, K4, K5, K6 = K
+        if table is None:
+            def read_convert(value):
+                try:
+                    x = 1000.0 / value
+                    T = (((((K6 * x + K5) * x + K4) * x + K3) * x + K2) * x + K1) * x + K0
+                    return T
+                except Exception as err:
+                    raise type(err)(f'SiliconTemperatureConverter for {dev_name}: {err}')
+            return read_convert
+        x_lo, x_hi, inv_step, x_tab, T_tab, slope_tab, _ = table
+        x_tab, T_tab, slope_tab = x_tab.tolist(), T_tab.tolist(), slope_tab.tolist()
+        last = len(x_tab) - 2
+        def read_convert(value):
+            try:
+                x = 1000.0 / value
+                if x_lo <= x <= x_hi: # calibrated range
+                    idx = min(int((x - x_lo) * inv_step), last)
+                    return T_tab[idx] + (x - x_tab[idx]) * slope_tab[idx]
+                T = (((((K6 * x + K5) * x + K4) * x + K3) * x + K2) * x + K1) * x + K0
                 return T
-            K = self.si_therm_data[dev_name]
-            T = K[0] + K[1] * (1000.0 / value) + K[2] * (1000.0 / value) ** 2 + K[3] * (1000.0 / value) ** 3 + K[4] * (
-                        1000.0 / value) ** 4 + K[5] * (1000.0 / value) ** 5 + K[6] * (1000.0 / value) ** 6
+            except Exception as err:
+                raise type(err)(f'SiliconTemperatureConverter for {dev_name}: {err}')
+        return read_convert
+
+
+    def batch_params(self, dev_name:str, dev_conf:dict):
+        # mode (0 - platinum formula, 1 - polynomial, 2 - table inside calibrated range), polynomial coefficients,
+        # table: x_lo, x_hi, 1 / step, offset in flat tables, last index
+        K, table = self.get_calibration(dev_name, dev_conf)
+        if K is None:
+            return (0.0,) + (0.0,) * 12
+        if table is None:
+            return (1.0,) + tuple(K) + (0.0,) * 5
+        x_lo, x_hi, inv_step, x_tab, _, _, offset = table
+        return (2.0,) + tuple(K) + (x_lo, x_hi, inv_step, float(offset), float(len(x_tab) - 2))
+
+
+    def convert_batch(self, values, params):
+        mode = params[:, 0]
+        x = 1000.0 / values
+        T = params[:, 7]
+        for k in range(6, 0, -1):
+            T = T * x + params[:, k]
+        tabulated = (mode == 2) & (x >= params[:, 8]) & (x <= params[:, 9])
+        if tabulated.any():
+            x_tab, T_tab, slope_tab = self.flat_tables
+            x_in = x[tabulated]
+            idx = np.clip((x_in - params[tabulated, 8]) * params[tabulated, 10], 0, params[tabulated, 12]).astype(np.intp)
+            idx += params[tabulated, 11].astype(np.intp)
+            T[tabulated] = T_tab[idx] + (x_in - x_tab[idx]) * slope_tab[idx]
+        if (mode != 0).all():
             return T
-        except Exception as err:
-            raise type(err)(f'SiliconTemperatureConverter for {dev_name}: {err}')
\ No newline at end of file
+        T_pt = np.rint(-(np.sqrt((-0.00232 * values) + 17.59246) - 3.908) / 0.00116 * 1000) / 1000 + 273.15
+        return np.where(mode != 0, T, T_pt)
@@ -1,22 +1,28 @@
 # test classes for debugging without device connections
 # random values are returned
+# (to run the real interfaces without hardware use simulated devices from refrig_simulator.py)
 from multiprocessing import Queue
 from queue import Empty
-from refrig_comm_ifaces import BaseInterface
+from refrig_comm_ifaces import BaseInterface, MultiDeviceCalculator
 from refrig_data_converters import RefrigDataConverter
-from time import sleep
+from refrig_modbus_codec import get_codec
+from refrig_value_table import SharedValueTable
+from time import sleep, monotonic
+import sys
+import math
+import struct
 
-from random import uniform
+from random import Random, uniform
 
 
 class ModbusComInterface(BaseInterface):
     def __init__(self, core_path, output_dict, err_queue:Queue, modbus_con_info:dict, read_devices_config:dict, 
-                 control_devices_config: dict, read_period = .5, name: str | None = None, ) -> None:
+                 control_devices_config: dict, read_period = .5, name: str | None = None, metrics_dict = None, calibrations = None) -> None:
         try:
-            super().__init__(output_dict=output_dict, err_queue=err_queue, read_period=read_period, name=name)
+            super().__init__(output_dict=output_dict, err_queue=err_queue, read_period=read_period, name=name, metrics_dict=metrics_dict)
             self.output_dict = output_dict
             self.cmd_queue = Queue(maxsize=10)
-            self.data_converter = RefrigDataConverter(core_path)
+            self.data_converter = RefrigDataConverter(core_path, calibrations)
             self.read_dev_conf = read_devices_config
             self.control_dev_conf = control_devices_config
         except Exception as err:
@@ -63,7 +69,7 @@ class ModbusComInterface(BaseInterface):
                     dev_values.update({dev_name:None})
                     self.process_error(f'read_devices: {err}')
                     continue
-            self.output_dict.update(dev_values)
+            self.publish_values(dev_values, 'substituted') # random values, not measured
         except Exception as err:
             raise type(err)(f'read_devices: {err}')
         
@@ -74,19 +80,20 @@ class ModbusComInterface(BaseInterface):
 
 class ModbusRtuOverTcpComInterface(ModbusComInterface): # no control devices only sensors
     def __init__(self, core_path, output_dict, err_queue:Queue, modbus_con_info:dict, read_devices_config:dict, 
-                 read_period = .5, name: str | None = None, ) -> None:
+                 read_period = .5, name: str | None = None, metrics_dict = None, calibrations = None) -> None:
         super().__init__(core_path=core_path, output_dict=output_dict, err_queue=err_queue, modbus_con_info=modbus_con_info, 
-                            read_devices_config=read_devices_config, control_devices_config={}, read_period=read_period, name=name)
+                            read_devices_config=read_devices_config, control_devices_config={}, read_period=read_period, name=name,
+                            metrics_dict=metrics_dict, calibrations=calibrations)
 
     def connect_iface(self):
         print('ModbusTcpTestInterface:connect_iface called')
 
 
 class TurbineComInterface(ModbusComInterface):
-    def __init__(self, core_path, output_dict, err_queue: Queue, con_info: dict, read_devices_config: dict, control_devices_config: dict, read_period=0.5, name: str | None = None) -> None:
+    def __init__(self, core_path, output_dict, err_queue: Queue, con_info: dict, read_devices_config: dict, control_devices_config: dict, read_period=0.5, name: str | None = None, metrics_dict = None, calibrations = None) -> None:
         super().__init__(core_path=core_path, output_dict=output_dict, err_queue=err_queue, modbus_con_info=con_info, 
                          read_devices_config=read_devices_config, control_devices_config=control_devices_config, 
-                         read_period=read_period, name=name)
+                         read_period=read_period, name=name, metrics_dict=metrics_dict, calibrations=calibrations)
 
 
     def connect_iface(self):
@@ -94,10 +101,108 @@ class TurbineComInterface(ModbusComInterface):
 
 
 class MqttComInterface(ModbusComInterface):
-    def __init__(self, core_path, output_dict, err_queue: Queue, con_info: dict, read_devices_config: dict, control_devices_config: dict, read_period=0.5, name: str | None = None) -> None:
+    def __init__(self, core_path, output_dict, err_queue: Queue, con_info: dict, read_devices_config: dict, control_devices_config: dict, read_period=0.5, name: str | None = None, calibrations = None) -> None:
         super().__init__(core_path=core_path, output_dict=output_dict, err_queue=err_queue, modbus_con_info=con_info, 
                          read_devices_config=read_devices_config, control_devices_config=control_devices_config, 
-                         read_period=read_period, name=name)
+                         read_period=read_period, name=name, calibrations=calibrations)
         
     def connect_iface(self):
-        print('MqttComInterface:connect_iface called')
\ No newline at end of file
+        print('MqttComInterface:connect_iface called')
+
+
+#modbus codec compatibility check against the old bit-string path
+def legacy_modbus_to_dec(reg1, reg2):
+    raw_value = '{0:016b}'.format(reg1) + '{0:016b}'.format(reg2)
+    raw_value = f'{raw_value[24:]}{raw_value[16:24]}{raw_value[8:16]}{raw_value[0:8]}' #reverse bytes
+    sign = int(raw_value[0])
+    exp = int(raw_value[1:9], 2)
+    mant = int(raw_value[9:], 2)
+    return ((-1) ** sign) * (2 ** (exp - 127)) * (1 + (mant / 2 ** 23))
+
+
+def legacy_val_to_modbus(val):
+    hex_str = struct.pack('!f', val).hex()
+    return int(f'{hex_str[2:4]}{hex_str[0:2]}', 16), int(f'{hex_str[6:8]}{hex_str[4:6]}', 16)
+
+
+# words of exponent 0 (zero, denormals) and 255 (inf, NaN): the old path didn't follow IEEE754 for them,
+# documented differences {word: (old value, new value)}
+codec_edge_words = {
+    0x00000000: (2.0**-127, 0.0),
+    0x80000000: (-2.0**-127, -0.0),
+    0x00000001: (2.0**-127 * (1 + 2.0**-23), 2.0**-149),
+    0x007fffff: (2.0**-127 * (2 - 2.0**-23), (2**23 - 1) * 2.0**-149),
+    0x80000001: (-2.0**-127 * (1 + 2.0**-23), -2.0**-149),
+    0x7f800000: (2.0**128, math.inf),
+    0xff800000: (-2.0**128, -math.inf),
+    0x7fc00000: (2.0**128 * 1.5, math.nan),
+    0x7f800001: (2.0**128 * (1 + 2.0**-23), math.nan),
+    0xffffffff: (-2.0**128 * (2 - 2.0**-23), math.nan),
+}
+# normal floats at the limits, old and new values must be the same
+codec_normal_words = [0x00800000, 0x80800000, 0x7f7fffff, 0xff7fffff, 0x3f800000, 0xbf800000, 0x40490fdb]
+
+
+def check_modbus_codec(num_random = 100000, seed = 20240501):
+    """
+    Compares ModbusValueCodec with the old bit-string decoding/encoding (deterministic: random words
+    are generated from a fixed seed). Normal floats must be decoded and encoded exactly as before.
+    Edge words (exponent 0 or 255) must give the documented old and new values of `codec_edge_words`.
+    Returns a list of mismatches.
+    """
+    read_codec = get_codec('float32', word_order='little', byte_order='little')
+    write_codec = get_codec('float32', word_order='big', byte_order='little')
+    rng = Random(seed)
+    same = lambda val1, val2: (math.isnan(val1) and math.isnan(val2)) or (val1 == val2 and math.copysign(1, val1) == math.copysign(1, val2))
+    mismatches = []
+    # random normal floats: any sign and mantissa, exponent 1..254
+    words = codec_normal_words + [(rng.randrange(2) << 31) | (rng.randrange(1, 255) << 23) | rng.randrange(2**23) for _ in range(num_random)]
+    for word in words + list(codec_edge_words):
+        reg1, reg2 = struct.unpack('>HH', struct.pack('<I', word)) # registers as sent by the device
+        old_val, new_val = legacy_modbus_to_dec(reg1, reg2), read_codec.decode([reg1, reg2])[0]
+        if word in codec_edge_words:
+            doc_old_val, doc_new_val = codec_edge_words[word]
+            if not same(old_val, doc_old_val) or not same(new_val, doc_new_val):
+                mismatches.append(('edge decode', hex(word), (doc_old_val, doc_new_val), (old_val, new_val)))
+        elif not same(old_val, new_val):
+            mismatches.append(('decode', hex(word), old_val, new_val))
+        if tuple(write_codec.encode([new_val])) != legacy_val_to_modbus(new_val): # struct based, IEEE754 for all values
+            mismatches.append(('encode', hex(word), legacy_val_to_modbus(new_val), write_codec.encode([new_val])))
+    return mismatches
+
+
+#multi devices must stay fresh while their components are constant (no change events) and other devices change
+def check_multi_device_freshness(duration:float = 2, read_period:float = .2):
+    """
+    Runs MultiDeviceCalculator in this process on a value table where P5a and P5d are rewritten with
+    constant values and P1 changes with every write, H1 (P5d - P5a) must stay good.
+    Returns a list of failures.
+    """
+    table = SharedValueTable(['P5a', 'P5d', 'P1', 'H1'], sources=['check', 'multi_dev_calculator'], default_stale_after=3 * read_period)
+    calculator = MultiDeviceCalculator(output_dict=table, multi_devices_conf={'H1':['P5d', 'P5a']}, err_queue=Queue(),
+                                       read_period=read_period, name='multi_dev_calculator',
+                                       value_events=table.subscribe('multi_dev_calculator'))
+    failures = []
+    try:
+        start = monotonic()
+        while monotonic() - start < duration:
+            table.update({'P5a':1.0, 'P5d':3.0, 'P1':monotonic() - start}, source='check')
+            calculator.recalculate(calculator.wait_changes())
+            record = table.get_record('H1')
+            if record is None or record[0] != 2.0 or record[2] != 'good':
+                failures.append(('H1', round(monotonic() - start, 3), record))
+            sleep(read_period / 10)
+    finally:
+        table.close()
+    return failures
+
+
+if __name__ == '__main__':
+    failed = False
+    for check in (check_modbus_codec, check_multi_device_freshness):
+        failures = check()
+        print(f'{check.__name__}: {"OK" if not failures else f"{len(failures)} failures"}')
+        for failure in failures[:20]:
+            print(f'    {failure}')
+        failed = failed or bool(failures)
+    sys.exit(1 if failed else 0)
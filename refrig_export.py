@@ -0,0 +1,228 @@
+# export of recorded history (refrig_historian) for post-run analysis, to Parquet (needs pyarrow) or CSV:
+# python refrig_export.py run.parquet --devices Turb1_Freq Turb1_TBearing --start 2026-10-01T08:00 --end 2026-10-01T20:00
+# samples are streamed device by device in chunks (raw segments are memory-mapped, cold files are decoded block by block)
+# and written as row groups, memory use doesn't depend on the size of the export;
+# --resolution N exports the N seconds rollup tier (min/max/mean/last/count per bucket) instead of raw samples.
+# Times without UTC offset are local times, samples not flushed by the running historian yet are not exported.
+import argparse
+import csv
+import json
+import sys
+from datetime import datetime
+from itertools import repeat
+from pathlib import Path
+from time import perf_counter, time
+
+import numpy as np
+
+from refrig_historian import HistoryStore
+
+
+def get_history_path(cfg_path:Path):
+    # history directory from the core configuration (relative to the core directory)
+    import yaml
+    try:
+        with open(cfg_path, 'r') as stream:
+            history_cfg = dict(yaml.safe_load(stream)).get('history', None) or {}
+    except FileNotFoundError:
+        history_cfg = {}
+    return cfg_path.parent.joinpath(history_cfg.get('path', 'history'))
+
+
+def open_history(path, resolution:str | None = None):
+    """
+    The function `open_history` opens recorded history for reading, record layout and quality codes
+    are taken from the schema stored with the history.
+
+    :param path: The `path` parameter is the history directory
+    :param resolution: The `resolution` parameter is the bucket size (seconds) of a rollup tier, None - raw samples
+    :return: a HistoryStore.
+    """
+    try:
+        path = Path(path)
+        if resolution is not None:
+            path = path.joinpath(f'rollup_{resolution}s')
+        schema_path = path.joinpath('schema.json')
+        if not schema_path.exists():
+            raise FileNotFoundError(f'no recorded history at {path}')
+        schema = json.loads(schema_path.read_text())
+        return HistoryStore(path, schema['qualities'], dtype=[tuple(field) for field in schema['record']])
+    except Exception as err:
+        raise type(err)(f'open_history: {err}')
+
+
+def parse_time(text:str):
+    # unix time or ISO 8601 date/time (local time if there is no UTC offset)
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+def iter_chunks(store:HistoryStore, dev_names:list, t_start:float, t_end:float, chunk_rows:int):
+    """
+    The function `iter_chunks` streams records of devices in a time range.
+
+    :return: a generator of (device name, numpy array of the store's dtype), device by device in time order.
+    """
+    for dev_name in dev_names:
+        for records in store.iter_query(dev_name, t_start, t_end, chunk_rows):
+            yield dev_name, records
+
+
+def iter_row_groups(chunks, row_group_rows:int):
+    """
+    The function `iter_row_groups` collects chunks to groups of at least `row_group_rows` rows (the last
+    group can be smaller), only one group is held in memory.
+
+    :return: a generator of lists of (device name, records).
+    """
+    group, num_rows = [], 0
+    for dev_name, records in chunks:
+        group.append((dev_name, records))
+        num_rows += len(records)
+        if num_rows >= row_group_rows:
+            yield group
+            group, num_rows = [], 0
+    if group:
+        yield group
+
+
+def write_parquet(out_path:Path, store:HistoryStore, dev_names:list, chunks, row_group_rows:int):
+    """
+    The function `write_parquet` writes chunks to a Parquet file, one row group per group of chunks
+    (device and quality are dictionary encoded, timestamp is UTC with microseconds).
+
+    :return: number of written rows.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError(f'pyarrow is needed for Parquet export, install it or export to .csv')
+    fields = [pa.field('device', pa.dictionary(pa.int32(), pa.string())), pa.field('timestamp', pa.timestamp('us', tz='UTC'))]
+    for name in store.dtype.names[1:]:
+        if name == 'quality':
+            fields.append(pa.field(name, pa.dictionary(pa.uint8(), pa.string())))
+        else:
+            fields.append(pa.field(name, pa.from_numpy_dtype(store.dtype[name])))
+    schema = pa.schema(fields)
+    dev_indexes = {dev_name:idx for idx, dev_name in enumerate(dev_names)}
+    devices, qualities = pa.array(dev_names, pa.string()), pa.array(store.qualities, pa.string())
+    num_rows = 0
+    with pq.ParquetWriter(out_path, schema, compression='zstd') as writer:
+        for group in iter_row_groups(chunks, row_group_rows):
+            records = np.concatenate([records for dev_name, records in group])
+            dev_idx = np.concatenate([np.full(len(records), dev_indexes[dev_name], dtype=np.int32) for dev_name, records in group])
+            columns = [pa.DictionaryArray.from_arrays(pa.array(dev_idx), devices),
+                       pa.array(np.round(records['timestamp'] * 1e6).astype(np.int64), pa.timestamp('us', tz='UTC'))]
+            for name in store.dtype.names[1:]:
+                if name == 'quality':
+                    columns.append(pa.DictionaryArray.from_arrays(pa.array(records[name]), qualities))
+                else:
+                    columns.append(pa.array(records[name]))
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema), row_group_size=len(records))
+            num_rows += len(records)
+    return num_rows
+
+
+def write_csv(out_file, store:HistoryStore, chunks):
+    """
+    The function `write_csv` writes chunks to a CSV file: device, unix timestamp, UTC time, the other
+    record fields (quality by name).
+
+    :return: number of written rows.
+    """
+    writer = csv.writer(out_file)
+    writer.writerow(['device', 'timestamp', 'time_utc'] + list(store.dtype.names[1:]))
+    quality_names = np.array(store.qualities + ['unknown'] * (256 - len(store.qualities)))
+    num_rows = 0
+    for dev_name, records in chunks:
+        timestamps = records['timestamp']
+        columns = [repeat(dev_name), timestamps.tolist(),
+                   np.datetime_as_string(np.round(timestamps * 1e6).astype('datetime64[us]'), unit='ms').tolist()]
+        for name in store.dtype.names[1:]:
+            columns.append(quality_names[records[name]].tolist() if name == 'quality' else records[name].tolist())
+        writer.writerows(zip(*columns))
+        num_rows += len(records)
+    return num_rows
+
+
+def export(out_path:str, history_path, dev_names:list | None = None, t_start:float = 0, t_end:float | None = None,
+           out_format:str | None = None, resolution:str | None = None, chunk_rows:int = 65536, row_group_rows:int = 262144):
+    """
+    The function `export` streams recorded history of devices in a time range to a file (written to a
+    temporary file first and renamed when it is complete).
+
+    :param out_path: The `out_path` parameter is the output file, '-' - CSV to stdout
+    :param history_path: The `history_path` parameter is the history directory
+    :param dev_names: The `dev_names` parameter is a list of device names, None - all recorded devices
+    :param t_start: The `t_start` parameter is the start of the range (unix time, included)
+    :param t_end: The `t_end` parameter is the end of the range (unix time, included), None - now
+    :param out_format: The `out_format` parameter is 'parquet' or 'csv', None - by the file extension
+    :param resolution: The `resolution` parameter is the bucket size (seconds) of a rollup tier to export,
+    None - raw samples
+    :param chunk_rows: The `chunk_rows` parameter is the max number of records read at once from a raw segment
+    :param row_group_rows: The `row_group_rows` parameter is the number of rows in a Parquet row group
+    :return: a dictionary {dev_name: number of exported rows}.
+    """
+    store = open_history(history_path, resolution)
+    recorded = store.device_names()
+    if dev_names is None:
+        dev_names = recorded
+    unknown = [dev_name for dev_name in dev_names if dev_name not in recorded]
+    if unknown:
+        raise ValueError(f'export: no recorded history of {", ".join(unknown)}')
+    if t_end is None:
+        t_end = time()
+    if out_format is None:
+        out_format = 'parquet' if Path(out_path).suffix.lower() in ('.parquet', '.pq') else 'csv'
+
+    counts = dict.fromkeys(dev_names, 0)
+    def counted(chunks):
+        for dev_name, records in chunks:
+            counts[dev_name] += len(records)
+            yield dev_name, records
+    chunks = counted(iter_chunks(store, dev_names, t_start, t_end, min(chunk_rows, row_group_rows)))
+
+    if out_path == '-':
+        if out_format != 'csv':
+            raise ValueError(f'export: only CSV can be written to stdout')
+        write_csv(sys.stdout, store, chunks)
+        return counts
+    out_path = Path(out_path)
+    tmp_path = out_path.with_name(out_path.name + '.tmp')
+    try:
+        if out_format == 'parquet':
+            write_parquet(tmp_path, store, dev_names, chunks, row_group_rows)
+        else:
+            with open(tmp_path, 'w', newline='') as out_file:
+                write_csv(out_file, store, chunks)
+        tmp_path.replace(out_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export recorded history to Parquet or CSV.')
+    parser.add_argument('output', help="output file (.parquet/.pq - Parquet, otherwise CSV), '-' - CSV to stdout")
+    parser.add_argument('--devices', nargs='+', help='device names (default: all recorded devices)')
+    parser.add_argument('--start', type=parse_time, default=0, help='unix time or ISO date/time (default: the beginning)')
+    parser.add_argument('--end', type=parse_time, help='unix time or ISO date/time (default: now)')
+    parser.add_argument('--format', choices=['parquet', 'csv'], help='output format (default: by the file extension)')
+    parser.add_argument('--resolution', help='export the rollup tier of this bucket size (seconds) instead of raw samples')
+    parser.add_argument('--history', type=Path, help='history directory (default: history path of config.yaml)')
+    parser.add_argument('--row-group-rows', type=int, default=262144, help='rows in one Parquet row group')
+    args = parser.parse_args()
+
+    history_path = args.history or get_history_path(Path(__file__).parent.joinpath('config.yaml'))
+    start = perf_counter()
+    try:
+        counts = export(args.output, history_path, args.devices, args.start, args.end, args.format, args.resolution,
+                        row_group_rows=args.row_group_rows)
+    except Exception as err:
+        sys.exit(f'{err.__class__.__name__}: {err}')
+    for dev_name, num_rows in counts.items():
+        print(f'{dev_name:<24}{num_rows:>12}', file=sys.stderr)
+    print(f'{sum(counts.values())} rows exported in {perf_counter() - start:.1f} s', file=sys.stderr)
@@ -1,12 +1,37 @@
 # interface services for external applications (MQTT/OPC/???)
 import paho.mqtt.client as mqtt
+from time import monotonic, time
+import struct
+import json
+import zlib
 
 class mqtt_iface():
-    def __init__(self, iface_cfg, cmd_callback, err_queue) -> None:
+
+    # snapshot mode: refrig/snapshot/schema (retained JSON) lists devices and qualities, refrig/snapshot messages are
+    # header (schema version, kind, crc32 of the schema message, unix time, number of entries) + entries
+    snapshot_version = 1
+    snapshot_kinds = {'snapshot':0, 'delta':1}
+    snapshot_header = struct.Struct('<BBIdH')
+    snapshot_entry = struct.Struct('<HdB') # device index in schema, value (NaN - no value), quality index in schema
+
+    def __init__(self, iface_cfg, cmd_callback, err_queue, deadbands:dict | None = None, dev_names:list | None = None,
+                 qualities:list | None = None, history_callback = None) -> None:
         self.con_info = iface_cfg
         self.cmd_callback = cmd_callback
+        self.history_callback = history_callback # gets history requests (dicts) from refrig/history/request
         self.mqtt_client = mqtt.Client()
         self.err_queue = err_queue
+        self.sent_quality = {} # last published quality of every device
+        self.sent_values = {} # last published value of every device and monotonic time of publish
+        self.deadbands = deadbands or {} # {dev_name: (absolute deadband, relative deadband)}
+        self.heartbeat = float(iface_cfg.get('heartbeat', 10)) # max silence of an unchanged value (seconds)
+        self.publish_mode = iface_cfg.get('publish_mode', 'topics') # topics/snapshot/both
+        if self.publish_mode not in ('topics', 'snapshot', 'both'):
+            raise ValueError(f'External mqtt_iface: unknown publish_mode {self.publish_mode}')
+        self.snapshot_period = float(iface_cfg.get('snapshot_period', 10))
+        self.next_snapshot = monotonic()
+        self.last_records = {} # latest record of every device (for snapshots)
+        self.make_snapshot_schema(dev_names or [], qualities or [])
         self.connect_iface()
 
 
@@ -16,11 +41,44 @@ class mqtt_iface():
             self.mqtt_client.connect(host=self.con_info['ip'], port=int(self.con_info['port']), keepalive=60, )
             self.mqtt_client.on_message = self.process_command
             self.mqtt_client.subscribe(f'refrig/Command')
+            if self.history_callback is not None:
+                self.mqtt_client.message_callback_add('refrig/history/request', self.process_history_request)
+                self.mqtt_client.subscribe('refrig/history/request')
             self.mqtt_client.loop_start()
+            if self.publish_mode != 'topics':
+                self.mqtt_client.publish('refrig/snapshot/schema', self.snapshot_schema, retain=True)
         except Exception as err:
             raise type(err)(f'External mqtt_iface: connect_iface: {err}')
         
 
+    def make_snapshot_schema(self, dev_names:list, qualities:list):
+        # schema message and its id (crc32), device and quality indexes used in snapshot entries
+        self.snapshot_schema = json.dumps({'version':self.snapshot_version, 'devices':list(dev_names), 'qualities':list(qualities)})
+        self.snapshot_schema_id = zlib.crc32(self.snapshot_schema.encode())
+        self.snapshot_dev_idx = {dev_name:idx for idx, dev_name in enumerate(dev_names)}
+        self.snapshot_quality_idx = {quality:idx for idx, quality in enumerate(qualities)}
+
+
+    def encode_snapshot(self, kind:str, records:dict):
+        """
+        The function `encode_snapshot` packs records to a snapshot message (devices unknown to the schema
+        are skipped).
+
+        :param kind: The `kind` parameter is 'snapshot' (all devices) or 'delta' (changed devices)
+        :param records: The `records` parameter is a dictionary {dev_name: (value, timestamp, quality, source)}
+        :return: bytes of the message.
+        """
+        entries = []
+        for cur_device, (cur_value, _, cur_quality, _) in records.items():
+            idx = self.snapshot_dev_idx.get(cur_device, None)
+            if idx is None:
+                continue
+            entries.append(self.snapshot_entry.pack(idx, float('nan') if cur_value is None else cur_value,
+                                                    self.snapshot_quality_idx.get(cur_quality, 0)))
+        header = self.snapshot_header.pack(self.snapshot_version, self.snapshot_kinds[kind], self.snapshot_schema_id, time(), len(entries))
+        return header + b''.join(entries)
+
+
     def send(self, values_dict:dict, retain=False):
         try:
             for cur_device, cur_value in values_dict.items():
@@ -30,6 +88,86 @@ class mqtt_iface():
         return
     
 
+    def send_values(self, records:dict):
+        """
+        The function `send_values` publishes live values to refrig/<dev_name> when they change by more
+        than their deadband or were not published for `heartbeat` seconds; quality, acquisition time and
+        source of a value are published (retained) to refrig/quality/<dev_name> when its quality changes.
+        In snapshot mode changed values go to one refrig/snapshot delta message, all values are sent as
+        a full snapshot every `snapshot_period`.
+
+        :param records: The `records` parameter is a dictionary {dev_name: (value, timestamp, quality, source)}
+        :type records: dict
+        """
+        try:
+            now = monotonic()
+            changed = {}
+            for cur_device, record in records.items():
+                self.last_records[cur_device] = record
+                if self.value_changed(cur_device, record[0], now) or self.sent_quality.get(cur_device, None) != record[2]:
+                    changed[cur_device] = record
+            for cur_device, (cur_value, _, _, _) in changed.items():
+                if self.publish_mode != 'snapshot':
+                    self.mqtt_client.publish(f'refrig/{cur_device}', cur_value)
+                self.sent_values[cur_device] = (cur_value, now)
+            if self.publish_mode != 'topics':
+                if now >= self.next_snapshot:
+                    self.mqtt_client.publish('refrig/snapshot', self.encode_snapshot('snapshot', self.last_records))
+                    self.next_snapshot = now + self.snapshot_period
+                elif changed:
+                    self.mqtt_client.publish('refrig/snapshot', self.encode_snapshot('delta', changed))
+            self.send_quality(records)
+        except Exception as err:
+            raise type(err)(f'External mqtt_iface: send_values: {err}')
+
+
+    def value_changed(self, dev_name, value, now:float):
+        """
+        The function `value_changed` checks if a value should be published: it was never published, it
+        appeared/disappeared, it is out of the deadband of the last published value or heartbeat time passed.
+        """
+        if dev_name not in self.sent_values:
+            return True
+        sent_value, sent_time = self.sent_values[dev_name]
+        if now - sent_time >= self.heartbeat:
+            return True
+        if value is None or sent_value is None:
+            return value is not sent_value
+        deadband, deadband_rel = self.deadbands.get(dev_name, (0, 0))
+        return abs(value - sent_value) > max(deadband, deadband_rel * abs(sent_value))
+
+
+    def send_quality(self, records:dict):
+        """
+        The function `send_quality` publishes (retained) quality, acquisition time and source of the values
+        which quality has changed since the last publish (e.g. good values which became stale).
+
+        :param records: The `records` parameter is a dictionary {dev_name: (value, timestamp, quality, source)}
+        :type records: dict
+        """
+        try:
+            for cur_device, (_, cur_timestamp, cur_quality, cur_source) in records.items():
+                if self.sent_quality.get(cur_device, None) != cur_quality:
+                    self.mqtt_client.publish(f'refrig/quality/{cur_device}', f'{cur_quality} {cur_timestamp:.3f} {cur_source}', retain=True)
+                    self.sent_quality[cur_device] = cur_quality
+        except Exception as err:
+            raise type(err)(f'External mqtt_iface: send_quality: {err}')
+
+
+    def publish(self, topic:str, payload):
+        try:
+            self.mqtt_client.publish(topic, payload)
+        except Exception as err:
+            raise type(err)(f'External mqtt_iface: publish: {err}')
+
+
+    def process_history_request(self, client, userdata, msg):
+        try:
+            self.history_callback(json.loads(msg.payload.decode()))
+        except Exception as err:
+            self.process_error(type(err)(f'process_history_request: {err}'))
+
+
     def process_command(self, client, userdata, msg):
         try:
             cmd = f'{msg.payload.decode()}'
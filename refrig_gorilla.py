@@ -0,0 +1,289 @@
+# Gorilla-style compression of recorded samples (timestamp, value, quality), as in Pelkonen et al.
+# "Gorilla: A Fast, Scalable, In-Memory Time Series Database":
+# timestamps (rounded to 1 ms) are delta-of-delta coded, values are XOR coded with the previous value (lossless),
+# quality is one bit if it is the same as the previous one.
+# A cold file is a sequence of independent blocks: header (first/last timestamp, samples, payload bytes) + bit payload,
+# range queries skip blocks by their headers and decode the others as a stream.
+# Benchmark on recorded history: python refrig_gorilla.py [history path]
+import struct
+import sys
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+
+block_header = struct.Struct('<ddII')
+# delta-of-delta buckets (ms): (control bits, number of control bits, value bits)
+dod_buckets = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12))
+quality_bits = 4
+
+
+class BitWriter():
+
+    def __init__(self) -> None:
+        self.buf = bytearray()
+        self.acc = 0
+        self.num_bits = 0
+
+
+    def write(self, value:int, num_bits:int):
+        self.acc = (self.acc << num_bits) | (value & ((1 << num_bits) - 1))
+        self.num_bits += num_bits
+        if self.num_bits >= 64: # whole bytes go to the buffer, the accumulator stays small
+            rest = self.num_bits & 7
+            self.buf += (self.acc >> rest).to_bytes((self.num_bits - rest) // 8, 'big')
+            self.acc &= (1 << rest) - 1
+            self.num_bits = rest
+
+
+    def getvalue(self):
+        if self.num_bits:
+            pad = -self.num_bits & 7
+            return bytes(self.buf + (self.acc << pad).to_bytes((self.num_bits + pad) // 8, 'big'))
+        return bytes(self.buf)
+
+
+class BitReader():
+
+    def __init__(self, data:bytes) -> None:
+        self.data = data
+        self.pos = 0
+        self.acc = 0
+        self.num_bits = 0
+
+
+    def read(self, num_bits:int):
+        while self.num_bits < num_bits:
+            chunk = self.data[self.pos:self.pos + 8]
+            if not chunk:
+                raise EOFError(f'BitReader: end of data')
+            self.pos += len(chunk)
+            self.acc = (self.acc << (8 * len(chunk))) | int.from_bytes(chunk, 'big')
+            self.num_bits += 8 * len(chunk)
+        self.num_bits -= num_bits
+        value = self.acc >> self.num_bits
+        self.acc &= (1 << self.num_bits) - 1
+        return value
+
+
+def encode_block(timestamps, values, qualities):
+    """
+    The function `encode_block` compresses samples to one block.
+
+    :param timestamps: The `timestamps` parameter is a numpy float64 array of unix times (sorted)
+    :param values: The `values` parameter is a numpy float64 array (NaN - no value)
+    :param qualities: The `qualities` parameter is a numpy array of quality codes (< 16)
+    :return: bytes of the block (header + payload).
+    """
+    ts_ms = np.round(np.asarray(timestamps, dtype=np.float64) * 1000).astype(np.int64).tolist()
+    value_bits = np.ascontiguousarray(values, dtype=np.float64).view(np.uint64).tolist()
+    quality_codes = np.asarray(qualities).tolist()
+    writer = BitWriter()
+    write = writer.write
+    prev_t, prev_v, prev_q = ts_ms[0], value_bits[0], quality_codes[0]
+    write(prev_t, 64)
+    write(prev_v, 64)
+    write(prev_q, quality_bits)
+    prev_delta = 0
+    prev_lead, prev_trail = -1, -1 # no XOR window yet
+    for t, v, q in zip(ts_ms[1:], value_bits[1:], quality_codes[1:]):
+        delta = t - prev_t
+        dod = delta - prev_delta
+        if dod == 0:
+            write(0, 1)
+        else:
+            for control, control_bits, dod_bits in dod_buckets:
+                half = 1 << (dod_bits - 1)
+                if -half < dod <= half:
+                    write(control, control_bits)
+                    write(dod + half - 1, dod_bits)
+                    break
+            else:
+                write(0b1111, 4)
+                write(dod, 64)
+        prev_t, prev_delta = t, delta
+
+        xor = v ^ prev_v
+        if xor == 0:
+            write(0, 1)
+        else:
+            lead = min(64 - xor.bit_length(), 31)
+            trail = (xor & -xor).bit_length() - 1
+            if prev_lead >= 0 and lead >= prev_lead and trail >= prev_trail: # fits into the previous window
+                write(0b10, 2)
+                write(xor >> prev_trail, 64 - prev_lead - prev_trail)
+            else:
+                significant = 64 - lead - trail
+                write(0b11, 2)
+                write(lead, 5)
+                write(significant - 1, 6)
+                write(xor >> trail, significant)
+                prev_lead, prev_trail = lead, trail
+        prev_v = v
+
+        if q == prev_q:
+            write(0, 1)
+        else:
+            write(1, 1)
+            write(q, quality_bits)
+            prev_q = q
+    payload = writer.getvalue()
+    return block_header.pack(ts_ms[0] / 1000, ts_ms[-1] / 1000, len(ts_ms), len(payload)) + payload
+
+
+def decode_block(payload:bytes, num_samples:int):
+    """
+    The function `decode_block` decompresses the payload of a block.
+
+    :return: numpy arrays of timestamps (float64), values (float64) and quality codes (uint8).
+    """
+    read = BitReader(payload).read
+    ts_ms = [0] * num_samples
+    value_bits = [0] * num_samples
+    quality_codes = [0] * num_samples
+    t, v, q = read(64), read(64), read(quality_bits)
+    ts_ms[0], value_bits[0], quality_codes[0] = t, v, q
+    delta = 0
+    lead, trail = 0, 0
+    for idx in range(1, num_samples):
+        if read(1):
+            if not read(1):
+                dod_bits = 7
+            elif not read(1):
+                dod_bits = 9
+            elif not read(1):
+                dod_bits = 12
+            else:
+                dod_bits = 0
+            if dod_bits:
+                delta += read(dod_bits) - (1 << (dod_bits - 1)) + 1
+            else:
+                dod = read(64)
+                delta += dod - (1 << 64) if dod >> 63 else dod
+        t += delta
+        ts_ms[idx] = t
+
+        if read(1):
+            if read(1):
+                lead = read(5)
+                significant = read(6) + 1
+                trail = 64 - lead - significant
+            v ^= read(64 - lead - trail) << trail
+        value_bits[idx] = v
+
+        if read(1):
+            q = read(quality_bits)
+        quality_codes[idx] = q
+    timestamps = np.array(ts_ms, dtype=np.int64) / 1000
+    values = np.array(value_bits, dtype=np.uint64).view(np.float64)
+    return timestamps, values, np.array(quality_codes, dtype=np.uint8)
+
+
+def write_file(path, timestamps, values, qualities, block_size:int = 4096):
+    """
+    The function `write_file` compresses samples to a cold file (written to a temporary file first and
+    renamed, so a cold file is always complete).
+
+    :return: size of the file (bytes).
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    size = 0
+    with open(tmp_path, 'wb') as cold_file:
+        for start in range(0, len(timestamps), block_size):
+            end = start + block_size
+            size += cold_file.write(encode_block(timestamps[start:end], values[start:end], qualities[start:end]))
+    tmp_path.replace(path)
+    return size
+
+
+def iter_blocks(path):
+    """
+    The function `iter_blocks` reads a cold file block by block.
+
+    :return: a generator of (first timestamp, last timestamp, number of samples, payload).
+    """
+    with open(path, 'rb') as cold_file:
+        while True:
+            header = cold_file.read(block_header.size)
+            if len(header) < block_header.size:
+                return
+            first_ts, last_ts, num_samples, payload_size = block_header.unpack(header)
+            yield first_ts, last_ts, num_samples, cold_file.read(payload_size)
+
+
+def read_range(path, t_start:float, t_end:float):
+    """
+    The function `read_range` decodes samples of a cold file in a time range, only blocks which overlap
+    the range are decoded.
+
+    :return: a generator of (timestamps, values, quality codes) numpy arrays per block.
+    """
+    for first_ts, last_ts, num_samples, payload in iter_blocks(path):
+        if last_ts < t_start:
+            continue
+        if first_ts > t_end:
+            return
+        timestamps, values, qualities = decode_block(payload, num_samples)
+        if first_ts < t_start or last_ts > t_end:
+            mask = (timestamps >= t_start) & (timestamps <= t_end)
+            timestamps, values, qualities = timestamps[mask], values[mask], qualities[mask]
+        yield timestamps, values, qualities
+
+
+def count_range(path, t_start:float, t_end:float):
+    """
+    The function `count_range` returns the number of samples of a cold file in a time range (only blocks
+    at the ends of the range are decoded).
+    """
+    num_samples = 0
+    for first_ts, last_ts, block_samples, payload in iter_blocks(path):
+        if last_ts < t_start:
+            continue
+        if first_ts > t_end:
+            break
+        if first_ts >= t_start and last_ts <= t_end:
+            num_samples += block_samples
+        else:
+            timestamps = decode_block(payload, block_samples)[0]
+            num_samples += int(np.count_nonzero((timestamps >= t_start) & (timestamps <= t_end)))
+    return num_samples
+
+
+def benchmark(history_path, block_size:int = 4096):
+    """
+    The function `benchmark` compresses raw segments of recorded history (traces captured from the live
+    values by the historian) and prints compression ratio and encode/decode throughput per device.
+    """
+    from refrig_historian import record_dtype
+    totals = {} # {dev_name: [samples, raw bytes, cold bytes, encode s, decode s]}
+    for seg_path in sorted(Path(history_path).glob('[0-9]*-*-*/*.seg')):
+        records = np.fromfile(seg_path, dtype=record_dtype, count=seg_path.stat().st_size // record_dtype.itemsize)
+        if len(records) == 0:
+            continue
+        dev_name = seg_path.name.split('.')[0]
+        start = perf_counter()
+        blocks = [encode_block(records['timestamp'][idx:idx + block_size], records['value'][idx:idx + block_size],
+                               records['quality'][idx:idx + block_size]) for idx in range(0, len(records), block_size)]
+        encode_time = perf_counter() - start
+        start = perf_counter()
+        for block in blocks:
+            first_ts, last_ts, num_samples, payload_size = block_header.unpack_from(block)
+            decode_block(block[block_header.size:], num_samples)
+        decode_time = perf_counter() - start
+        dev_totals = totals.setdefault(dev_name, [0, 0, 0, 0, 0])
+        for idx, value in enumerate((len(records), records.nbytes, sum(len(block) for block in blocks), encode_time, decode_time)):
+            dev_totals[idx] += value
+    if not totals:
+        print(f'no raw segments in {history_path}')
+        return
+    print(f'{"device":<16}{"samples":>10}{"ratio":>8}{"bits/sample":>13}{"enc ksamples/s":>16}{"dec ksamples/s":>16}')
+    for dev_name, (num_samples, raw_size, cold_size, encode_time, decode_time) in sorted(totals.items()) + \
+            [('TOTAL', [sum(dev_totals[idx] for dev_totals in totals.values()) for idx in range(5)])]:
+        print(f'{dev_name:<16}{num_samples:>10}{raw_size / cold_size:>8.2f}{8 * cold_size / num_samples:>13.2f}'
+              f'{num_samples / encode_time / 1000:>16.1f}{num_samples / decode_time / 1000:>16.1f}')
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else Path(__file__).parent.joinpath('history'))
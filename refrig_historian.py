@@ -0,0 +1,742 @@
+# recorded history of live values:
+# <path>/<YYYY-MM-DD>/<dev_name>.<nnn>.seg - append-only segments of fixed-width records (timestamp, value, quality),
+# one column of segments per device, days are UTC, a new segment is started when the current one reaches its size limit,
+# the oldest days are removed when the history exceeds its total size; segments are memory-mapped for range queries.
+# <path>/rollup_<N>s/... - downsampled tiers in the same layout, one record (min, max, mean, last, count) per N seconds bucket
+# <path>/<YYYY-MM-DD>/<dev_name>.<nnn>.gor - cold tier, raw segments of old days compressed by refrig_gorilla
+# <path>/calibrations.jsonl - ids of calibrations devices were converted with, a line when they change
+from threading import Thread, Lock, Event
+from queue import Queue, Full
+from pathlib import Path
+from time import gmtime, strftime, monotonic, time, perf_counter
+import json
+import re
+import shutil
+import struct
+import zlib
+
+import numpy as np
+
+import refrig_gorilla
+
+
+record_dtype = np.dtype([('timestamp', '<f8'), ('value', '<f8'), ('quality', 'u1')]) # packed, 17 bytes per sample
+rollup_dtype = np.dtype([('timestamp', '<f8'), ('min', '<f8'), ('max', '<f8'), ('mean', '<f8'), ('last', '<f8'),
+                         ('count', '<u4')]) # timestamp is the bucket start
+
+
+class HistoryStore():
+    '''
+    segmented append-only storage of samples, written by one thread (historian), readable from any thread
+    '''
+
+    schema_version = 1
+    segment_suffix = '.seg'
+    cold_suffix = '.gor'
+    day_pattern = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+    def __init__(self, path, qualities:list, segment_max_size:int = 64 * 2**20, max_total_size:int = 2 * 2**30,
+                 dtype:np.dtype = record_dtype, cold_after:float | None = None, cold_block_size:int = 4096) -> None:
+        """
+        :param path: The `path` parameter is the directory of the history (created if it doesn't exist)
+        :param qualities: The `qualities` parameter is a list of quality names, quality codes are their indexes
+        :param segment_max_size: The `segment_max_size` parameter is the max size of one segment file (bytes)
+        :param max_total_size: The `max_total_size` parameter is the max size of the whole history (bytes)
+        :param dtype: The `dtype` parameter is the record type (`record_dtype` for samples, `rollup_dtype` for tiers)
+        :param cold_after: The `cold_after` parameter is the age (days) of segments which are compressed to the
+        cold tier (samples only), None - no cold tier
+        :param cold_block_size: The `cold_block_size` parameter is the number of samples in one compressed block
+        """
+        try:
+            self.path = Path(path)
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.qualities = list(qualities)
+            self.quality_codes = {quality:code for code, quality in enumerate(self.qualities)}
+            self.dtype = np.dtype(dtype)
+            self.segment_max_size = segment_max_size // self.dtype.itemsize * self.dtype.itemsize
+            self.max_total_size = max_total_size
+            if cold_after is not None and self.dtype != record_dtype:
+                raise ValueError(f'cold tier is supported for samples only')
+            self.cold_after = cold_after
+            self.cold_block_size = cold_block_size
+            self.check_schema()
+            self.segments = {} # current segment of every device {dev_name: (day, segment number, size)}
+            self.total_size = sum(seg_path.stat().st_size for day_path in self.day_dirs() for seg_path in self.day_files(day_path))
+        except Exception as err:
+            raise type(err)(f'HistoryStore init: {err}')
+
+
+    def check_schema(self):
+        # record layout and quality codes are stored with the history, an existing history should match them
+        schema = {'version':self.schema_version, 'record':[[name, self.dtype[name].str] for name in self.dtype.names],
+                  'qualities':self.qualities}
+        schema_path = self.path.joinpath('schema.json')
+        if not schema_path.exists():
+            schema_path.write_text(json.dumps(schema))
+            return
+        stored_schema = json.loads(schema_path.read_text())
+        if stored_schema != schema:
+            raise ValueError(f'history at {self.path} has different schema: {stored_schema}')
+
+
+    def read_calibration_log(self):
+        # [(timestamp, {dev_name: calibration id})] in time order
+        log_path = self.path.joinpath('calibrations.jsonl')
+        if not log_path.exists():
+            return []
+        entries = [json.loads(cur_line) for cur_line in log_path.read_text().splitlines() if cur_line.strip()]
+        return [(entry['timestamp'], entry['calibrations']) for entry in entries]
+
+
+    def log_calibrations(self, timestamp:float, calibrations:dict):
+        """
+        The function `log_calibrations` records calibrations which are active from `timestamp` on (only
+        devices whose calibration changed since the last record), so the calibration a sample was converted
+        with is known for every recorded sample (`get_calibration`).
+
+        :param timestamp: The `timestamp` parameter is the unix time the calibrations are active from
+        :param calibrations: The `calibrations` parameter is a dictionary {dev_name: calibration id}
+        :return: a dictionary of changed calibrations.
+        """
+        try:
+            active = {}
+            for _, logged in self.read_calibration_log():
+                active.update(logged)
+            changed = {dev_name:calibration_id for dev_name, calibration_id in calibrations.items() if active.get(dev_name, None) != calibration_id}
+            if changed:
+                with open(self.path.joinpath('calibrations.jsonl'), 'a') as log_file:
+                    log_file.write(json.dumps({'timestamp':timestamp, 'calibrations':changed}) + '\n')
+            return changed
+        except Exception as err:
+            raise type(err)(f'HistoryStore.log_calibrations: {err}')
+
+
+    def get_calibration(self, dev_name:str, timestamp:float):
+        """
+        The function `get_calibration` returns the id of the calibration a sample of a device was converted
+        with (None if the device had no logged calibration at that time).
+        """
+        calibration_id = None
+        for log_ts, logged in self.read_calibration_log():
+            if log_ts > timestamp:
+                break
+            calibration_id = logged.get(dev_name, calibration_id)
+        return calibration_id
+
+
+    def get_day(self, timestamp:float):
+        return strftime('%Y-%m-%d', gmtime(timestamp))
+
+
+    def day_dirs(self):
+        # day directories in time order (other directories, e.g. rollup tiers, are not days of this store)
+        return [day_path for day_path in sorted(self.path.iterdir()) if day_path.is_dir() and self.day_pattern.fullmatch(day_path.name)]
+
+
+    def day_files(self, day_path:Path, dev_name:str = '*'):
+        # segment and cold files of a day (of one device if it is specified)
+        pattern = '*' if dev_name == '*' else f'{dev_name}.[0-9][0-9][0-9]'
+        return list(day_path.glob(f'{pattern}{self.segment_suffix}')) + list(day_path.glob(f'{pattern}{self.cold_suffix}'))
+
+
+    def seg_number(self, seg_path:Path):
+        return int(seg_path.name.rsplit('.', 2)[1])
+
+
+    def device_segments(self, day_path:Path, dev_name:str):
+        # files of a device at a day in segment order, a cold file is taken if its segment is not deleted yet
+        seg_paths = {}
+        for seg_path in self.day_files(day_path, dev_name):
+            seg_no = self.seg_number(seg_path)
+            if seg_path.suffix == self.cold_suffix or seg_no not in seg_paths:
+                seg_paths[seg_no] = seg_path
+        return [seg_paths[seg_no] for seg_no in sorted(seg_paths)]
+
+
+    def device_names(self):
+        # names of all devices which have recorded files
+        return sorted({seg_path.name.split('.')[0] for day_path in self.day_dirs() for seg_path in self.day_files(day_path)})
+
+
+    def segment_path(self, day:str, dev_name:str, seg_no:int):
+        return self.path.joinpath(day, f'{dev_name}.{seg_no:03d}{self.segment_suffix}')
+
+
+    def list_segments(self, dev_name:str, t_start:float | None = None, t_end:float | None = None):
+        """
+        The function `list_segments` lists segment files of a device in time order, only days which
+        overlap the time range if it is specified.
+        """
+        first_day = self.get_day(t_start) if t_start is not None else ''
+        last_day = self.get_day(t_end) if t_end is not None else '9999'
+        seg_paths = []
+        for day_path in self.day_dirs():
+            if not first_day <= day_path.name <= last_day:
+                continue
+            seg_paths += self.device_segments(day_path, dev_name)
+        return seg_paths
+
+
+    def open_segment(self, dev_name:str, day:str):
+        # the last segment of the device at this day (appending continues after restart)
+        seg_paths = self.device_segments(self.path.joinpath(day), dev_name)
+        if not seg_paths:
+            return (day, 0, 0)
+        seg_path = seg_paths[-1]
+        seg_no, size = self.seg_number(seg_path), seg_path.stat().st_size
+        if seg_path.suffix == self.cold_suffix or size % self.dtype.itemsize: # compressed or last record was not written completely
+            return (day, seg_no + 1, 0)
+        return (day, seg_no, size)
+
+
+    def append(self, dev_name:str, samples):
+        """
+        The function `append` writes samples of a device to the end of its current segments (one write
+        per segment), starting new segments at day change and when a segment is full.
+
+        :param dev_name: The `dev_name` parameter is the device name
+        :param samples: The `samples` parameter is a numpy array of the store's dtype sorted by timestamp
+        :return: number of written bytes.
+        """
+        written = 0
+        day_numbers = (samples['timestamp'] // 86400).astype(np.int64) # UTC days since epoch
+        start = 0
+        while start < len(samples):
+            day = self.get_day(day_numbers[start] * 86400)
+            end = int(np.searchsorted(day_numbers, day_numbers[start], side='right'))
+            cur_day, seg_no, size = self.segments.get(dev_name, None) or self.open_segment(dev_name, day)
+            if cur_day != day:
+                cur_day, seg_no, size = self.open_segment(dev_name, day)
+            if size + self.dtype.itemsize > self.segment_max_size:
+                seg_no, size = seg_no + 1, 0
+            end = min(end, start + (self.segment_max_size - size) // self.dtype.itemsize)
+            seg_path = self.segment_path(day, dev_name, seg_no)
+            seg_path.parent.mkdir(exist_ok=True)
+            data = samples[start:end].tobytes()
+            with open(seg_path, 'ab') as seg_file:
+                seg_file.write(data)
+            size += len(data)
+            written += len(data)
+            self.segments[dev_name] = (day, seg_no, size)
+            start = end
+        self.total_size += written
+        return written
+
+
+    def remove_oldest(self, keep_day:str | None = None):
+        """
+        The function `remove_oldest` removes the oldest days while the history is larger than its max size
+        (`keep_day` is never removed).
+        """
+        for day_path in self.day_dirs():
+            if self.total_size <= self.max_total_size:
+                return
+            if day_path.name == keep_day:
+                continue
+            self.total_size -= sum(seg_path.stat().st_size for seg_path in self.day_files(day_path))
+            shutil.rmtree(day_path)
+            self.segments = {dev_name:segment for dev_name, segment in self.segments.items() if segment[0] != day_path.name}
+
+
+    def migrate_cold(self, now:float, time_budget:float = 0.5):
+        """
+        The function `migrate_cold` compresses raw segments of days older than `cold_after` to cold files
+        (raw segment is removed after its cold file is complete), until `time_budget` seconds are used.
+
+        :param now: The `now` parameter is the current unix time
+        :return: number of compressed segments.
+        """
+        if self.cold_after is None:
+            return 0
+        deadline = perf_counter() + time_budget
+        cutoff_day = self.get_day(now - self.cold_after * 86400)
+        num_migrated = 0
+        for day_path in self.day_dirs():
+            if day_path.name >= cutoff_day:
+                break
+            for seg_path in sorted(day_path.glob(f'*{self.segment_suffix}')):
+                if perf_counter() >= deadline:
+                    return num_migrated
+                cold_path = seg_path.with_suffix(self.cold_suffix)
+                raw_size = seg_path.stat().st_size
+                if cold_path.exists(): # migrated before, the raw segment was not removed
+                    seg_path.unlink()
+                    self.total_size -= raw_size
+                    continue
+                records = np.fromfile(seg_path, dtype=self.dtype, count=raw_size // self.dtype.itemsize)
+                cold_size = 0
+                if len(records):
+                    cold_size = refrig_gorilla.write_file(cold_path, records['timestamp'], records['value'], records['quality'],
+                                                          self.cold_block_size)
+                seg_path.unlink()
+                self.total_size += cold_size - raw_size
+                num_migrated += 1
+        return num_migrated
+
+
+    def iter_segment(self, seg_path:Path, t_start:float, t_end:float, chunk_rows:int = 65536):
+        # records of a segment or cold file in a time range by chunks (the raw segment could be just compressed)
+        if seg_path.suffix == self.segment_suffix:
+            try:
+                records = self.map_segment(seg_path)
+            except FileNotFoundError:
+                seg_path = seg_path.with_suffix(self.cold_suffix)
+            else:
+                if records is None:
+                    return
+                timestamps = records['timestamp']
+                lo = int(np.searchsorted(timestamps, t_start, side='left'))
+                hi = int(np.searchsorted(timestamps, t_end, side='right'))
+                for start in range(lo, hi, chunk_rows):
+                    yield np.array(records[start:min(start + chunk_rows, hi)]) # copy, the segment is unmapped after that
+                return
+        for timestamps, values, qualities in refrig_gorilla.read_range(seg_path, t_start, t_end):
+            if len(timestamps) == 0:
+                continue
+            part = np.empty(len(timestamps), dtype=self.dtype)
+            part['timestamp'], part['value'], part['quality'] = timestamps, values, qualities
+            yield part
+
+
+    def map_segment(self, seg_path:Path):
+        # memory-mapped records of a segment (a partly written last record is ignored), None if it is empty
+        num_records = seg_path.stat().st_size // self.dtype.itemsize
+        if num_records == 0:
+            return None
+        return np.memmap(seg_path, dtype=self.dtype, mode='r', shape=(num_records,))
+
+
+    def iter_query(self, dev_name:str, t_start:float, t_end:float, chunk_rows:int = 65536):
+        """
+        The function `iter_query` reads samples of a device in a time range by chunks, so any range can be
+        read in bounded memory (raw segments are memory-mapped and sliced, cold files are decoded block by block).
+
+        :param dev_name: The `dev_name` parameter is the device name
+        :param t_start: The `t_start` parameter is the start of the range (unix time, included)
+        :param t_end: The `t_end` parameter is the end of the range (unix time, included)
+        :param chunk_rows: The `chunk_rows` parameter is the max number of records in a chunk of a raw segment
+        (a chunk of a cold file is one block)
+        :return: a generator of numpy arrays of the store's dtype in time order.
+        """
+        try:
+            for seg_path in self.list_segments(dev_name, t_start, t_end):
+                yield from self.iter_segment(seg_path, t_start, t_end, chunk_rows)
+        except Exception as err:
+            raise type(err)(f'HistoryStore.iter_query: {err}')
+
+
+    def query(self, dev_name:str, t_start:float, t_end:float):
+        """
+        The function `query` returns samples of a device in a time range, only the needed part of every
+        segment is read (segments are memory-mapped and searched by timestamp, cold files are decoded by blocks).
+
+        :param dev_name: The `dev_name` parameter is the device name
+        :param t_start: The `t_start` parameter is the start of the range (unix time, included)
+        :param t_end: The `t_end` parameter is the end of the range (unix time, included)
+        :return: a numpy array of the store's dtype.
+        """
+        parts = list(self.iter_query(dev_name, t_start, t_end))
+        if not parts:
+            return np.empty(0, dtype=self.dtype)
+        return np.concatenate(parts)
+
+
+    def count(self, dev_name:str, t_start:float, t_end:float):
+        """
+        The function `count` returns the number of records of a device in a time range (nothing is copied).
+        """
+        num_records = 0
+        for seg_path in self.list_segments(dev_name, t_start, t_end):
+            try:
+                records = self.map_segment(seg_path) if seg_path.suffix == self.segment_suffix else None
+            except FileNotFoundError: # just compressed
+                records = None
+            if records is None and seg_path.with_suffix(self.cold_suffix).exists():
+                num_records += refrig_gorilla.count_range(seg_path.with_suffix(self.cold_suffix), t_start, t_end)
+                continue
+            if records is None:
+                continue
+            timestamps = records['timestamp']
+            num_records += int(np.searchsorted(timestamps, t_end, side='right') - np.searchsorted(timestamps, t_start, side='left'))
+            del records, timestamps
+        return num_records
+
+
+def merge_buckets(buckets):
+    """
+    The function `merge_buckets` sorts rollup records and merges the ones of the same bucket (a partial
+    bucket written at stop and its continuation after restart).
+    """
+    buckets = buckets[np.argsort(buckets['timestamp'], kind='stable')]
+    starts, first = np.unique(buckets['timestamp'], return_index=True)
+    if len(starts) == len(buckets):
+        return buckets
+    return reduce_buckets(buckets, first)
+
+
+def decimate_buckets(buckets, max_points:int):
+    """
+    The function `decimate_buckets` merges every k consecutive buckets into one, so there are not more
+    than `max_points` of them.
+    """
+    if len(buckets) <= max_points:
+        return buckets
+    k = -(-len(buckets) // max_points)
+    return reduce_buckets(buckets, np.arange(0, len(buckets), k))
+
+
+def reduce_buckets(buckets, first):
+    # merges groups of sorted buckets which start at `first` indexes, a merged bucket starts with its first bucket
+    merged = np.empty(len(first), dtype=rollup_dtype)
+    merged['timestamp'] = buckets['timestamp'][first]
+    merged['min'] = np.minimum.reduceat(buckets['min'], first)
+    merged['max'] = np.maximum.reduceat(buckets['max'], first)
+    merged['count'] = np.add.reduceat(buckets['count'], first)
+    merged['mean'] = np.add.reduceat(buckets['mean'] * buckets['count'], first) / merged['count']
+    merged['last'] = buckets['last'][np.append(first[1:], len(buckets)) - 1]
+    return merged
+
+
+class RollupTier():
+    '''
+    downsampled tier updated incrementally by every sample: min, max, mean, last and count of values (no values
+    are skipped) per `resolution` seconds bucket; closed buckets are written to the tier's store by the historian
+    '''
+
+    def __init__(self, store:HistoryStore, resolution:float) -> None:
+        self.store = store
+        self.resolution = resolution
+        self.buckets = {} # open bucket of every device {dev_name: [start, min, max, sum, last, count]}
+        self.pending = {} # closed buckets not written yet {dev_name: [rollup rows]}
+        self.flushing = {} # pending buckets which are being written
+
+
+    def add(self, dev_name:str, timestamp:float, value:float):
+        if value != value: # no value
+            return
+        start = timestamp // self.resolution * self.resolution
+        bucket = self.buckets.get(dev_name, None)
+        if bucket is None or bucket[0] != start:
+            if bucket is not None:
+                self.pending.setdefault(dev_name, []).append(self.bucket_row(bucket))
+            self.buckets[dev_name] = [start, value, value, value, value, 1]
+            return
+        if value < bucket[1]:
+            bucket[1] = value
+        if value > bucket[2]:
+            bucket[2] = value
+        bucket[3] += value
+        bucket[4] = value
+        bucket[5] += 1
+
+
+    def bucket_row(self, bucket):
+        start, min_value, max_value, total, last_value, count = bucket
+        return (start, min_value, max_value, total / count, last_value, count)
+
+
+    def close_buckets(self, now:float | None = None):
+        """
+        The function `close_buckets` moves open buckets which ended before `now` (all of them if `now` is
+        None, e.g. at stop) to pending buckets.
+        """
+        for dev_name, bucket in list(self.buckets.items()):
+            if now is None or bucket[0] + self.resolution <= now:
+                self.pending.setdefault(dev_name, []).append(self.bucket_row(bucket))
+                del self.buckets[dev_name]
+
+
+    def memory_buckets(self, dev_name:str, t_start:float, t_end:float):
+        # buckets which are not written yet (should be called under the historian lock)
+        rows = self.flushing.get(dev_name, []) + self.pending.get(dev_name, [])
+        if dev_name in self.buckets:
+            rows = rows + [self.bucket_row(self.buckets[dev_name])]
+        return [row for row in rows if t_start - self.resolution < row[0] <= t_end]
+
+
+class RefrigHistorian(Thread):
+    '''
+    records every sample from the value events to the history store and updates rollup tiers; samples and
+    closed buckets are written in batches every `flush_period` (or when too many are pending) to save flash,
+    old raw segments are compressed to the cold tier a bit at every flush
+    '''
+
+    migrate_budget = 0.5 # seconds of every flush used for compression of old segments
+
+    def __init__(self, store:HistoryStore, value_events, error_queue, flush_period:float = 10, max_pending:int = 50000,
+                 name: str | None = None, tier_stores:dict | None = None) -> None:
+        """
+        :param tier_stores: The `tier_stores` parameter is a dictionary {bucket size (seconds): HistoryStore of
+        `rollup_dtype`} of downsampled tiers
+        """
+        try:
+            super().__init__(name=name, daemon=True)
+            self.store = store
+            self.tiers = [RollupTier(tier_store, resolution) for resolution, tier_store in sorted((tier_stores or {}).items())]
+            self.value_events = value_events # subscription to all written values (not only changes)
+            self.err_queue = error_queue
+            self.flush_period = flush_period
+            self.max_pending = max_pending
+            self.pending = {} # {dev_name: [(timestamp, value, quality code)]} not written yet
+            self.flushing = {} # pending samples which are being written
+            self.num_pending = 0
+            self.last_timestamps = {} # last recorded timestamp of every device
+            self.lock = Lock() # pending samples are also read by queries
+            self.stop_event = Event() # the last flush is made by the historian thread, the only writer of the stores
+            self.metrics = {'samples':0, 'bytes':0, 'dropped':0, 'lost_batches':0, 'cold_segments':0}
+        except Exception as err:
+            raise type(err)(f'RefrigHistorian init: {err}')
+
+
+    def run(self):
+        next_flush = monotonic() + self.flush_period
+        while not self.stop_event.is_set():
+            try:
+                batches, lost = self.value_events.get_batches(timeout=max(next_flush - monotonic(), 0))
+                if lost:
+                    self.metrics['lost_batches'] += 1
+                    self.process_error(f'RefrigHistorian: some samples were lost (events queue was full)')
+                self.add_samples(batches)
+                if monotonic() >= next_flush or self.num_pending >= self.max_pending:
+                    self.flush()
+                    next_flush = monotonic() + self.flush_period
+            except Exception as err:
+                self.process_error(f'RefrigHistorian: {err}')
+        try:
+            self.add_samples(self.value_events.get_batches(timeout=0)[0]) # samples received before the stop
+            self.flush(close_all=True) # pending samples and open buckets
+        except Exception as err:
+            self.process_error(f'RefrigHistorian: {err}')
+
+
+    def stop(self, timeout:float | None = None):
+        """
+        The function `stop` stops recording and waits for the historian thread, which writes pending samples
+        and open buckets of rollup tiers before it exits.
+
+        :param timeout: The `timeout` parameter is the max time in seconds to wait, None - wait until done
+        """
+        self.stop_event.set()
+        self.value_events.put({}) # wakes the thread up if it waits for events
+        self.join(timeout)
+
+
+    def add_samples(self, batches:list):
+        """
+        The function `add_samples` puts samples of event batches to pending samples and rollup tiers. Samples
+        which are not newer than the last sample of their device (e.g. multi devices recalculated from the
+        same values) are dropped, so every device's history is sorted by time.
+        """
+        with self.lock:
+            for batch in batches:
+                for dev_name, (value, timestamp, quality) in batch.items():
+                    if timestamp <= self.last_timestamps.get(dev_name, 0):
+                        self.metrics['dropped'] += 1
+                        continue
+                    self.last_timestamps[dev_name] = timestamp
+                    value = float('nan') if value is None else value
+                    self.pending.setdefault(dev_name, []).append((timestamp, value, self.store.quality_codes[quality]))
+                    self.num_pending += 1
+                    for tier in self.tiers:
+                        tier.add(dev_name, timestamp, value)
+
+
+    def flush(self, close_all:bool = False):
+        """
+        The function `flush` writes all pending samples and finished buckets of rollup tiers to their stores.
+
+        :param close_all: The `close_all` parameter is True to write open buckets too (at stop)
+        """
+        with self.lock:
+            self.flushing, self.pending, self.num_pending = self.pending, {}, 0
+            for tier in self.tiers:
+                tier.close_buckets(None if close_all else time())
+                tier.flushing, tier.pending = tier.pending, {}
+        now_day = None
+        try:
+            for dev_name, samples in self.flushing.items():
+                samples = np.array(samples, dtype=record_dtype)
+                self.metrics['bytes'] += self.store.append(dev_name, samples)
+                self.metrics['samples'] += len(samples)
+                now_day = self.store.get_day(samples['timestamp'][-1])
+            for tier in self.tiers:
+                for dev_name, buckets in tier.flushing.items():
+                    self.metrics['bytes'] += tier.store.append(dev_name, np.array(buckets, dtype=rollup_dtype))
+        finally:
+            with self.lock:
+                self.flushing = {}
+                for tier in self.tiers:
+                    tier.flushing = {}
+        self.store.remove_oldest(keep_day=now_day)
+        for tier in self.tiers:
+            tier.store.remove_oldest(keep_day=now_day)
+        self.metrics['cold_segments'] += self.store.migrate_cold(time(), self.migrate_budget)
+
+
+    def query_records(self, dev_name:str, t_start:float, t_end:float):
+        # raw samples of a device in a time range (numpy array of record_dtype), including the ones which are not written yet
+        with self.lock:
+            pending = [sample for sample in self.flushing.get(dev_name, []) + self.pending.get(dev_name, [])
+                       if t_start <= sample[0] <= t_end]
+        samples = self.store.query(dev_name, t_start, t_end)
+        if pending:
+            pending = np.array(pending, dtype=record_dtype)
+            samples = np.concatenate([samples, pending[pending['timestamp'] > (samples['timestamp'][-1] if len(samples) else 0)]])
+        return samples
+
+
+    def query(self, dev_name:str, t_start:float, t_end:float):
+        """
+        The function `query` returns recorded samples of a device in a time range, including the ones which
+        are not written yet.
+
+        :return: numpy arrays of timestamps, values (NaN - no value) and quality codes.
+        """
+        samples = self.query_records(dev_name, t_start, t_end)
+        return samples['timestamp'], samples['value'], samples['quality']
+
+
+    def query_tier(self, tier:RollupTier, dev_name:str, t_start:float, t_end:float):
+        # buckets of a tier which overlap a time range (numpy array of rollup_dtype), including open and not written ones
+        with self.lock:
+            memory_buckets = tier.memory_buckets(dev_name, t_start, t_end)
+        buckets = tier.store.query(dev_name, t_start - tier.resolution + 1e-6, t_end)
+        if memory_buckets:
+            buckets = np.concatenate([buckets, np.array(memory_buckets, dtype=rollup_dtype)])
+        return merge_buckets(buckets)
+
+
+    def query_range(self, dev_name:str, t_start:float, t_end:float, max_points:int):
+        """
+        The function `query_range` returns history of a device in a time range at the finest resolution which
+        fits `max_points`: raw samples or buckets of a rollup tier. If none fits, buckets of the coarsest tier
+        are merged (or every k-th raw sample is taken if there are no tiers), so there are never more than
+        `max_points` rows.
+
+        :return: resolution (0 for raw samples, bucket size in seconds otherwise) and a numpy array of
+        `record_dtype` (raw samples) or `rollup_dtype` (buckets).
+        """
+        try:
+            max_points = max(int(max_points), 1)
+            with self.lock:
+                num_pending = sum(1 for sample in self.flushing.get(dev_name, []) + self.pending.get(dev_name, [])
+                                  if t_start <= sample[0] <= t_end)
+            if not self.tiers or self.store.count(dev_name, t_start, t_end) + num_pending <= max_points:
+                samples = self.query_records(dev_name, t_start, t_end)
+                return 0, samples[::-(-len(samples) // max_points)] if len(samples) > max_points else samples
+            for tier in self.tiers:
+                if (t_end - t_start) / tier.resolution <= max_points or tier is self.tiers[-1]:
+                    # partial buckets at the ends of the range can exceed the budget too
+                    return tier.resolution, decimate_buckets(self.query_tier(tier, dev_name, t_start, t_end), max_points)
+        except Exception as err:
+            raise type(err)(f'RefrigHistorian.query_range: {err}')
+
+
+    def get_metrics(self):
+        return dict(self.metrics, pending=self.num_pending, total_size=self.store.total_size,
+                    tiers_size={tier.resolution:tier.store.total_size for tier in self.tiers})
+
+
+    def process_error(self, err):
+        try:
+            self.err_queue.put_nowait(err)
+        except Full:
+            print(f'RefrigHistorian: error queue is full!!! \n {err}')
+
+
+class HistoryQueryService(Thread):
+    '''
+    answers history requests {'id', 'devices', 'start', 'end', 'max_points'} from recorded history: every device
+    is decimated on the server side (see `RefrigHistorian.query_range`) and sent to refrig/history/reply/<id> in
+    zlib compressed chunks: header (version, flags, sequence number, device index in the request, resolution, rows)
+    + rows of `record_dtype` (resolution 0) or `rollup_dtype`; the last chunk of a reply has the `last` flag
+    '''
+
+    reply_version = 1
+    reply_header = struct.Struct('<BBHHdI')
+    flag_last = 1
+    flag_error = 2 # body is an utf-8 error message
+    max_points_limit = 100000
+    oversample = 4 # history is queried for up to this times more points and decimated, so a finer tier can be used
+
+    def __init__(self, historian:RefrigHistorian, publish_func, error_queue, chunk_rows:int = 2000, name: str | None = None) -> None:
+        """
+        :param publish_func: The `publish_func` parameter is a function(topic, payload) which sends replies
+        :param chunk_rows: The `chunk_rows` parameter is the max number of rows in one reply message
+        """
+        try:
+            super().__init__(name=name, daemon=True)
+            self.historian = historian
+            self.publish = publish_func
+            self.err_queue = error_queue
+            self.chunk_rows = chunk_rows
+            self.requests = Queue(maxsize=10)
+        except Exception as err:
+            raise type(err)(f'HistoryQueryService init: {err}')
+
+
+    def submit(self, request:dict):
+        """
+        The function `submit` queues a request (requests are answered one by one in the service thread).
+        :raises BufferError: if there are too many queued requests.
+        """
+        try:
+            self.requests.put_nowait(request)
+        except Full:
+            raise BufferError(f'HistoryQueryService: too many history requests')
+
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            try:
+                self.answer(request)
+            except Exception as err:
+                self.process_error(f'HistoryQueryService: {err}')
+
+
+    def answer(self, request:dict):
+        """
+        The function `answer` queries history of every requested device and sends it in chunks; an invalid
+        request is answered with an error message.
+        """
+        request_id = str(request.get('id', ''))
+        if not request_id or any(char in request_id for char in '/#+'):
+            raise ValueError(f'invalid request id {request_id!r}')
+        topic = f'refrig/history/reply/{request_id}'
+        try:
+            devices = [str(dev_name) for dev_name in request['devices']]
+            t_start, t_end = float(request['start']), float(request['end'])
+            max_points = min(max(int(request.get('max_points', 2000)), 1), self.max_points_limit)
+            if t_end < t_start:
+                raise ValueError(f'end of range is before its start')
+        except Exception as err:
+            self.publish(topic, self.encode_chunk(0, 0, 0, b'', 0, self.flag_last | self.flag_error, f'{type(err).__name__}: {err}'))
+            return
+        seq = 0
+        for dev_idx, dev_name in enumerate(devices):
+            resolution, data = self.historian.query_range(dev_name, t_start, t_end, max_points * self.oversample)
+            if resolution:
+                data = decimate_buckets(data, max_points)
+            elif len(data) > max_points: # every k-th sample
+                data = data[::-(-len(data) // max_points)]
+            for start in range(0, max(len(data), 1), self.chunk_rows): # empty history is one empty chunk
+                rows = data[start:start + self.chunk_rows]
+                last = dev_idx == len(devices) - 1 and start + self.chunk_rows >= len(data)
+                self.publish(topic, self.encode_chunk(seq, dev_idx, resolution, rows.tobytes(), len(rows), self.flag_last if last else 0))
+                seq += 1
+        if not devices:
+            self.publish(topic, self.encode_chunk(0, 0, 0, b'', 0, self.flag_last))
+
+
+    def encode_chunk(self, seq:int, dev_idx:int, resolution:float, body:bytes, num_rows:int, flags:int, error:str = ''):
+        if flags & self.flag_error:
+            body = error.encode()
+        return zlib.compress(self.reply_header.pack(self.reply_version, flags, seq & 0xFFFF, dev_idx, resolution, num_rows) + body)
+
+
+    def process_error(self, err):
+        try:
+            self.err_queue.put_nowait(err)
+        except Full:
+            print(f'HistoryQueryService: error queue is full!!! \n {err}')
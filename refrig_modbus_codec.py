@@ -0,0 +1,108 @@
+# binary encoding/decoding of 32-bit modbus values (2 registers per value)
+# word_order: order of the 2 registers of a value ('big' - high word first)
+# byte_order: order of the bytes inside each register ('big' - modbus standard)
+import struct
+from functools import lru_cache
+
+
+class ModbusValueCodec():
+
+    data_types = {'float32':'f', 'uint32':'I', 'int32':'i'}
+    orders = ('big', 'little')
+
+    def __init__(self, data_type:str = 'float32', word_order:str = 'little', byte_order:str = 'little', divider:float = 1) -> None:
+        try:
+            if data_type not in self.data_types:
+                raise ValueError(f'unknown data type {data_type}')
+            if word_order not in self.orders or byte_order not in self.orders:
+                raise ValueError(f'word/byte order should be one of {self.orders}, got {word_order}/{byte_order}')
+            if divider == 0:
+                raise ValueError(f'divider should not be 0')
+            self.data_type = data_type
+            self.word_order = word_order
+            self.byte_order = byte_order
+            self.divider = divider
+            # registers are packed with reg_fmt and unpacked as values with val_fmt (and vice versa for encoding)
+            self.reg_fmt = '>' if word_order == byte_order else '<'
+            self.val_fmt = '<' if word_order == 'little' else '>'
+            self.type_char = self.data_types[data_type]
+        except Exception as err:
+            raise type(err)(f'ModbusValueCodec init: {err}')
+
+
+    def decode(self, registers):
+        """
+        The function `decode` converts a block of registers to a list of values (2 registers per value).
+
+        :param registers: The `registers` parameter is a sequence of 16-bit register values, its length
+        should be even
+        :return: a list of decoded values.
+        """
+        try:
+            num_values, rest = divmod(len(registers), 2)
+            if rest:
+                raise ValueError(f'odd number of registers: {len(registers)}')
+            raw = struct.pack(f'{self.reg_fmt}{num_values*2}H', *registers)
+            values = struct.unpack(f'{self.val_fmt}{num_values}{self.type_char}', raw)
+            if self.divider != 1:
+                return [value / self.divider for value in values]
+            return list(values)
+        except Exception as err:
+            raise type(err)(f'ModbusValueCodec.decode: {err}')
+
+
+    def encode(self, values):
+        """
+        The function `encode` converts a list of values to a flat list of registers (2 registers per value).
+
+        :param values: The `values` parameter is a sequence of numbers to encode
+        :return: a list of 16-bit register values.
+        """
+        try:
+            if self.divider != 1:
+                values = [value * self.divider for value in values]
+            if self.type_char != 'f':
+                values = [int(round(value)) for value in values]
+            raw = struct.pack(f'{self.val_fmt}{len(values)}{self.type_char}', *values)
+            return list(struct.unpack(f'{self.reg_fmt}{len(values)*2}H', raw))
+        except Exception as err:
+            raise type(err)(f'ModbusValueCodec.encode: {err}')
+
+
+    def __repr__(self) -> str:
+        return f'ModbusValueCodec({self.data_type}, word_order={self.word_order}, byte_order={self.byte_order}, divider={self.divider})'
+
+
+@lru_cache(maxsize=None)
+def get_codec(data_type:str = 'float32', word_order:str = 'little', byte_order:str = 'little', divider:float = 1):
+    # codecs are stateless, share one instance per format
+    return ModbusValueCodec(data_type, word_order, byte_order, divider)
+
+
+def codec_from_config(dev_conf:dict | None, default:ModbusValueCodec):
+    """
+    The function `codec_from_config` returns a codec for a device, format options of the device config
+    (`data_type`, `word_order`, `byte_order`, `divider`) override the ones of the `default` codec.
+
+    :param dev_conf: The `dev_conf` parameter is a device config dictionary (can be None)
+    :param default: The `default` parameter is the codec of the interface
+    :type default: ModbusValueCodec
+    :return: a `ModbusValueCodec` object.
+    """
+    if dev_conf is None:
+        return default
+    return get_codec(dev_conf.get('data_type', default.data_type), dev_conf.get('word_order', default.word_order),
+                     dev_conf.get('byte_order', default.byte_order), dev_conf.get('divider', default.divider))
+
+
+def crc16_modbus(data:bytes):
+    # CRC of modbus RTU frames (appended little endian)
+    crc = 0xFFFF
+    for cur_byte in data:
+        crc ^= cur_byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+    return crc
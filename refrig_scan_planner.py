@@ -0,0 +1,161 @@
+# scan planning for bus interfaces:
+# groups devices by modbus_id and poll period and merges close register ranges into block reads,
+# PollScheduler decides which poll classes are due
+from time import monotonic
+
+
+class ScanBlock():
+    def __init__(self, modbus_id:int, start_register:int, num_registers:int, devices:list, poll_period:float | None = None) -> None:
+        self.modbus_id = modbus_id
+        self.start_register = start_register
+        self.num_registers = num_registers
+        self.devices = devices # list of (dev_name, dev_conf) tuples, sorted by start_register
+        self.poll_period = poll_period
+
+
+    def split_registers(self, registers:list):
+        """
+        The function `split_registers` splits registers of a block read back into per-device register lists.
+
+        :param registers: The `registers` parameter is a list of register values returned by a block read
+        :type registers: list
+        :return: a dictionary with device names as keys and lists of their registers as values.
+        """
+        try:
+            if len(registers) < self.num_registers:
+                raise ValueError(f'expected {self.num_registers} registers, got {len(registers)}')
+            dev_registers = {}
+            for dev_name, dev_conf in self.devices:
+                offset = dev_conf['start_register'] - self.start_register
+                dev_registers.update({dev_name:registers[offset:offset+dev_conf['num_registers']]})
+            return dev_registers
+        except Exception as err:
+            raise type(err)(f'ScanBlock.split_registers for unit {self.modbus_id}: {err}')
+
+
+    def __repr__(self) -> str:
+        dev_names = [dev_name for dev_name, _ in self.devices]
+        return f'ScanBlock(unit={self.modbus_id}, start={self.start_register}, count={self.num_registers}, period={self.poll_period}, devices={dev_names})'
+
+
+class ModbusScanPlanner():
+
+    max_block_limit = 125 # modbus limit for read_holding_registers
+
+    def __init__(self, max_gap:int = 4, max_block_size:int = 60) -> None:
+        if max_gap < 0:
+            raise ValueError(f'ModbusScanPlanner: max_gap should be >= 0, got {max_gap}')
+        if not 0 < max_block_size <= self.max_block_limit:
+            raise ValueError(f'ModbusScanPlanner: max_block_size should be in (0, {self.max_block_limit}], got {max_block_size}')
+        self.max_gap = max_gap
+        self.max_block_size = max_block_size
+
+
+    def plan(self, read_dev_conf:dict, default_period:float | None = None):
+        """
+        The function `plan` groups devices by modbus id and poll period and merges adjacent or
+        near-adjacent register ranges into as few block reads as possible.
+
+        :param read_dev_conf: The `read_dev_conf` parameter is a dictionary of sensor devices configs
+        (`modbus_id`, `start_register`, `num_registers`, optional `poll_period`)
+        :type read_dev_conf: dict
+        :param default_period: The `default_period` parameter is the poll period of devices without
+        `poll_period` in config
+        :type default_period: float | None
+        :return: a list of `ScanBlock` objects.
+        """
+        try:
+            units = {}
+            for dev_name, dev_conf in read_dev_conf.items():
+                if dev_conf['num_registers'] <= 0:
+                    raise ValueError(f'Invalid register config for {dev_name}')
+                if dev_conf['num_registers'] > self.max_block_size:
+                    raise ValueError(f'{dev_name} needs {dev_conf["num_registers"]} registers, max block size is {self.max_block_size}')
+                poll_period = dev_conf.get('poll_period', default_period)
+                units.setdefault((dev_conf['modbus_id'], poll_period), []).append((dev_name, dev_conf))
+
+            blocks = []
+            for (modbus_id, poll_period), devices in units.items():
+                devices.sort(key=lambda dev: dev[1]['start_register'])
+                cur_block = None
+                for dev_name, dev_conf in devices:
+                    dev_start = dev_conf['start_register']
+                    dev_end = dev_start + dev_conf['num_registers']
+                    if cur_block is not None:
+                        block_end = cur_block.start_register + cur_block.num_registers
+                        new_size = max(block_end, dev_end) - cur_block.start_register
+                        if dev_start - block_end <= self.max_gap and new_size <= self.max_block_size:
+                            cur_block.num_registers = new_size
+                            cur_block.devices.append((dev_name, dev_conf))
+                            continue
+                    cur_block = ScanBlock(modbus_id, dev_start, dev_conf['num_registers'], [(dev_name, dev_conf)], poll_period)
+                    blocks.append(cur_block)
+            return blocks
+        except Exception as err:
+            raise type(err)(f'ModbusScanPlanner.plan: {err}')
+
+
+    def split_block(self, block:ScanBlock):
+        """
+        The function `split_block` breaks a block into single-device blocks (used when a device rejects
+        a block read, e.g. because of unmapped registers in a gap).
+
+        :param block: The `block` parameter is a `ScanBlock` to split
+        :type block: ScanBlock
+        :return: a list of `ScanBlock` objects with one device each.
+        """
+        return [ScanBlock(block.modbus_id, dev_conf['start_register'], dev_conf['num_registers'], [(dev_name, dev_conf)], block.poll_period)
+                for dev_name, dev_conf in block.devices]
+
+
+class PollScheduler():
+    '''
+    multi-rate scheduler for poll classes (one class per poll period);
+    every class has its own deadline which is advanced by its period, so
+    the cycle does not drift by the scan duration
+    '''
+    def __init__(self) -> None:
+        self.deadlines = {} # poll_period: next deadline (monotonic time)
+        self.overruns = 0 # number of times a poll class was late by more than its period
+
+
+    def add_poll_class(self, poll_period:float):
+        if poll_period <= 0:
+            raise ValueError(f'PollScheduler: poll period should be > 0, got {poll_period}')
+        self.deadlines.setdefault(poll_period, monotonic())
+
+
+    def pop_due(self, now:float | None = None):
+        """
+        The function `pop_due` returns poll classes which deadlines have passed (fastest first) and
+        moves their deadlines to the next period.
+
+        :param now: The `now` parameter is the current monotonic time, taken from clock if not specified
+        :type now: float | None
+        :return: a list of due poll periods.
+        """
+        if now is None:
+            now = monotonic()
+        due = []
+        for poll_period, deadline in self.deadlines.items():
+            if deadline > now:
+                continue
+            due.append(poll_period)
+            deadline += poll_period
+            if deadline <= now: # late by more than a period, skip missed polls instead of bursting
+                self.overruns += 1
+                deadline = now + poll_period
+            self.deadlines[poll_period] = deadline
+        return sorted(due)
+
+
+    def time_to_next(self, now:float | None = None):
+        """
+        The function `time_to_next` returns time in seconds until the next poll class is due (0 if
+        some class is already due).
+        """
+        if not self.deadlines:
+            return 1
+        if now is None:
+            now = monotonic()
+        return max(0, min(self.deadlines.values()) - now)
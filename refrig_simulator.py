@@ -0,0 +1,374 @@
+# modbus device simulator for running/profiling the real interfaces without hardware
+# register map is built from config.yaml:
+#   box units (valves feedback/control, levels, pressures, temperatures) are served over a pseudo-terminal (RTU),
+#   PKT8 units (resistances of silicon thermometers) are served over localhost TCP (RTU over TCP gateway)
+# usage: python refrig_simulator.py [--latency 0.005] [--jitter 0.002] [--baudrate 115200] [--profile 20]
+# (pseudo-terminals need a unix-like OS)
+import argparse
+import os
+import socketserver
+import struct
+import sys
+import threading
+import tty
+from pathlib import Path
+from random import uniform
+from time import monotonic, sleep
+
+from refrig_comm_ifaces import ModbusComInterface, ModbusRtuOverTcpComInterface
+from refrig_modbus_codec import codec_from_config, crc16_modbus
+
+
+class SimDevice():
+    '''
+    simulated value of a device: random walk around its value, moves to target with limited rate
+    '''
+    def __init__(self, name:str, unit:int, start_register:int, num_registers:int, codec, value:float,
+                 noise:float = 0, rate:float | None = None) -> None:
+        self.name = name
+        self.unit = unit
+        self.start_register = start_register
+        self.num_registers = num_registers
+        self.codec = codec
+        self.value = value
+        self.target = value
+        self.noise = noise
+        self.rate = rate # units per second, None - jumps to target
+        self.last_update = monotonic()
+
+
+    def get_registers(self):
+        now = monotonic()
+        if self.rate is None:
+            self.value = self.target
+        else:
+            step = self.rate * (now - self.last_update)
+            self.value += max(-step, min(step, self.target - self.value))
+        self.last_update = now
+        value = self.value + uniform(-self.noise, self.noise) if self.noise else self.value
+        registers = self.codec.encode([value])
+        return (registers + [0] * self.num_registers)[:self.num_registers]
+
+
+class SimRegisterMap():
+    def __init__(self, strict:bool = False) -> None:
+        self.strict = strict # unmapped registers cause "illegal data address" exception, otherwise read as 0
+        self.read_index = {} # (unit, register): (device, offset)
+        self.write_index = {} # (unit, start_register): (control device name, codec, feedback device)
+        self.units = set()
+
+
+    def add_device(self, device:SimDevice):
+        self.units.add(device.unit)
+        for offset in range(device.num_registers):
+            self.read_index[(device.unit, device.start_register + offset)] = (device, offset)
+
+
+    def add_control(self, dev_name:str, unit:int, start_register:int, codec, feedback:SimDevice | None):
+        self.units.add(unit)
+        self.write_index[(unit, start_register)] = (dev_name, codec, feedback)
+
+
+    def read(self, unit:int, start_register:int, count:int):
+        """
+        The function `read` returns registers of a unit or raises `LookupError` with modbus exception code.
+        """
+        registers = []
+        cur_device_regs = {}
+        for register in range(start_register, start_register + count):
+            entry = self.read_index.get((unit, register), None)
+            if entry is None:
+                if self.strict:
+                    raise LookupError(2) # illegal data address
+                registers.append(0)
+                continue
+            device, offset = entry
+            if device.name not in cur_device_regs: # every device is encoded once per request
+                cur_device_regs[device.name] = device.get_registers()
+            registers.append(cur_device_regs[device.name][offset])
+        return registers
+
+
+    def write(self, unit:int, start_register:int, registers:list):
+        if len(registers) % 2:
+            raise LookupError(3) # illegal data value
+        for offset in range(0, len(registers), 2):
+            entry = self.write_index.get((unit, start_register + offset), None)
+            if entry is None:
+                raise LookupError(2)
+            _, codec, feedback = entry
+            if feedback is not None:
+                feedback.target = codec.decode(registers[offset:offset+2])[0]
+
+
+def build_register_map(device_cfg:dict, strict:bool = False):
+    """
+    The function `build_register_map` builds simulated box and PKT8 register maps from the `devices`
+    section of config.yaml, values are encoded with the same codecs the interfaces use.
+
+    :param device_cfg: The `device_cfg` parameter is the `devices` section of config
+    :return: register maps of box units and PKT8 units.
+    """
+    box_map = SimRegisterMap(strict)
+    for dev_name, dev_conf in device_cfg.get('box_sensor_devices', {}).items():
+        codec = codec_from_config(dev_conf, ModbusComInterface.read_codec)
+        match dev_conf.get('converter_type', 'Default'):
+            case 'Valve':
+                value, noise, rate = uniform(0, 100), 0.05, 20 # valve travels 20 %/s
+            case 'Pressure' if dev_name.startswith('Pvac'):
+                value, noise, rate = uniform(1e-4, 1e-2), 1e-5, None
+            case 'Pressure':
+                value, noise, rate = uniform(1, 3), 0.001, None
+            case _:
+                value, noise, rate = uniform(20, 300), 0.01, None
+        box_map.add_device(SimDevice(dev_name, dev_conf['modbus_id'], dev_conf['start_register'], dev_conf['num_registers'],
+                                     codec, value, noise, rate))
+    box_devices = {device.name:device for device, _ in box_map.read_index.values()}
+    for dev_name, dev_conf in device_cfg.get('box_control_devices', {}).items():
+        if not isinstance(dev_conf, dict) or 'modbus_id' not in dev_conf:
+            continue
+        feedback = box_devices.get(dev_conf.get('feedback', f'{dev_name}_fb'), None)
+        box_map.add_control(dev_name, dev_conf['modbus_id'], dev_conf['start_register'],
+                            codec_from_config(dev_conf, ModbusComInterface.write_codec), feedback)
+
+    therm_map = SimRegisterMap(strict)
+    for dev_name, dev_conf in device_cfg.get('therm_sensor_devices', {}).items():
+        codec = codec_from_config(dev_conf, ModbusRtuOverTcpComInterface.read_codec)
+        therm_map.add_device(SimDevice(dev_name, dev_conf['modbus_id'], dev_conf['start_register'], dev_conf['num_registers'],
+                                       codec, uniform(1100, 4900), 0.5)) # resistance, Ohm
+    return box_map, therm_map
+
+
+class SimBusTiming():
+    def __init__(self, latency:float = .005, jitter:float = 0, baudrate:int | None = None) -> None:
+        self.latency = latency # device response time, seconds
+        self.jitter = jitter # random extra response time, seconds
+        self.baudrate = baudrate # line speed to emulate (None - no line delay)
+
+
+    def get_delay(self, num_bytes:int):
+        delay = self.latency + uniform(0, self.jitter)
+        if self.baudrate:
+            delay += num_bytes * 10 / self.baudrate # 8N1: 10 bits per byte
+        return delay
+
+
+class SimModbusSlave():
+    '''
+    modbus RTU protocol handling of simulated units (functions 3, 6, 16)
+    '''
+    def __init__(self, register_map:SimRegisterMap, timing:SimBusTiming) -> None:
+        self.register_map = register_map
+        self.timing = timing
+        self.transactions = 0
+
+
+    def read_request(self, read_exactly):
+        """
+        The function `read_request` reads one request frame with `read_exactly(num_bytes)` function.
+        """
+        header = read_exactly(2)
+        match header[1]:
+            case 3 | 4 | 6:
+                body = read_exactly(6)
+            case 16:
+                body = read_exactly(5)
+                body += read_exactly(body[4] + 2)
+            case _:
+                raise ValueError(f'unsupported function code {header[1]}')
+        return header + body
+
+
+    def process_request(self, frame:bytes):
+        """
+        The function `process_request` returns the response frame for a request (None if the unit
+        should stay silent: wrong CRC or unknown unit).
+        """
+        if crc16_modbus(frame[:-2]) != struct.unpack('<H', frame[-2:])[0]:
+            return None
+        unit, func_code = frame[0], frame[1]
+        if unit not in self.register_map.units:
+            return None
+        self.transactions += 1
+        try:
+            match func_code:
+                case 3 | 4:
+                    address, count = struct.unpack('>HH', frame[2:6])
+                    registers = self.register_map.read(unit, address, count)
+                    pdu = struct.pack(f'>BBB{count}H', unit, func_code, count * 2, *registers)
+                case 6:
+                    address, value = struct.unpack('>HH', frame[2:6])
+                    self.register_map.write(unit, address, [value])
+                    pdu = frame[:6]
+                case 16:
+                    address, count = struct.unpack('>HH', frame[2:6])
+                    registers = list(struct.unpack(f'>{count}H', frame[7:7 + count * 2]))
+                    self.register_map.write(unit, address, registers)
+                    pdu = frame[:6]
+        except LookupError as err:
+            pdu = bytes([unit, func_code | 0x80, err.args[0]])
+        return pdu + struct.pack('<H', crc16_modbus(pdu))
+
+
+    def serve_transaction(self, read_exactly, write):
+        frame = self.read_request(read_exactly)
+        response = self.process_request(frame)
+        if response is None:
+            return
+        sleep(self.timing.get_delay(len(frame) + len(response)))
+        write(response)
+
+
+class SimRtuPtyServer(threading.Thread):
+    '''
+    RTU bus on a pseudo-terminal, connect the serial interface to `port_name`
+    '''
+    def __init__(self, slave:SimModbusSlave) -> None:
+        super().__init__(name='sim_rtu_pty', daemon=True)
+        self.slave = slave
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        self.port_name = os.ttyname(self.slave_fd)
+
+
+    def read_exactly(self, num_bytes:int):
+        data = b''
+        while len(data) < num_bytes:
+            data += os.read(self.master_fd, num_bytes - len(data))
+        return data
+
+
+    def run(self):
+        while True:
+            try:
+                self.slave.serve_transaction(self.read_exactly, lambda data: os.write(self.master_fd, data))
+            except Exception as err:
+                print(f'SimRtuPtyServer: {err}')
+
+
+class SimRtuOverTcpServer(socketserver.ThreadingTCPServer):
+    '''
+    RTU over TCP gateway on localhost; `concurrency` requests are served at once
+    (1 for a gateway with a single serial line behind it)
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, slave:SimModbusSlave, port:int = 0, concurrency:int = 1) -> None:
+        self.slave = slave
+        self.bus_semaphore = threading.Semaphore(concurrency)
+        super().__init__(('127.0.0.1', port), SimRtuOverTcpHandler)
+        self.port = self.server_address[1]
+
+
+class SimRtuOverTcpHandler(socketserver.StreamRequestHandler):
+
+    def read_exactly(self, num_bytes:int):
+        data = self.rfile.read(num_bytes)
+        if len(data) < num_bytes:
+            raise EOFError('connection closed')
+        return data
+
+
+    def handle(self):
+        while True:
+            try:
+                frame = self.server.slave.read_request(self.read_exactly)
+            except (EOFError, ConnectionError):
+                return
+            with self.server.bus_semaphore:
+                response = self.server.slave.process_request(frame)
+                if response is None:
+                    continue
+                sleep(self.server.slave.timing.get_delay(len(frame) + len(response)))
+            self.wfile.write(response)
+
+
+def get_expected_range(iface, dev_name:str, device:SimDevice):
+    # interface's conversion of the simulated raw value, widened by the noise and float32 precision of registers
+    delta = device.noise + abs(device.value) * 1e-6
+    if hasattr(iface, 'read_batch'):
+        values = [iface.read_batch.convert_dict({dev_name:raw_value})[dev_name] for raw_value in (device.value - delta, device.value + delta)]
+    else:
+        values = [iface.read_converters[dev_name](raw_value) for raw_value in (device.value - delta, device.value + delta)]
+    return min(values), max(values)
+
+
+def profile_interfaces(core_path:Path, cfg:dict, box_port:str, therm_port:int, box_map:SimRegisterMap, therm_map:SimRegisterMap,
+                       num_scans:int = 20):
+    """
+    The function `profile_interfaces` runs full scans of the real box and PKT8 interfaces against the
+    simulator, prints scan durations and checks the values in the value table against the simulated ones.
+
+    :return: a list of mismatches (dev_name, value in the table, expected range).
+    """
+    from queue import Queue
+    from refrig_value_table import SharedValueTable
+    err_queue = Queue()
+    box_con_info = dict(cfg['connections']['box_serial'], port=box_port)
+    therm_con_info = dict(cfg['connections']['therm_serial'], ip='127.0.0.1', port=therm_port)
+    values_table = SharedValueTable(list(cfg['devices']['box_sensor_devices']) + list(cfg['devices']['therm_sensor_devices']),
+                                    sources=['box_iface', 'therm_iface'])
+    mismatches = []
+    try:
+        box_iface = ModbusComInterface(core_path, values_table, err_queue, box_con_info, cfg['devices']['box_sensor_devices'],
+                                       cfg['devices']['box_control_devices'], name='box_iface')
+        therm_iface = ModbusRtuOverTcpComInterface(core_path, values_table, err_queue, therm_con_info, cfg['devices']['therm_sensor_devices'],
+                                                   name='therm_iface')
+        for iface, register_map in ((box_iface, box_map), (therm_iface, therm_map)):
+            iface.connect_iface()
+            durations = []
+            for _ in range(num_scans):
+                start = monotonic()
+                iface.read_devices()
+                durations.append(monotonic() - start)
+            durations.sort()
+            print(f'{iface.name}: {len(iface.read_dev_conf)} devices, scan mean {sum(durations)/len(durations)*1000:.1f} ms, '
+                  f'median {durations[len(durations)//2]*1000:.1f} ms, max {durations[-1]*1000:.1f} ms')
+            sim_devices = {device.name:device for device, _ in register_map.read_index.values()}
+            for dev_name in iface.read_dev_conf:
+                record = values_table.get_record(dev_name)
+                expected = get_expected_range(iface, dev_name, sim_devices[dev_name])
+                if record is None or record[0] is None or not expected[0] <= record[0] <= expected[1]:
+                    mismatches.append((dev_name, None if record is None else record[0], expected))
+        errors = []
+        while not err_queue.empty():
+            errors.append(err_queue.get())
+        print(f'{len(errors)} errors reported' + (f', first: {errors[0]}' if errors else ''))
+        print(f'{len(mismatches)} values differ from the simulated ones' +
+              ''.join(f'\n    {dev_name}: {value}, expected {expected[0]}..{expected[1]}' for dev_name, value, expected in mismatches))
+    finally:
+        values_table.close()
+    return mismatches
+
+
+if __name__ == '__main__':
+    import yaml
+    parser = argparse.ArgumentParser(description='modbus simulator of refrigerator devices')
+    parser.add_argument('--config', default=Path(__file__).parent.joinpath('config.yaml'))
+    parser.add_argument('--latency', type=float, default=.005, help='device response time, seconds')
+    parser.add_argument('--jitter', type=float, default=.002, help='random extra response time, seconds')
+    parser.add_argument('--baudrate', type=int, default=None, help='emulated line speed (box_serial baudrate by default)')
+    parser.add_argument('--tcp-port', type=int, default=0, help='port of the PKT8 gateway (random by default)')
+    parser.add_argument('--concurrency', type=int, default=1, help='requests served at once by the PKT8 gateway')
+    parser.add_argument('--strict', action='store_true', help='unmapped registers return "illegal data address"')
+    parser.add_argument('--profile', type=int, default=0, metavar='SCANS', help='profile the real interfaces with SCANS scans and exit')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as stream:
+        cfg = yaml.safe_load(stream)
+    box_map, therm_map = build_register_map(cfg['devices'], args.strict)
+    baudrate = args.baudrate or int(cfg['connections']['box_serial']['baudrate'])
+    rtu_server = SimRtuPtyServer(SimModbusSlave(box_map, SimBusTiming(args.latency, args.jitter, baudrate)))
+    rtu_server.start()
+    tcp_server = SimRtuOverTcpServer(SimModbusSlave(therm_map, SimBusTiming(args.latency, args.jitter, baudrate)),
+                                     args.tcp_port, args.concurrency)
+    threading.Thread(target=tcp_server.serve_forever, daemon=True).start()
+    print(f'box units {sorted(box_map.units)} on {rtu_server.port_name}, PKT8 units {sorted(therm_map.units)} on 127.0.0.1:{tcp_server.port}')
+
+    if args.profile:
+        if profile_interfaces(Path(__file__).parent, cfg, rtu_server.port_name, tcp_server.port, box_map, therm_map, args.profile):
+            sys.exit(1)
+    else:
+        while True:
+            sleep(1)
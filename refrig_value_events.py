@@ -0,0 +1,80 @@
+# change notification channel for live values:
+# the value table puts batches of changed values {dev_name: (value, timestamp, quality)} to the queue of every subscriber
+# (or of all written values if the subscriber records every sample),
+# consumers block on their queue and react as events arrive instead of polling the table on a timer
+from multiprocessing import Queue, RawValue
+from queue import Empty, Full
+
+
+class ValueSubscription():
+    '''
+    change events queue of one consumer, should be created before interface processes are started
+    (every writer process needs its own handle to the queue)
+    '''
+
+    def __init__(self, name:str, maxsize:int = 1000, changes_only:bool = True) -> None:
+        self.name = name
+        self.changes_only = changes_only # False - every written value is an event, even if it is the same
+        self.queue = Queue(maxsize=maxsize)
+        self.overflow = RawValue('b', 0) # some events were dropped, consumer should re-read the whole table
+
+
+    def put(self, events:dict):
+        """
+        The function `put` sends a batch of events to the consumer, never blocks the writer (if the
+        queue is full the batch is dropped and the consumer is told to resync).
+
+        :param events: The `events` parameter is a dictionary {dev_name: (value, timestamp, quality)}
+        :type events: dict
+        """
+        try:
+            self.queue.put_nowait(events)
+        except Full:
+            self.overflow.value = 1
+
+
+    def get(self, timeout:float | None = None):
+        """
+        The function `get` waits for events and returns all pending events merged (the latest event of
+        every device).
+
+        :param timeout: The `timeout` parameter is the time in seconds to wait for the first event, 0 -
+        don't wait, None - wait forever
+        :return: a dictionary {dev_name: (value, timestamp, quality)}, empty on timeout, None if events were lost
+        (consumer should re-read the whole table).
+        """
+        events = {}
+        try:
+            if timeout is None or timeout > 0:
+                events.update(self.queue.get(timeout=timeout))
+            while True:
+                events.update(self.queue.get_nowait())
+        except Empty:
+            pass
+        if self.overflow.value:
+            self.overflow.value = 0
+            return None
+        return events
+
+
+    def get_batches(self, timeout:float | None = None):
+        """
+        The function `get_batches` waits for events and returns all pending batches as they were put
+        (for consumers which need every sample, not only the latest one).
+
+        :param timeout: The `timeout` parameter is the time in seconds to wait for the first batch, 0 -
+        don't wait, None - wait forever
+        :return: a list of dictionaries {dev_name: (value, timestamp, quality)} (empty on timeout) and
+        True if some batches were dropped since the last call.
+        """
+        batches = []
+        try:
+            if timeout is None or timeout > 0:
+                batches.append(self.queue.get(timeout=timeout))
+            while True:
+                batches.append(self.queue.get_nowait())
+        except Empty:
+            pass
+        lost = bool(self.overflow.value)
+        self.overflow.value = 0
+        return batches, lost
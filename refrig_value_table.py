@@ -0,0 +1,303 @@
+# process shared table of live device values:
+# every device has a fixed slot, values, timestamps, quality codes and sources are packed arrays in one shared memory block,
+# readers take lock-free snapshots (per slot sequence counters, torn slots are re-read),
+# changed values are announced to subscribers (see refrig_value_events.py)
+from multiprocessing import shared_memory
+from time import time
+
+from refrig_value_events import ValueSubscription
+
+
+class SharedValueTable():
+    '''
+    fixed-slot value table in `multiprocessing.shared_memory`, a drop-in for the values dict
+    (update/get/items/keys); every slot should be written by one process only (device's interface),
+    reads never block writers.
+    Good values older than their `stale_after` time are reported as stale (checked at read time).
+    Changes of value or quality are sent to all subscriptions as events {dev_name: (value, timestamp, quality)}.
+    '''
+
+    qualities = ('good', 'stale', 'comm_error', 'out_of_range', 'substituted')
+    severity = ('good', 'substituted', 'stale', 'out_of_range', 'comm_error') # from best to worst
+    seq_mask = 0xFFFFFFFF
+
+    def __init__(self, dev_names:list, sources:list | None = None, stale_after:dict | None = None, default_stale_after:float = 5,
+                 shm_name:str | None = None, subscriptions:list | None = None) -> None:
+        """
+        :param dev_names: The `dev_names` parameter is a list of devices (one slot per device)
+        :param sources: The `sources` parameter is a list of names of interfaces writing to the table
+        :param stale_after: The `stale_after` parameter is a dictionary {dev_name: seconds} of value lifetimes
+        :param default_stale_after: The `default_stale_after` parameter is the value lifetime of other devices
+        :param shm_name: The `shm_name` parameter is the name of existing table to attach to (new table by default)
+        :param subscriptions: The `subscriptions` parameter is a list of `ValueSubscription` of an existing table
+        """
+        try:
+            self.dev_names = list(dev_names)
+            self.slots = {dev_name:idx for idx, dev_name in enumerate(self.dev_names)}
+            if len(self.slots) != len(self.dev_names):
+                raise ValueError(f'device names should be unique')
+            self.sources = [''] + list(sources or []) # 0 - unknown source
+            self.source_codes = {source:code for code, source in enumerate(self.sources)}
+            if len(self.sources) > 256:
+                raise ValueError(f'too many sources: {len(self.sources)}')
+            self.quality_codes = {quality:code for code, quality in enumerate(self.qualities)}
+            self.stale_after = dict(stale_after or {})
+            self.default_stale_after = default_stale_after
+            self.subscriptions = list(subscriptions or [])
+            self.slot_stale_after = [float(self.stale_after.get(dev_name, default_stale_after)) for dev_name in self.dev_names]
+            num_slots = max(len(self.dev_names), 1)
+            # layout (8-byte aligned): seq uint32[n] | values float64[n] | timestamps float64[n] | quality uint8[n] | source uint8[n]
+            self.values_offset = (4 * num_slots + 7) // 8 * 8
+            self.timestamps_offset = self.values_offset + 8 * num_slots
+            self.quality_offset = self.timestamps_offset + 8 * num_slots
+            self.source_offset = self.quality_offset + num_slots
+            size = self.source_offset + num_slots
+            if shm_name is None:
+                self.shm = shared_memory.SharedMemory(create=True, size=size) # zero filled: no values yet
+                self.owner = True
+            else: # child processes share the resource tracker of the core, it removes the block if the core dies
+                self.shm = shared_memory.SharedMemory(name=shm_name)
+                self.owner = False
+            self.map_arrays(num_slots)
+        except Exception as err:
+            raise type(err)(f'SharedValueTable init: {err}')
+
+
+    def map_arrays(self, num_slots:int):
+        buf = self.shm.buf
+        self.views = [buf[:4 * num_slots], buf[self.values_offset:self.timestamps_offset], buf[self.timestamps_offset:self.quality_offset],
+                      buf[self.quality_offset:self.source_offset], buf[self.source_offset:self.source_offset + num_slots]]
+        self.views += [view.cast(fmt) for view, fmt in zip(self.views, ('I', 'd', 'd', 'B', 'B'))]
+        self.seq, self.values, self.timestamps, self.quality, self.source = self.views[5:]
+
+
+    def release_views(self):
+        # shared memory can't be closed while views of it exist
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+
+
+    def __getstate__(self):
+        # processes started with spawn attach to the same block by name
+        return {'dev_names':self.dev_names, 'sources':self.sources[1:], 'stale_after':self.stale_after,
+                'default_stale_after':self.default_stale_after, 'shm_name':self.shm.name, 'subscriptions':self.subscriptions}
+
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+    def subscribe(self, name:str, maxsize:int = 1000, changes_only:bool = True):
+        """
+        The function `subscribe` creates a change events queue for a consumer. Subscriptions should be
+        made before the writing processes are started, otherwise they don't see them.
+
+        :param name: The `name` parameter is the name of the consumer
+        :param maxsize: The `maxsize` parameter is the max number of pending event batches
+        :param changes_only: The `changes_only` parameter is False if the consumer needs every written value
+        :return: a `ValueSubscription`.
+        """
+        subscription = ValueSubscription(name, maxsize, changes_only)
+        self.subscriptions.append(subscription)
+        return subscription
+
+
+    def update(self, values:dict, timestamp:float | None = None, quality:str | dict | None = None, source:str | None = None):
+        """
+        The function `update` writes device values to their slots in place (None is stored as NaN with
+        comm_error quality). Changed values (or qualities) are sent to subscriptions as one batch, subscriptions
+        which are not `changes_only` get all written values.
+
+        :param values: The `values` parameter is a dictionary {dev_name: value}
+        :type values: dict
+        :param timestamp: The `timestamp` parameter is the acquisition time (unix time), current time by default
+        :param quality: The `quality` parameter is the quality of all values or a dictionary {dev_name: quality},
+        'good' by default
+        :param source: The `source` parameter is the name of the interface which acquired the values
+        :raises KeyError: if some devices have no slot (values of other devices are written)
+        """
+        if timestamp is None:
+            timestamp = time()
+        source_code = self.source_codes.get(source, 0)
+        comm_error_code = self.quality_codes['comm_error']
+        unknown = []
+        events = {}
+        samples = {}
+        for dev_name, value in values.items():
+            idx = self.slots.get(dev_name, None)
+            if idx is None:
+                unknown.append(dev_name)
+                continue
+            if value is None:
+                value, quality_code = float('nan'), comm_error_code
+            else:
+                dev_quality = quality.get(dev_name, 'good') if isinstance(quality, dict) else quality or 'good'
+                value, quality_code = float(value), self.quality_codes[dev_quality]
+            old_value = self.values[idx] # slots are written by this process only, no torn reads here
+            samples[dev_name] = (None if value != value else value, timestamp, self.qualities[quality_code])
+            if (quality_code != self.quality[idx] or not self.timestamps[idx]
+                    or (old_value != value and (old_value == old_value or value == value))): # NaN == NaN here
+                events[dev_name] = samples[dev_name]
+            seq = self.seq[idx]
+            self.seq[idx] = (seq + 1) & self.seq_mask # odd - slot is being written
+            self.values[idx] = value
+            self.timestamps[idx] = timestamp
+            self.quality[idx] = quality_code
+            self.source[idx] = source_code
+            self.seq[idx] = (seq + 2) & self.seq_mask
+        for subscription in self.subscriptions:
+            if not subscription.changes_only:
+                if samples:
+                    subscription.put(samples)
+            elif events:
+                subscription.put(events)
+        if unknown:
+            raise KeyError(f'SharedValueTable.update: no slots for {unknown}')
+
+
+    def read_slot(self, idx:int, max_attempts:int = 1000):
+        # consistent (value, timestamp, quality, source) of one slot (as is after max_attempts, e.g. if the writer died mid-write)
+        for _ in range(max_attempts):
+            seq = self.seq[idx]
+            if seq & 1:
+                continue
+            slot = (self.values[idx], self.timestamps[idx], self.quality[idx], self.source[idx])
+            if self.seq[idx] == seq:
+                return slot
+        return (self.values[idx], self.timestamps[idx], self.quality[idx], self.source[idx])
+
+
+    def snapshot_arrays(self):
+        """
+        The function `snapshot_arrays` copies all slots at once, slots which were written during the
+        copy are re-read one by one.
+        :return: lists of values, timestamps, quality codes and source codes (in slot order).
+        """
+        seq_before = self.seq.tolist()
+        values = self.values.tolist()
+        timestamps = self.timestamps.tolist()
+        quality = self.quality.tolist()
+        source = self.source.tolist()
+        seq_after = self.seq.tolist()
+        for idx, (seq1, seq2) in enumerate(zip(seq_before, seq_after)):
+            if seq1 != seq2 or seq1 & 1:
+                values[idx], timestamps[idx], quality[idx], source[idx] = self.read_slot(idx)
+        return values, timestamps, quality, source
+
+
+    def get_quality(self, idx:int, quality_code:int, timestamp:float, now:float):
+        # good values are stale when they are too old
+        if quality_code == 0 and now - timestamp > self.slot_stale_after[idx]:
+            return 'stale'
+        return self.qualities[quality_code]
+
+
+    def snapshot(self):
+        """
+        The function `snapshot` returns a consistent copy of the table as a values dict; devices which
+        were never written are omitted, missing values (NaN) are returned as None.
+        """
+        values, timestamps, _, _ = self.snapshot_arrays()
+        return {dev_name:(None if value != value else value) # NaN check
+                for dev_name, value, timestamp in zip(self.dev_names, values, timestamps) if timestamp}
+
+
+    def snapshot_records(self, now:float | None = None):
+        """
+        The function `snapshot_records` returns a consistent copy of the table with value metadata.
+
+        :param now: The `now` parameter is the current unix time for stale detection, taken from clock if not specified
+        :return: a dictionary {dev_name: (value, timestamp, quality, source)} of devices which were written.
+        """
+        if now is None:
+            now = time()
+        records = {}
+        for idx, (value, timestamp, quality_code, source_code) in enumerate(zip(*self.snapshot_arrays())):
+            if not timestamp:
+                continue
+            records[self.dev_names[idx]] = (None if value != value else value, timestamp,
+                                            self.get_quality(idx, quality_code, timestamp, now), self.sources[source_code])
+        return records
+
+
+    def get_record(self, dev_name, now:float | None = None):
+        """
+        The function `get_record` returns (value, timestamp, quality, source) of a device, None if the
+        device was never written.
+        """
+        idx = self.slots.get(dev_name, None)
+        if idx is None:
+            raise KeyError(dev_name)
+        value, timestamp, quality_code, source_code = self.read_slot(idx)
+        if not timestamp:
+            return None
+        return (None if value != value else value, timestamp,
+                self.get_quality(idx, quality_code, timestamp, time() if now is None else now), self.sources[source_code])
+
+
+    def get_records(self, dev_names, now:float | None = None):
+        """
+        The function `get_records` returns records of several devices (e.g. of just received events).
+
+        :param dev_names: The `dev_names` parameter is an iterable of device names
+        :param now: The `now` parameter is the current unix time for stale detection, taken from clock if not specified
+        :return: a dictionary {dev_name: (value, timestamp, quality, source)} of devices which were written.
+        """
+        if now is None:
+            now = time()
+        records = {}
+        for dev_name in dev_names:
+            record = self.get_record(dev_name, now)
+            if record is not None:
+                records[dev_name] = record
+        return records
+
+
+    def get(self, dev_name, default = None):
+        idx = self.slots.get(dev_name, None)
+        if idx is None:
+            return default
+        value, timestamp, _, _ = self.read_slot(idx)
+        if not timestamp:
+            return default
+        return None if value != value else value
+
+
+    def __getitem__(self, dev_name):
+        if dev_name not in self.slots or not self.read_slot(self.slots[dev_name])[1]:
+            raise KeyError(dev_name)
+        return self.get(dev_name)
+
+
+    def __contains__(self, dev_name):
+        return dev_name in self.slots
+
+
+    def __len__(self):
+        return len(self.dev_names)
+
+
+    def keys(self):
+        return self.snapshot().keys()
+
+
+    def items(self):
+        return self.snapshot().items()
+
+
+    def close(self):
+        """
+        The function `close` detaches from the shared memory block, the creating process also removes it.
+        """
+        self.release_views()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+    def __del__(self):
+        try:
+            self.release_views()
+        except Exception:
+            pass